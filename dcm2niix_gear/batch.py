@@ -0,0 +1,457 @@
+"""Batch entry point to convert many dcm2niix Gear inputs on one machine.
+
+Each input is run through run.main, with a plain BatchContext in place of the
+GearToolkitContext, in a pool of worker processes. Each worker imports the gear
+(nipype, nibabel, pydicom, ...) once and converts many inputs, each with an isolated
+work directory and output directory. The status of each input is recorded as it
+completes, so a batch that is interrupted resumes by skipping completed inputs.
+
+Example:
+    python -m dcm2niix_gear.batch /data/archives --output-dir /data/nifti --workers 8
+"""
+
+import argparse
+import hashlib
+import importlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from dcm2niix_gear.dcm2niix import arrange
+from dcm2niix_gear.utils import cache
+from dcm2niix_gear.utils import checkpoint
+from dcm2niix_gear.utils import footprint
+from dcm2niix_gear.utils import planner
+from dcm2niix_gear.utils import profiling
+
+
+log = logging.getLogger(__name__)
+
+GEAR_DIR = Path(__file__).parents[1]
+
+STATUS_DIR = ".status"
+LOGS_DIR = ".logs"
+WORK_DIR = ".work"
+SUMMARY_FILENAME = "batch_summary.json"
+
+
+class BatchContext:
+    """Plain stand-in for the GearToolkitContext attributes used by run.main.
+
+    Args:
+        config (dict): The gear config.
+        inputs (dict): The gear inputs, as in the 'inputs' of a gear config.json.
+        work_dir (str): The absolute path to the work directory of this input.
+        output_dir (str): The absolute path to the output directory of this input.
+
+    """
+
+    def __init__(self, config, inputs, work_dir, output_dir):
+        self.config = config
+        self.config_json = {"config": config, "inputs": inputs}
+        self.work_dir = Path(work_dir)
+        self.output_dir = Path(output_dir)
+        self.log = logging.getLogger("run")
+
+    def get_input_path(self, name):
+        """Return the path to a gear input, or None if it is not set."""
+        return self.config_json["inputs"].get(name, {}).get("location", {}).get("path")
+
+
+def load_config(config_file=None, manifest_file=GEAR_DIR / "manifest.json"):
+    """Return the gear config and inputs for a batch.
+
+        The config is the manifest defaults, updated with the 'config' of the config
+        file, if set. The 'inputs' of the config file (e.g., the modality and
+        classification of dcm2niix_input, or a pydeface_template) apply to every input
+        of the batch; the location of dcm2niix_input is set per input.
+
+    Args:
+        config_file (str): The path to a config JSON, in the format of a gear
+            config.json.
+        manifest_file (str): The path to the gear manifest.
+
+    Returns:
+        config (dict): The gear config.
+        inputs (dict): The gear inputs, other than the dcm2niix_input location.
+
+    """
+    with open(manifest_file) as manifest_obj:
+        manifest = json.load(manifest_obj)
+
+    config = {
+        name: option["default"]
+        for name, option in manifest["config"].items()
+        if "default" in option
+    }
+
+    config_json = {}
+    if config_file:
+        with open(config_file) as config_obj:
+            config_json = json.load(config_obj)
+
+    config.update(config_json.get("config", {}))
+    inputs = config_json.get("inputs", {})
+
+    return config, inputs
+
+
+def find_inputs(paths, input_list=None):
+    """Return the input files from files, directories and an optional list file."""
+    input_files = []
+
+    if input_list:
+        with open(input_list) as list_obj:
+            paths = list(paths) + [line.strip() for line in list_obj if line.strip()]
+
+    for path in paths:
+        path = Path(path).absolute()
+        if path.is_dir():
+            input_files.extend(
+                sorted(
+                    file
+                    for file in path.iterdir()
+                    if file.is_file() and not file.name.startswith(".")
+                )
+            )
+        else:
+            input_files.append(path)
+
+    return input_files
+
+
+def input_names(input_files):
+    """Return a unique name per input file, used for its output directory.
+
+        The name is the filename, unless two inputs share it, in which case a hash of
+        the absolute path is appended, so that names are stable across resumes.
+
+    """
+    counts = {}
+    for file in input_files:
+        counts[file.name] = counts.get(file.name, 0) + 1
+
+    names = {}
+    for file in input_files:
+        name = file.name
+        if counts[name] > 1:
+            digest = hashlib.sha1(str(file).encode()).hexdigest()[:8]
+            name = f"{name}_{digest}"
+        names[file] = name
+
+    return names
+
+
+def completed(output_root, name):
+    """Return true if the input of this name completed successfully."""
+    status_file = os.path.join(output_root, STATUS_DIR, f"{name}.json")
+    try:
+        with open(status_file) as status_obj:
+            return json.load(status_obj)["status"] == "success"
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return False
+
+
+def convert_input(input_file, name, output_root, config, inputs, keep_work=False):
+    """Run the gear on one input and record its status.
+
+        The outputs are written to output_root/name, the gear log to
+        output_root/.logs/name.log and the status to output_root/.status/name.json.
+
+    Args:
+        input_file (str): The absolute path to the input file.
+        name (str): The unique name of the input.
+        output_root (str): The absolute path to the batch output directory.
+        config (dict): The gear config.
+        inputs (dict): The gear inputs, other than the dcm2niix_input location.
+        keep_work (bool): If true, keep the work directory of the input.
+
+    Returns:
+        status (dict): The status of the input.
+
+    """
+    import run
+
+    # An input left running by a crashed worker is told apart from one not started
+    write_status(
+        output_root, name, {"input": str(input_file), "name": name, "status": "running"}
+    )
+
+    output_dir = os.path.join(output_root, name)
+    work_dir = os.path.join(output_root, WORK_DIR, name)
+
+    # Outputs of an input that did not complete are removed before it is rerun
+    for directory in [output_dir, work_dir]:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+    inputs = {
+        **inputs,
+        "dcm2niix_input": {
+            **inputs.get("dcm2niix_input", {}),
+            "location": {"name": Path(input_file).name, "path": str(input_file)},
+        },
+    }
+    context = BatchContext(config, inputs, work_dir, output_dir)
+
+    log_handler = logging.FileHandler(
+        os.path.join(output_root, LOGS_DIR, f"{name}.log")
+    )
+    log_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s")
+    )
+    root_logger = logging.getLogger()
+    root_logger.addHandler(log_handler)
+
+    # run.log is only defined when run.py is executed as a script
+    run.log = context.log
+    profiling.reset()
+    planner.reset()
+    arrange.reset()
+    cache.release_pins()
+    checkpoint.reset()
+    footprint.reset()
+
+    status = {"input": str(input_file), "name": name, "error": None}
+    start = time.perf_counter()
+    try:
+        status["exit_status"] = run.main(context)
+    except SystemExit as exception:
+        status["exit_status"] = exception.code
+    except Exception as exception:
+        root_logger.exception(f"Error converting {input_file}.")
+        status["exit_status"] = 1
+        status["error"] = repr(exception)
+    finally:
+        root_logger.removeHandler(log_handler)
+        log_handler.close()
+
+    status["wall_time"] = time.perf_counter() - start
+    status["status"] = "success" if status["exit_status"] in [0, None] else "failed"
+
+    if not keep_work:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    write_status(output_root, name, status)
+    return status
+
+
+def write_status(output_root, name, status):
+    """Write the status of an input, replacing any previous status atomically."""
+    status_file = os.path.join(output_root, STATUS_DIR, f"{name}.json")
+    with open(f"{status_file}.tmp", "w") as status_obj:
+        json.dump(status, status_obj, indent=2)
+    os.replace(f"{status_file}.tmp", status_file)
+
+
+def _initialize_worker(log_level):
+    """Import the gear once per worker process."""
+    if str(GEAR_DIR) not in sys.path:
+        sys.path.insert(0, str(GEAR_DIR))
+    # Forked workers inherit the handlers of the batch, so basicConfig is a no-op
+    logging.basicConfig()
+    logging.getLogger().setLevel(log_level)
+    logging.getLogger().handlers[0].setLevel(logging.WARNING)
+    importlib.import_module("run")
+
+
+def run_batch(
+    input_files,
+    output_root,
+    config,
+    inputs,
+    workers=1,
+    keep_work=False,
+    log_level=logging.INFO,
+):
+    """Convert input files in a pool of worker processes and write a summary.
+
+    Args:
+        input_files (list): The absolute paths to the input files.
+        output_root (str): The absolute path to the batch output directory.
+        config (dict): The gear config.
+        inputs (dict): The gear inputs, other than the dcm2niix_input location.
+        workers (int): The number of worker processes.
+        keep_work (bool): If true, keep the work directory of each input.
+        log_level (int): The level of the gear log written per input.
+
+    Returns:
+        summary (dict): The batch summary, also written to output_root.
+
+    """
+    for directory in [STATUS_DIR, LOGS_DIR, WORK_DIR]:
+        os.makedirs(os.path.join(output_root, directory), exist_ok=True)
+
+    names = input_names(input_files)
+    pending = [file for file in input_files if not completed(output_root, names[file])]
+    log.info(
+        f"{len(input_files) - len(pending)} of {len(input_files)} inputs already "
+        f"completed. Converting {len(pending)} inputs with {workers} workers."
+    )
+
+    start = time.perf_counter()
+    while pending:
+        not_started = convert_pending(
+            pending, names, output_root, config, inputs, workers, keep_work, log_level
+        )
+
+        # A pool that breaks before converting any input would break again
+        if len(not_started) == len(pending):
+            for file in not_started:
+                write_status(output_root, names[file], crashed_status(file, names))
+            break
+        if not_started:
+            log.warning(
+                f"Worker crashed. Resubmitting {len(not_started)} inputs not started."
+            )
+        pending = not_started
+
+    summary = write_summary(output_root, input_files, names)
+    summary["wall_time"] = time.perf_counter() - start
+    log.info(
+        f"Batch completed in {summary['wall_time']:.1f} s: "
+        + ", ".join(f"{count} {status}" for status, count in summary["counts"].items())
+    )
+
+    return summary
+
+
+def convert_pending(
+    pending, names, output_root, config, inputs, workers, keep_work, log_level
+):
+    """Convert input files in a pool of worker processes, until the pool breaks.
+
+        A worker that crashes breaks the pool, which fails every input not yet
+        converted. Only the inputs running at the time are recorded as crashed; the
+        inputs not started are returned to be converted in a new pool.
+
+    Args:
+        pending (list): The absolute paths to the input files to convert.
+        names (dict): The unique name of each input file.
+        output_root (str): The absolute path to the batch output directory.
+        config (dict): The gear config.
+        inputs (dict): The gear inputs, other than the dcm2niix_input location.
+        workers (int): The number of worker processes.
+        keep_work (bool): If true, keep the work directory of each input.
+        log_level (int): The level of the gear log written per input.
+
+    Returns:
+        not_started (list): The input files not started when the pool broke.
+
+    """
+    # The status of a previous run would be read as that of this run
+    for file in pending:
+        status_file = os.path.join(output_root, STATUS_DIR, f"{names[file]}.json")
+        if os.path.exists(status_file):
+            os.remove(status_file)
+
+    not_started = []
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_initialize_worker, initargs=(log_level,)
+    ) as executor:
+        futures = {
+            executor.submit(
+                convert_input,
+                str(file),
+                names[file],
+                output_root,
+                config,
+                inputs,
+                keep_work,
+            ): file
+            for file in pending
+        }
+
+        for future in as_completed(futures):
+            file = futures[future]
+            try:
+                status = future.result()
+            except BrokenProcessPool:
+                if not started(output_root, names[file]):
+                    not_started.append(file)
+                    continue
+                status = crashed_status(file, names)
+                write_status(output_root, names[file], status)
+            log.info(f"{status['status']}: {file}")
+
+    # Inputs are resubmitted in their original order
+    return [file for file in pending if file in not_started]
+
+
+def started(output_root, name):
+    """Return true if the input of this name was started by a worker."""
+    status_file = os.path.join(output_root, STATUS_DIR, f"{name}.json")
+    return os.path.exists(status_file)
+
+
+def crashed_status(file, names):
+    """Return the status of an input whose worker crashed."""
+    return {"input": str(file), "name": names[file], "status": "crashed"}
+
+
+def write_summary(output_root, input_files, names):
+    """Write the summary of the status of every input of the batch."""
+    statuses = []
+    for file in input_files:
+        status_file = os.path.join(output_root, STATUS_DIR, f"{names[file]}.json")
+        try:
+            with open(status_file) as status_obj:
+                statuses.append(json.load(status_obj))
+        except (FileNotFoundError, json.JSONDecodeError):
+            statuses.append(
+                {"input": str(file), "name": names[file], "status": "pending"}
+            )
+
+    counts = {}
+    for status in statuses:
+        counts[status["status"]] = counts.get(status["status"], 0) + 1
+
+    summary = {"counts": counts, "inputs": statuses}
+    with open(os.path.join(output_root, SUMMARY_FILENAME), "w") as summary_obj:
+        json.dump(summary, summary_obj, indent=2)
+
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "inputs", nargs="*", help="Input files, or directories of input files."
+    )
+    parser.add_argument("--input-list", help="File listing one input path per line.")
+    parser.add_argument("--output-dir", required=True, help="Batch output directory.")
+    parser.add_argument(
+        "--config", help="Config JSON in the format of a gear config.json."
+    )
+    parser.add_argument("--workers", type=int, default=planner.cpu_quota())
+    parser.add_argument("--keep-work", action="store_true")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    config, inputs = load_config(args.config)
+    input_files = find_inputs(args.inputs, args.input_list)
+    output_root = os.path.abspath(args.output_dir)
+
+    summary = run_batch(
+        input_files,
+        output_root,
+        config,
+        inputs,
+        workers=args.workers,
+        keep_work=args.keep_work,
+        log_level=logging.DEBUG if args.debug else logging.INFO,
+    )
+
+    return 0 if set(summary["counts"]) <= {"success"} else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,58 @@
 """Functions to arrange dcm2niix input."""
 
+import contextlib
 import glob
 import logging
 import os
 import re
 import shutil
+import subprocess
 import tarfile
+import tempfile
 import zipfile
+from pathlib import Path
 
+import pydicom
+from pydicom.filereader import InvalidDicomError
+
+from dcm2niix_gear.utils import cache
+from dcm2niix_gear.utils import processes
+from dcm2niix_gear.utils import profiling
 
-log = logging.getLogger(__name__)
 
+log = logging.getLogger(__name__)
 
-def prepare_dcm2niix_input(infile, rec_infile, work_dir):
+# Compressed tar archives decompressed by an external decoder, identified by magic
+# number; the decoder runs in its own process, so that decompression overlaps with
+# extraction
+TAR_DECODERS = {
+    "zstd": {
+        "magic": b"\x28\xb5\x2f\xfd",
+        "command": ["zstd", "--decompress", "--stdout", "--quiet", "--long=31"],
+    },
+    "xz": {
+        "magic": b"\xfd7zXZ\x00",
+        # Multi-threaded decoding of archives compressed in blocks (xz >= 5.4)
+        "command": ["xz", "--decompress", "--stdout", "--threads=0"],
+    },
+}
+
+# Bytes read at a time when draining the output of a decoder
+DRAIN_SIZE = 1024**2
+
+# Uncompressed bytes of a tar archive per compressed byte, if the size is not
+# recorded by the compression format
+TAR_EXPANSION = 3
+
+# The member listings of the archives listed or extracted, by path
+_listings = {}
+
+
+def prepare_dcm2niix_input(infile, rec_infile, work_dir, remove_duplicates=False):
     """Prepare dcm2niix input directory.
 
-        The input can be a zip archive (.zip), a compressed tar archive (.tgz), or a
-        par/rec file pair. Input contents are placed in a single directory. The path to
+        The input can be a zip archive (.zip), a compressed tar archive (.tgz,
+        .tar.zst, .tar.xz), or a par/rec file pair. Input contents are placed in a single directory. The path to
         this directory is the output of this function.
 
     Args:
@@ -25,6 +61,8 @@ def prepare_dcm2niix_input(infile, rec_infile, work_dir):
             note, the infile input must be a valid par file.
         work_dir (str): The absolute path to the working directory where the output
             directory is created.
+        remove_duplicates (bool): If true, remove duplicate instances extracted from
+            an archive, before the archive contents are flattened.
 
     Returns:
         dcm2niix_input_dir (str): The absolute path to the output directory containing
@@ -40,7 +78,9 @@ def prepare_dcm2niix_input(infile, rec_infile, work_dir):
             with zipfile.ZipFile(infile, "r") as zip_obj:
                 log.info(f"Establishing input as zip file: {infile}")
                 exit_if_archive_empty(zip_obj)
-                dcm2niix_input_dir = extract_archive_contents(zip_obj, work_dir)
+                dcm2niix_input_dir = extract_archive_contents(
+                    zip_obj, work_dir, remove_duplicates
+                )
 
         except zipfile.BadZipFile:
             log.exception(
@@ -51,13 +91,35 @@ def prepare_dcm2niix_input(infile, rec_infile, work_dir):
             )
             os.sys.exit(1)
 
+    elif compressed_tar_format(infile):
+
+        # Extracted in one pass; the archive is checked for contents as it is read
+        try:
+            log.info(
+                f"Establishing input as {compressed_tar_format(infile)} compressed tar "
+                f"file: {infile}"
+            )
+            dcm2niix_input_dir = extract_tar_stream(infile, work_dir, remove_duplicates)
+
+        except tarfile.ReadError:
+            log.exception(
+                (
+                    "Incorrect gear input. "
+                    "File is not a compressed tar archive file (.tar.zst, .tar.xz). "
+                    "Exiting."
+                )
+            )
+            os.sys.exit(1)
+
     elif tarfile.is_tarfile(infile):
 
         try:
             with tarfile.open(infile, "r") as tar_obj:
                 log.info(f"Establishing input as tar file: {infile}")
                 exit_if_archive_empty(tar_obj)
-                dcm2niix_input_dir = extract_archive_contents(tar_obj, work_dir)
+                dcm2niix_input_dir = extract_archive_contents(
+                    tar_obj, work_dir, remove_duplicates
+                )
 
         except tarfile.ReadError:
             log.exception(
@@ -102,10 +164,19 @@ def prepare_dcm2niix_input(infile, rec_infile, work_dir):
 def exit_if_archive_empty(archive_obj):
     """If the archive contents are empty, log an error and exit."""
     if type(archive_obj) == zipfile.ZipFile:
-        size_contents = sum([zipinfo.file_size for zipinfo in archive_obj.filelist])
+        # The listing of the preflight, if listed before
+        size_contents = list_archive(archive_obj.filename)["size"]
 
     elif type(archive_obj) == tarfile.TarFile:
-        size_contents = sum([tarinfo.size for tarinfo in archive_obj.getmembers()])
+        members = archive_obj.getmembers()
+        size_contents = sum([tarinfo.size for tarinfo in members])
+
+        # The listing, read by the check rather than by another pass
+        _listings[str(archive_obj.name)] = {
+            "subdirs": [info.name for info in members if info.isdir()],
+            "files": {info.name: info.size for info in members if info.isreg()},
+            "size": size_contents,
+        }
 
     else:
         log.info(
@@ -237,7 +308,7 @@ def flatten_directory(dir_source, dir_target, overwrite=False):
     )
 
 
-def extract_archive_contents(archive_obj, work_dir):
+def extract_archive_contents(archive_obj, work_dir, remove_duplicates=False):
     """Extract archive contents to a directory created from the input filename."""
     # 1. Get the stage for zip or tar archive
     if type(archive_obj) == zipfile.ZipFile:
@@ -255,7 +326,11 @@ def extract_archive_contents(archive_obj, work_dir):
 
         # Input filename will be used as the dcm2niix input directory name
         dcm2niix_input_dir, dirname = setup_dcm2niix_input_dir(filename, work_dir)
-        archive_obj.extractall(dcm2niix_input_dir)
+        with profiling.span("extraction", files=len(filelist)):
+            archive_obj.extractall(dcm2niix_input_dir)
+
+        if remove_duplicates:
+            remove_duplicate_instances(dcm2niix_input_dir)
 
     elif len(subdirs) >= 1:
 
@@ -277,19 +352,27 @@ def extract_archive_contents(archive_obj, work_dir):
         os.mkdir(dcm2niix_input_dir_o)
 
         # extract
-        if type(archive_obj) == zipfile.ZipFile:
-            for subdir in subdirs:
-                archive_obj.extractall(
-                    dcm2niix_input_dir_o, strip_prefix_ziparchive(archive_obj, subdir)
-                )
-        elif type(archive_obj) == tarfile.TarFile:
-            for subdir in subdirs:
-                archive_obj.extractall(
-                    dcm2niix_input_dir_o, strip_prefix_tararchive(archive_obj, subdir)
-                )
+        with profiling.span("extraction", files=len(filelist)):
+            if type(archive_obj) == zipfile.ZipFile:
+                for subdir in subdirs:
+                    archive_obj.extractall(
+                        dcm2niix_input_dir_o,
+                        strip_prefix_ziparchive(archive_obj, subdir),
+                    )
+            elif type(archive_obj) == tarfile.TarFile:
+                for subdir in subdirs:
+                    archive_obj.extractall(
+                        dcm2niix_input_dir_o,
+                        strip_prefix_tararchive(archive_obj, subdir),
+                    )
+
+        # duplicates in different subdirectories may share a filename
+        if remove_duplicates:
+            remove_duplicate_instances(dcm2niix_input_dir_o)
 
         # flattening: take file leaves in dcm2niix_input_dir_o and move them dcm2niix_input_dir
-        flatten_directory(dcm2niix_input_dir_o, dcm2niix_input_dir)
+        with profiling.span("flattening"):
+            flatten_directory(dcm2niix_input_dir_o, dcm2niix_input_dir)
 
         # clean up
         shutil.rmtree(dcm2niix_input_dir_o)
@@ -312,6 +395,338 @@ def extract_archive_contents(archive_obj, work_dir):
     return dcm2niix_input_dir
 
 
+def list_archive(infile):
+    """Return the member listing of a zip archive, or of a tar archive once extracted.
+
+        A zip archive is listed from its central directory, once per archive. A tar
+        archive is only listed by decompressing it, so its listing is recorded by
+        the extraction, which reads it once.
+
+    Args:
+        infile (str): The absolute path to the input file.
+
+    Returns:
+        listing (dict): The names of the 'subdirs' and the size of each of the
+            'files' of the archive, with their total 'size'; None if the input is
+            not a zip archive or an extracted tar archive.
+
+    Raises:
+        zipfile.BadZipFile: If the zip archive cannot be read.
+
+    """
+    infile = str(infile)
+    if infile in _listings:
+        return _listings[infile]
+
+    if not zipfile.is_zipfile(infile):
+        return None
+
+    with zipfile.ZipFile(infile, "r") as zip_obj:
+        infolist = zip_obj.infolist()
+
+    _listings[infile] = {
+        "subdirs": [info.filename for info in infolist if info.is_dir()],
+        "files": {
+            info.filename: info.file_size for info in infolist if not info.is_dir()
+        },
+        "size": sum(info.file_size for info in infolist),
+    }
+
+    return _listings[infile]
+
+
+def archive_size(infile):
+    """Return the uncompressed bytes of the contents of an archive, before extraction.
+
+        A zip archive is sized from its listing, and a tar archive is estimated
+        without decompressing it, by estimate_tar_size.
+
+    Args:
+        infile (str): The absolute path to the input file.
+
+    Returns:
+        size (int): The bytes of the archive contents; None if the input is not a
+            zip or tar archive.
+
+    Raises:
+        zipfile.BadZipFile, tarfile.TarError: If the archive cannot be read.
+
+    """
+    listing = list_archive(infile)
+    if listing is not None:
+        return listing["size"]
+
+    if compressed_tar_format(infile) or tarfile.is_tarfile(infile):
+        return estimate_tar_size(infile)
+
+    return None
+
+
+def estimate_tar_size(infile):
+    """Return the uncompressed bytes of a tar archive, without decompressing it.
+
+        gzip records the size (modulo 4 GiB) in its trailer, xz in its index, and
+        zstd in its frame header, if compressed from a file; these are read, or
+        else the size is TAR_EXPANSION times the compressed size.
+
+    Args:
+        infile (str): The absolute path to the tar archive.
+
+    Returns:
+        size (int): The estimated bytes of the uncompressed archive.
+
+    """
+    compressed_size = os.path.getsize(infile)
+    with open(infile, "rb") as file_obj:
+        magic = file_obj.read(3)
+
+    size = None
+    if magic[:2] == b"\x1f\x8b":
+        with open(infile, "rb") as file_obj:
+            file_obj.seek(-4, os.SEEK_END)
+            size = int.from_bytes(file_obj.read(4), "little")
+        # The trailer records the size modulo 4 GiB
+        while size < compressed_size:
+            size += 2**32
+
+    elif compressed_tar_format(infile) == "xz" and shutil.which("xz"):
+        process = processes.run(["xz", "--robot", "--list", str(infile)])
+        for line in process.stdout.splitlines():
+            fields = line.split("\t")
+            if fields[0] == "totals" and process.returncode == 0:
+                size = int(fields[4])
+
+    elif compressed_tar_format(infile) == "zstd" and shutil.which("zstd"):
+        process = processes.run(["zstd", "--list", "-v", str(infile)])
+        match = re.search(r"Decompressed Size: .*\((\d+) B\)", process.stdout)
+        if match and process.returncode == 0:
+            size = int(match.group(1))
+
+    elif not compressed_tar_format(infile) and magic != b"BZh":
+        size = compressed_size
+
+    if size is None:
+        log.info(f"Size of {infile} not recorded. Estimated from the compressed size.")
+        size = TAR_EXPANSION * compressed_size
+
+    return size
+
+
+def reset():
+    """Clear the archive listings, e.g., between inputs converted by the batch runner."""
+    _listings.clear()
+
+
+def compressed_tar_format(infile):
+    """Return the decoder of a zstd or xz compressed file, from its magic number."""
+    try:
+        with open(infile, "rb") as file_obj:
+            magic = file_obj.read(6)
+    except OSError:
+        return None
+
+    for compression, decoder in TAR_DECODERS.items():
+        if magic.startswith(decoder["magic"]):
+            return compression
+
+    return None
+
+
+@contextlib.contextmanager
+def open_tar_stream(infile):
+    """Open a tar archive as a stream of members, decompressed as they are read.
+
+        A zstd or xz compressed archive is decompressed by the external decoder, with
+        its resource usage recorded in the run profile; xz archives are decompressed
+        in-process if xz is not installed. Other tar archives are decompressed by
+        tarfile.
+
+    Args:
+        infile (str): The absolute path to the tar archive.
+
+    Yields:
+        tar_obj (tarfile.TarFile): The archive, read as a stream.
+
+    Raises:
+        tarfile.ReadError: If the archive cannot be decompressed or read.
+
+    """
+    compression = compressed_tar_format(infile)
+    if compression and not shutil.which(TAR_DECODERS[compression]["command"][0]):
+        if compression != "xz":
+            log.error(f"{compression} is not installed. Unable to decompress input.")
+            os.sys.exit(1)
+        log.warning("xz is not installed. Decompressing in-process.")
+        compression = None
+
+    if compression is None:
+        with tarfile.open(infile, "r|*") as tar_obj:
+            yield tar_obj
+        return
+
+    with processes.popen(
+        TAR_DECODERS[compression]["command"] + [str(infile)],
+        tool=compression,
+        stderr=subprocess.PIPE,
+    ) as process:
+        try:
+            with tarfile.open(fileobj=process.stdout, mode="r|") as tar_obj:
+                yield tar_obj
+            # Drain the padding after the end of the archive, so the decoder completes
+            while process.stdout.read(DRAIN_SIZE):
+                pass
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read().decode(errors="replace").strip()
+            process.stderr.close()
+
+    if process.returncode != 0:
+        raise tarfile.ReadError(
+            f"{compression} exited with status {process.returncode}: {stderr}"
+        )
+
+
+def extract_tar_stream(infile, work_dir, remove_duplicates=False):
+    """Extract a tar archive as it is decompressed.
+
+        The archive is read once, so the directory layout is only known after
+        extraction: the contents are extracted to a scratch directory, then arranged
+        as by extract_archive_contents, named by the first directory of the archive
+        and flattened, or named by the archive, if the archive has no directories.
+        Links are kept as by extract_archive_contents: extracted from an archive
+        without directories, and dropped from a flattened archive. As the archive
+        is only listed as it is read, an empty archive is found after extraction.
+
+    Args:
+        infile (str): The absolute path to the tar archive.
+        work_dir (str): The absolute path to the working directory.
+        remove_duplicates (bool): If true, remove duplicate instances before the
+            archive contents are flattened.
+
+    Returns:
+        dcm2niix_input_dir (str): The absolute path to the output directory containing
+            the files from the archive.
+
+    """
+    scratch_dir = tempfile.mkdtemp(prefix=".extraction_", dir=str(work_dir))
+    subdirs = []
+    filelist = []
+    files = {}
+    links = []
+
+    with profiling.span("extraction"):
+        with open_tar_stream(infile) as tar_obj:
+            for info in tar_obj:
+                if info.isdir():
+                    subdirs.append(info.name)
+                elif info.isreg():
+                    files[info.name] = info.size
+                elif info.issym() or info.islnk():
+                    links.append(info.name)
+                else:
+                    continue
+                filelist.append(info.name)
+                tar_obj.extract(info, scratch_dir)
+
+    # The listing, read by the extraction rather than by another pass
+    size = sum(files.values())
+    _listings[str(infile)] = {"subdirs": subdirs, "files": files, "size": size}
+
+    if size == 0:
+        shutil.rmtree(scratch_dir)
+        log.error("Incorrect gear input. Input archive is empty. Exiting.")
+        os.sys.exit(1)
+
+    if subdirs:
+
+        # Subdirectory name will be used as the dcm2niix input directory name
+        log.info(f"subdirs: {subdirs}")
+        dcm2niix_input_dir, dirname = setup_dcm2niix_input_dir(subdirs[0], work_dir)
+        shutil.rmtree(dcm2niix_input_dir)
+
+        # Only regular files are flattened, as by strip_prefix_tararchive
+        for link in links:
+            os.remove(os.path.join(scratch_dir, link))
+
+        # duplicates in different subdirectories may share a filename
+        if remove_duplicates:
+            remove_duplicate_instances(scratch_dir)
+
+        with profiling.span("flattening"):
+            flatten_directory(scratch_dir, dcm2niix_input_dir)
+        shutil.rmtree(scratch_dir)
+
+    else:
+
+        # Input filename will be used as the dcm2niix input directory name
+        dcm2niix_input_dir, dirname = setup_dcm2niix_input_dir(infile, work_dir)
+        os.rmdir(dcm2niix_input_dir)
+        os.rename(scratch_dir, dcm2niix_input_dir)
+
+        if remove_duplicates:
+            remove_duplicate_instances(dcm2niix_input_dir)
+
+    # If PAR file in the archive, then adjust par/rec filenames
+    if [file for file in filelist if file.lower().endswith(".par")]:
+        adjust_parrec_filenames(dcm2niix_input_dir, dirname)
+
+    return dcm2niix_input_dir
+
+
+def remove_duplicate_instances(directory):
+    """Remove duplicate instances, keeping the first copy of each in path order.
+
+        DICOMs are identified by SOPInstanceUID, and other files (or DICOMs without
+        SOPInstanceUID) by the hash of their contents. Files starting with a period
+        are ignored, as they are dropped when the input is arranged.
+
+    Args:
+        directory (str): The absolute path to the extracted archive contents.
+
+    Returns:
+        duplicates (dict): The paths to the removed files, with the path to the copy
+            kept of each.
+
+    """
+    files = sorted(
+        path
+        for path in Path(directory).rglob("*")
+        if path.is_file() and not path.name.startswith(".")
+    )
+
+    instances = {}
+    duplicates = {}
+    with profiling.span("deduplication", files=len(files)):
+        for path in files:
+            try:
+                dicom_header = pydicom.dcmread(
+                    str(path), stop_before_pixels=True, specific_tags=["SOPInstanceUID"]
+                )
+                instance = f"uid:{dicom_header.SOPInstanceUID}"
+            except (InvalidDicomError, AttributeError, EOFError):
+                instance = f"sha256:{cache.file_hash(str(path))}"
+
+            if instance in instances:
+                duplicates[str(path)] = instances[instance]
+                os.remove(path)
+            else:
+                instances[instance] = str(path)
+
+    if duplicates:
+        log.warning(
+            f"Removed {len(duplicates)} duplicate instances of {len(files)} files."
+        )
+        for duplicate, kept in duplicates.items():
+            log.info(
+                f"Removed {os.path.relpath(duplicate, directory)}, a duplicate of "
+                f"{os.path.relpath(kept, directory)}."
+            )
+    else:
+        log.info(f"No duplicate instances in {len(files)} files.")
+
+    return duplicates
+
+
 def setup_dcm2niix_input_dir(infile, work_dir):
     """Create dcm2niix input directory using the filename from the input filepath."""
     if os.path.isfile(infile):
@@ -331,7 +746,7 @@ def clean_filename(filename):
     """Clean filename for the alphanumeric filename without extensions."""
     # Drop file extension
     # Do not use os.path.splitext because filename not required to have an extension
-    for extension in [".zip", ".tgz", ".par", ".PAR"]:
+    for extension in [".zip", ".tgz", ".tar.zst", ".tar.xz", ".par", ".PAR"]:
         if filename.endswith(extension):
             filename = filename.replace(extension, "")
 
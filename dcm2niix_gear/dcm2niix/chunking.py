@@ -0,0 +1,410 @@
+"""Functions to convert long series in temporal chunks and concatenate the outputs."""
+
+import gzip
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import nibabel as nb
+import numpy as np
+import pydicom
+from pydicom.filereader import InvalidDicomError
+
+from dcm2niix_gear.dcm2niix import conversion_cache
+from dcm2niix_gear.dcm2niix import incremental
+from dcm2niix_gear.dcm2niix import series_pipeline
+from dcm2niix_gear.utils import planner
+from dcm2niix_gear.utils import profiling
+
+
+log = logging.getLogger(__name__)
+
+CHUNKING_DIR = ".chunking"
+
+# A series is split only if each chunk has at least this number of volumes
+MIN_CHUNK_VOLUMES = 10
+
+# DICOM attributes identifying the volume of each file, in order of preference
+VOLUME_ATTRIBUTES = ["TemporalPositionIdentifier", "AcquisitionNumber"]
+
+# Sidecar fields dcm2niix writes with one value per volume, e.g., of PET frames
+VOLUME_FIELDS = [
+    "DecayCorrectionFactor",
+    "FrameDuration",
+    "FrameReferenceTime",
+    "FrameTimesStart",
+]
+
+# Header fields that must match across chunks to concatenate them
+HEADER_FIELDS = [
+    "datatype",
+    "bitpix",
+    "scl_slope",
+    "scl_inter",
+    "qform_code",
+    "sform_code",
+    "quatern_b",
+    "quatern_c",
+    "quatern_d",
+    "qoffset_x",
+    "qoffset_y",
+    "qoffset_z",
+    "srow_x",
+    "srow_y",
+    "srow_z",
+]
+
+
+def convert(dcm2niix_input_dir, work_dir, dcm2niix_args, chunks=2):
+    """Convert the series of the input, splitting long series into temporal chunks.
+
+        Each series with at least chunks * MIN_CHUNK_VOLUMES volumes, identified by
+        TemporalPositionIdentifier or AcquisitionNumber, is split into chunks of
+        consecutive volumes, converted in parallel by one dcm2niix run each, as
+        many at a time as planner.temporal_chunks fits. The series are split into
+        more chunks, if a chunk of the largest series would not fit in memory. The 4D
+        NIfTIs of the chunks are concatenated along time, streaming the image data
+        of each chunk into the output; the sidecar of the first chunk is kept, as for
+        a single conversion, with the per-volume lists of VOLUME_FIELDS concatenated,
+        and the bval and bvec files are concatenated. The other
+        series are converted together in one dcm2niix run. A chunked series whose
+        outputs cannot be concatenated, e.g., with another scaling per chunk, is
+        converted as a whole.
+
+    Args:
+        dcm2niix_input_dir (str): The absolute path to the input directory to dcm2niix.
+        work_dir (str): The absolute path to the output directory of dcm2niix.
+        dcm2niix_args (dict): The gear args of the dcm2niix stage.
+        chunks (int): The number of chunks to split long series into.
+
+    Returns:
+        output (types.SimpleNamespace): The dcm2niix outputs, in order of series
+            number; None if no series is split, or the series of the input cannot be
+            converted separately, and the input must be converted as a whole.
+
+    """
+    if not applicable(dcm2niix_args):
+        return None
+
+    series = incremental.fingerprint_series(dcm2niix_input_dir)
+    if len(series) > 1:
+        series = incremental.separable_series(dcm2niix_input_dir, dcm2niix_args)
+    if not series:
+        return None
+
+    # Split into more chunks than asked, if a chunk of the largest series would not
+    # fit the memory of the job
+    planned_chunks, _ = planner.temporal_chunks(chunks)
+    if planned_chunks > chunks:
+        log.info(
+            f"Splitting long series into {planned_chunks} temporal chunks, rather "
+            f"than {chunks}, to fit the memory of the job."
+        )
+        chunks = planned_chunks
+
+    volumes = {
+        series_uid: split_volumes(info["files"], chunks)
+        for series_uid, info in series.items()
+    }
+    chunked = [series_uid for series_uid in series if volumes[series_uid]]
+    if not chunked:
+        log.info("No series long enough to convert in temporal chunks.")
+        return None
+
+    log.info(f"Converting {len(chunked)} series in {chunks} temporal chunks.")
+    chunking_dir = os.path.join(str(work_dir), CHUNKING_DIR)
+    series_outputs = {}
+
+    try:
+        for series_uid in chunked:
+            with profiling.span("chunks", chunks=chunks):
+                outputs = convert_chunks(
+                    dcm2niix_input_dir,
+                    series_uid,
+                    series[series_uid],
+                    volumes[series_uid],
+                    os.path.join(chunking_dir, series_uid),
+                    dcm2niix_args,
+                )
+            if outputs is not None:
+                series_outputs[series_uid] = outputs
+
+        remaining = {
+            series_uid: info
+            for series_uid, info in series.items()
+            if series_uid not in series_outputs
+        }
+        if remaining:
+            remaining_outputs = incremental.convert_series(
+                dcm2niix_input_dir,
+                remaining,
+                os.path.join(chunking_dir, "remaining"),
+                dcm2niix_args,
+            )
+            if remaining_outputs is None:
+                return None
+            series_outputs.update(remaining_outputs)
+
+        outputs = {field: [] for field in conversion_cache.OUTPUT_FIELDS}
+        for series_uid in series:
+            moved = series_pipeline.move_outputs(series_outputs[series_uid], work_dir)
+            for field in conversion_cache.OUTPUT_FIELDS:
+                outputs[field].extend(moved[field])
+
+    finally:
+        shutil.rmtree(chunking_dir, ignore_errors=True)
+
+    return SimpleNamespace(outputs=SimpleNamespace(**outputs))
+
+
+def applicable(dcm2niix_args):
+    """Return true if the outputs of a series are 4D NIfTIs that can be concatenated."""
+    if (
+        dcm2niix_args["output_nrrd"]
+        or dcm2niix_args["compress_images"] == "3"
+        or dcm2niix_args["bids_sidecar"] == "o"
+    ):
+        log.info("Outputs are not 4D NIfTIs. Not converting in temporal chunks.")
+        return False
+
+    if dcm2niix_args["ignore_errors"]:
+        return False
+
+    return True
+
+
+def split_volumes(files, chunks):
+    """Split the files of a series into chunks of consecutive volumes.
+
+    Args:
+        files (list): The absolute paths to the DICOMs of the series.
+        chunks (int): The number of chunks.
+
+    Returns:
+        chunk_files (list): The files of each chunk, in volume order; empty if the
+            series has fewer than chunks * MIN_CHUNK_VOLUMES volumes, or the volume
+            of each file is not identified.
+
+    """
+    for attribute in VOLUME_ATTRIBUTES:
+        volume_files = {}
+        for file in files:
+            try:
+                dicom_header = pydicom.dcmread(
+                    file, stop_before_pixels=True, specific_tags=[attribute]
+                )
+                volume = int(dicom_header.get(attribute))
+            except (InvalidDicomError, TypeError, ValueError):
+                volume_files = {}
+                break
+            volume_files.setdefault(volume, []).append(file)
+
+        if len(volume_files) >= chunks * MIN_CHUNK_VOLUMES:
+            break
+    else:
+        return []
+
+    volumes = sorted(volume_files)
+    size = -(-len(volumes) // chunks)
+    return [
+        [
+            file
+            for volume in volumes[start : start + size]
+            for file in volume_files[volume]
+        ]
+        for start in range(0, len(volumes), size)
+    ]
+
+
+def convert_chunks(
+    dcm2niix_input_dir, series_uid, info, chunk_files, chunking_dir, dcm2niix_args
+):
+    """Convert the chunks of a series in parallel and concatenate the outputs.
+
+    Args:
+        dcm2niix_input_dir (str): The absolute path to the input directory to dcm2niix.
+        series_uid (str): The SeriesInstanceUID of the series.
+        info (dict): The series, from incremental.fingerprint_series.
+        chunk_files (list): The files of each chunk, from split_volumes.
+        chunking_dir (str): The absolute path to a scratch directory.
+        dcm2niix_args (dict): The gear args of the dcm2niix stage.
+
+    Returns:
+        outputs (dict): The concatenated dcm2niix output files of the series, by
+            field; None if the outputs of the chunks cannot be concatenated.
+
+    """
+    span_names = profiling.open_spans()
+
+    def convert_chunk(index):
+        profiling.attach(span_names)
+        with profiling.span("dcm2niix", chunk=index, files=len(chunk_files[index])):
+            return incremental.convert_series(
+                dcm2niix_input_dir,
+                {series_uid: {**info, "files": chunk_files[index]}},
+                os.path.join(chunking_dir, str(index)),
+                dcm2niix_args,
+            )
+
+    # Chunks are smaller than the series, so more run at a time than whole series
+    _, max_workers = planner.temporal_chunks(len(chunk_files))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        chunk_outputs = list(executor.map(convert_chunk, range(len(chunk_files))))
+
+    if any(outputs is None for outputs in chunk_outputs):
+        return None
+    chunk_outputs = [outputs[series_uid] for outputs in chunk_outputs]
+
+    # Each chunk must have one NIfTI and sidecar, and the same bval and bvec files
+    fields = [
+        [len(outputs[field]) for field in conversion_cache.OUTPUT_FIELDS]
+        for outputs in chunk_outputs
+    ]
+    if fields[0][:2] != [1, 1] or any(counts != fields[0] for counts in fields):
+        log.info(f"Series {series_uid} has more than one output. Converting whole.")
+        return None
+
+    output_dir = os.path.join(chunking_dir, "output")
+    os.makedirs(output_dir)
+    with profiling.span("concatenation", chunks=len(chunk_files)):
+        outputs = {}
+        for field in conversion_cache.OUTPUT_FIELDS:
+            outputs[field] = []
+            for files in zip(*[chunk[field] for chunk in chunk_outputs]):
+                target = os.path.join(output_dir, os.path.basename(files[0]))
+                if field == "converted_files":
+                    if not concatenate_niftis(
+                        files, target, dcm2niix_args["compression_level"]
+                    ):
+                        log.info(f"Unable to concatenate chunks of {series_uid}.")
+                        return None
+                elif field == "bids":
+                    merge_sidecars(
+                        files,
+                        [chunk["converted_files"][0] for chunk in chunk_outputs],
+                        target,
+                    )
+                else:
+                    concatenate_columns(files, target)
+                outputs[field].append(target)
+
+    return outputs
+
+
+def concatenate_niftis(nifti_files, target, compression_level=6):
+    """Concatenate 4D NIfTIs along time, streaming the image data of each NIfTI.
+
+        The NIfTIs must have the same voxel grid, orientation, datatype and scaling.
+        The header and extensions of the first NIfTI are written with the total
+        number of volumes, followed by the image data of each NIfTI in order, as
+        NIfTI image data is stored with time as the slowest varying axis.
+
+    Args:
+        nifti_files (list): The absolute paths to the NIfTIs to concatenate.
+        target (str): The absolute path to the concatenated NIfTI.
+        compression_level (int): The gzip compression level, if target ends in .gz.
+
+    Returns:
+        concatenated (bool): True if the NIfTIs were concatenated.
+
+    """
+
+    def open_file(file, mode):
+        if file.endswith(".gz"):
+            return gzip.open(file, mode, compresslevel=compression_level)
+        return open(file, mode)
+
+    # Read the headers as stored, as nibabel resets the offset and scaling on load
+    headers = []
+    for file in nifti_files:
+        with open_file(file, "rb") as nifti_file:
+            headers.append(nb.Nifti1Header.from_fileobj(nifti_file))
+    first = headers[0]
+    for header in headers:
+        if (
+            header["dim"][0] not in [3, 4]
+            or list(header["dim"][1:4]) != list(first["dim"][1:4])
+            or not np.allclose(header["pixdim"][1:5], first["pixdim"][1:5])
+            or any(
+                header[field].tobytes() != first[field].tobytes()
+                for field in HEADER_FIELDS
+            )
+        ):
+            return False
+
+    volumes = sum(max(int(header["dim"][4]), 1) for header in headers)
+    header = first.copy()
+    header.set_data_shape(tuple(first.get_data_shape()[:3]) + (volumes,))
+
+    with open_file(target, "wb") as target_file:
+        with open_file(nifti_files[0], "rb") as first_file:
+            target_file.write(header.binaryblock)
+            first_file.seek(len(header.binaryblock))
+            target_file.write(
+                first_file.read(int(first["vox_offset"]) - len(header.binaryblock))
+            )
+
+        for file, file_header in zip(nifti_files, headers):
+            with open_file(file, "rb") as source_file:
+                source_file.seek(int(file_header["vox_offset"]))
+                shutil.copyfileobj(source_file, target_file, 16 * 1024**2)
+
+    return True
+
+
+def merge_sidecars(sidecar_files, nifti_files, target):
+    """Write the sidecar of the first chunk, with the per-volume lists concatenated.
+
+        The other fields of dcm2niix sidecars are the same for each chunk, or, as
+        AcquisitionTime, are those of the first volume of the series.
+
+    Args:
+        sidecar_files (list): The absolute paths to the sidecars of the chunks.
+        nifti_files (list): The absolute paths to the NIfTIs of the chunks.
+        target (str): The absolute path to the merged sidecar.
+
+    """
+    sidecars = []
+    for file in sidecar_files:
+        with open(file) as sidecar_file:
+            sidecars.append(json.load(sidecar_file))
+    shapes = [nb.load(file).shape for file in nifti_files]
+    volumes = [shape[3] if len(shape) > 3 else 1 for shape in shapes]
+
+    merged = sidecars[0]
+    merged_fields = []
+    for field in VOLUME_FIELDS:
+        values = [sidecar.get(field) for sidecar in sidecars]
+        if all(
+            isinstance(value, list) and len(value) == count
+            for value, count in zip(values, volumes)
+        ):
+            merged[field] = [item for value in values for item in value]
+            merged_fields.append(field)
+
+    # Without per-volume lists, the sidecar is kept as dcm2niix wrote it
+    if not merged_fields:
+        shutil.copy2(sidecar_files[0], target)
+        return
+
+    with open(target, "w") as target_file:
+        json.dump(merged, target_file, indent="\t")
+
+
+def concatenate_columns(files, target):
+    """Concatenate the columns of bval or bvec files, keeping the separator."""
+    rows = None
+    separator = " "
+    for file in files:
+        with open(file) as column_file:
+            lines = column_file.read().splitlines()
+        if "\t" in lines[0]:
+            separator = "\t"
+        values = [line.split() for line in lines if line.strip()]
+        rows = values if rows is None else [row + new for row, new in zip(rows, values)]
+
+    with open(target, "w") as target_file:
+        target_file.write("".join(separator.join(row) + "\n" for row in rows))
@@ -0,0 +1,204 @@
+"""Functions to cache dcm2niix conversions across jobs, keyed by input and config."""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from types import SimpleNamespace
+
+from dcm2niix_gear.dcm2niix.interfaces import Dcm2niixEnhanced
+from dcm2niix_gear.utils import cache
+
+
+log = logging.getLogger(__name__)
+
+NAMESPACE = "conversion"
+INDEX_FILENAME = "index.json"
+
+# The dcm2niix outputs captured from the nipype interface
+OUTPUT_FIELDS = ["converted_files", "bids", "bvals", "bvecs"]
+
+
+def cache_key(prepare_args, dcm2niix_args, dcm2niix_version):
+    """Return the cache key of a conversion.
+
+        The key is the hash of the input file (and REC file of a PAR/REC pair), its
+        filename, as dcm2niix filenames can contain it, the options of the prepare
+        stage that change the dcm2niix input, the normalized dcm2niix arguments and the
+        dcm2niix version.
+
+    Args:
+        prepare_args (dict): The gear args of the prepare stage.
+        dcm2niix_args (dict): The gear args of the dcm2niix stage.
+        dcm2niix_version (str): The dcm2niix version.
+
+    Returns:
+        key (str): The cache key.
+
+    """
+    inputs = []
+    for infile in [prepare_args["infile"], prepare_args.get("rec_infile")]:
+        if infile:
+            inputs.append([os.path.basename(infile), cache.file_hash(str(infile))])
+
+    key_info = {
+        "inputs": inputs,
+        **conversion_options(prepare_args, dcm2niix_args, dcm2niix_version),
+    }
+
+    return hashlib.sha256(json.dumps(key_info, sort_keys=True).encode()).hexdigest()
+
+
+def conversion_options(prepare_args, dcm2niix_args, dcm2niix_version):
+    """Return the options that change the dcm2niix outputs of an input, normalized.
+
+    Args:
+        prepare_args (dict): The gear args of the prepare stage.
+        dcm2niix_args (dict): The gear args of the dcm2niix stage.
+        dcm2niix_version (str): The dcm2niix version.
+
+    Returns:
+        options (dict): The JSON serializable conversion options.
+
+    """
+    dcm2niix_args = {name: str(value) for name, value in dcm2niix_args.items()}
+
+    # Uncompressed 3D volumes are always named by protocol and series number
+    if dcm2niix_args["compress_images"] == "3":
+        dcm2niix_args["filename"] = "%p_%s"
+
+    options = {
+        "remove_incomplete_volumes": bool(prepare_args["remove_incomplete_volumes"]),
+        "decompress_dicoms": bool(prepare_args["decompress_dicoms"]),
+        "dcm2niix": dcm2niix_args,
+        "dcm2niix_version": str(dcm2niix_version),
+    }
+
+    # Only set if enabled, so that the keys of existing cache entries are unchanged
+    if prepare_args.get("remove_duplicate_dicoms"):
+        options["remove_duplicate_dicoms"] = True
+
+    return options
+
+
+def dcm2niix_version():
+    """Return the version of the installed dcm2niix."""
+    return Dcm2niixEnhanced().version
+
+
+def restore(key, work_dir, cache_dir=None, copy_files=False, namespace=NAMESPACE):
+    """Restore the dcm2niix outputs of a cached conversion into work_dir.
+
+        Files are restored as hardlinks to the cache entry, unless copy_files is set
+        (e.g., because coil combination or PyDeface modify the NIfTI files in place)
+        or the cache is on another filesystem.
+
+    Args:
+        key (str): The cache key of the conversion.
+        work_dir (str): The absolute path to the output directory of dcm2niix.
+        cache_dir (str): The absolute path to the cache directory.
+        copy_files (bool): If true, copy files instead of hardlinking them.
+        namespace (str): The cache subdirectory of the entry.
+
+    Returns:
+        output (types.SimpleNamespace): The dcm2niix outputs, with the fields of the
+            nipype interface result used by the gear; None if not cached.
+        dicom_index (dict): The DICOM header index of the input, for metadata capture;
+            None if not cached.
+
+    """
+    # Pinned while restored; the restored hardlinks or copies outlive the entry
+    with cache.pinned(cache_dir, namespace, key) as entry:
+        if entry is None:
+            log.info(f"Conversion cache miss for {key}.")
+            return None, None
+
+        log.info(f"Conversion cache hit for {key}. Restoring dcm2niix outputs.")
+        with open(os.path.join(entry, INDEX_FILENAME)) as index_file:
+            index = json.load(index_file)
+
+        outputs = {}
+        for field in OUTPUT_FIELDS:
+            outputs[field] = []
+            for name in index[field]:
+                file = os.path.join(str(work_dir), name)
+                link_or_copy(os.path.join(entry, "files", name), file, copy_files)
+                outputs[field].append(file)
+
+    return SimpleNamespace(outputs=SimpleNamespace(**outputs)), index["dicom_index"]
+
+
+def store(
+    key,
+    output,
+    dicom_index,
+    cache_dir=None,
+    cache_max_size=None,
+    copy_files=False,
+    namespace=NAMESPACE,
+):
+    """Store the dcm2niix outputs of a conversion in the cache.
+
+    Args:
+        key (str): The cache key of the conversion.
+        output (nipype.interfaces.base.support.InterfaceResult): The dcm2niix output
+            results.
+        dicom_index (dict): The DICOM header index of the input.
+        cache_dir (str): The absolute path to the cache directory.
+        cache_max_size (int): The maximum cache size in bytes.
+        copy_files (bool): If true, copy files instead of hardlinking them, as they are
+            modified in place after the conversion.
+        namespace (str): The cache subdirectory of the entry.
+
+    Returns:
+        None
+
+    """
+    outputs = output_files(output)
+    if outputs is None:
+        log.info("No dcm2niix outputs to cache.")
+        return
+    index = {"dicom_index": dicom_index, **outputs}
+
+    def create(entry):
+        os.mkdir(os.path.join(entry, "files"))
+        for field in OUTPUT_FIELDS:
+            for file in index[field]:
+                link_or_copy(
+                    file,
+                    os.path.join(entry, "files", os.path.basename(file)),
+                    copy_files,
+                )
+            index[field] = [os.path.basename(file) for file in index[field]]
+        with open(os.path.join(entry, INDEX_FILENAME), "w") as index_file:
+            json.dump(index, index_file)
+
+    cache.get_or_create(cache_dir, namespace, key, create, max_size=cache_max_size)
+
+
+def output_files(output):
+    """Return the dcm2niix output files of each field, as lists; None if no outputs."""
+    outputs = {}
+    try:
+        for field in OUTPUT_FIELDS:
+            files = getattr(output.outputs, field)
+            if isinstance(files, str):
+                files = [files]
+            outputs[field] = list(files) if isinstance(files, list) else []
+    except AttributeError:
+        return None
+
+    return outputs
+
+
+def link_or_copy(source, target, copy_file=False):
+    """Hardlink source to target, or copy it if copy_file is set or linking fails."""
+    if not copy_file:
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            log.debug(f"Unable to hardlink {source}. Copying.")
+
+    shutil.copy2(source, target)
@@ -3,6 +3,9 @@
 import logging
 import os
 from distutils import util
+from types import SimpleNamespace
+
+from dcm2niix_gear.utils import processes
 
 # from nipype.interfaces.dcm2nii import Dcm2niix
 from .interfaces import Dcm2niixEnhanced
@@ -86,7 +89,9 @@ def convert_directory(
 
         # dcm2niix command configurations for: anonymize_bids, bids_sidecar
         if bids_sidecar == "o":
+            log.info("Only the BIDS sidecar file will be generated, without images.")
             converter.inputs.bids_format = True
+            converter.inputs.bids_only = True
             converter.inputs.anon_bids = anonymize_bids
         elif bool(util.strtobool(bids_sidecar)):
             converter.inputs.bids_format = True
@@ -173,7 +178,7 @@ def convert_directory(
 
         # Log the dcm2niix command configuration and run
         log.info(f"Command to be executed: \n\n{converter.cmdline}\n")
-        output = converter.run()
+        output = run_converter(converter)
 
         log.info(f"Output from dcm2niix: \n\n{output.runtime.stdout }\n")
 
@@ -201,3 +206,29 @@ def convert_directory(
             )
 
     return output
+
+
+def run_converter(converter):
+    """Run dcm2niix and collect its outputs, as the nipype interface run does.
+
+        dcm2niix is run through processes.run_interface rather than by nipype, so
+        that its resource usage is accounted to its own process when dcm2niix runs
+        in parallel, e.g., for temporal chunks. Its outputs are then parsed from its
+        stdout and aggregated by the interface.
+
+    Args:
+        converter (Dcm2niixEnhanced): The interface, with its inputs set.
+
+    Returns:
+        output (types.SimpleNamespace): The 'outputs' aggregated by the interface and
+            the 'runtime', with the stdout and returncode of dcm2niix.
+
+    """
+    # dcm2niix may exit with status 1 despite converting
+    process = processes.run_interface(converter, tool="dcm2niix", success_codes=(0, 1))
+    converter._parse_files(converter._parse_stdout(process.stdout))
+
+    return SimpleNamespace(
+        outputs=converter.aggregate_outputs(),
+        runtime=SimpleNamespace(stdout=process.stdout, returncode=process.returncode),
+    )
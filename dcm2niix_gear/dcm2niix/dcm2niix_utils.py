@@ -4,10 +4,14 @@ import glob
 import logging
 import os
 import shutil
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 import nibabel as nb
 
+from dcm2niix_gear.utils import planner
+from dcm2niix_gear.utils import profiling
+from dcm2niix_gear.utils import processes
+
 
 log = logging.getLogger(__name__)
 
@@ -30,19 +34,11 @@ def remove_incomplete_volumes(dcm2niix_input_dir):
     command = ["python3", script, dcm2niix_input_dir]
     log.info(f"Command to be executed: {' '.join(command)}")
 
-    process = subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        universal_newlines=True,
-    )
+    process = processes.run(command, tool="fix_dcm_vols")
 
-    with process.stdout:
-        log.info(
-            "Output from incomplete volume correction:" f"\n\n{process.stdout.read()}\n"
-        )
+    log.info(f"Output from incomplete volume correction:\n\n{process.stdout}\n")
 
-    if process.wait() != 0:
+    if process.returncode != 0:
         log.error("Incomplete volume removal script failed. Exiting.")
         os.sys.exit(1)
     else:
@@ -96,7 +92,7 @@ def remove_incomplete_volumes(dcm2niix_input_dir):
         )
 
 
-def decompress_dicoms(dcm2niix_input_dir):
+def decompress_dicoms(dcm2niix_input_dir, workers=None):
     """Implement decompression of dicom files.
 
            For some types of dicom files, compression can be applied to the image data
@@ -107,6 +103,8 @@ def decompress_dicoms(dcm2niix_input_dir):
 
     Args:
         dcm2niix_input_dir (str): The absolute path to a set of dicoms.
+        workers (int): The number of gdcmconv processes run at a time; from the
+            resource plan, if not set.
 
     Returns:
         None; decompresses dicoms in dc2miix_input_dir.
@@ -118,26 +116,23 @@ def decompress_dicoms(dcm2niix_input_dir):
         f"Running decompression of dicom files. {n_dicom_files} dicom files found."
     )
 
-    for file in dicom_files:
+    workers = workers or planner.workers("decompression")
 
+    def decompress(file):
         # Decompress with gcdmconv in place (overwriting the compressed dicom)
         command = ["gdcmconv", "--raw", file, file]
+        return processes.run(command, tool="gdcmconv")
 
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-        )
-
-        if process.wait() != 0:
-            log.info("Output from gdcmconv ...")
+    with profiling.span("decompression", files=n_dicom_files, workers=workers):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for process in executor.map(decompress, dicom_files):
 
-            with process.stdout:
-                log.info("\n\n" + process.stdout.read())
+                if process.returncode != 0:
+                    log.info("Output from gdcmconv ...")
+                    log.info("\n\n" + process.stdout)
 
-            log.error("Error decompressing dicom file using gdcmconv. Exiting.")
-            os.sys.exit(1)
+                    log.error("Error decompressing dicom file using gdcmconv. Exiting.")
+                    os.sys.exit(1)
 
     log.info("Success. Completed decompression of dicom files.")
 
@@ -145,6 +140,9 @@ def decompress_dicoms(dcm2niix_input_dir):
 def coil_combine(nifti_files):
     """Implement the coil combined method.
 
+        Only the last volume of each nifti file is read, and as many files are
+        combined at a time as the resource plan fits.
+
     Args:
         nifti_files (list): A set of absolute paths to nifti files to
             generate coil combined data for.
@@ -160,22 +158,27 @@ def coil_combine(nifti_files):
         "Continuing."
     )
 
-    for nifti_file in nifti_files:
+    workers = min(len(nifti_files), planner.workers("coil_combine")) or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(coil_combine_file, nifti_files))
 
-        try:
 
-            log.info(f"Start implementing coil combined method for {nifti_file}")
-            n1 = nb.load(nifti_file)
-            d1 = n1.get_data()
-            d2 = d1[..., -1]
-            n2 = nb.Nifti1Image(d2, n1.get_affine(), header=n1.get_header())
-            nb.save(n2, nifti_file)
-            log.info(f"Generated coil combined data for {nifti_file}")
+def coil_combine_file(nifti_file):
+    """Replace a nifti file with its last volume, the coil combined data."""
+    try:
 
-        except Exception as e:
+        log.info(f"Start implementing coil combined method for {nifti_file}")
+        n1 = nb.load(nifti_file)
+        # Read the last volume alone; slicing the data on disk does not check bounds
+        if not n1.shape or not n1.shape[-1]:
+            raise IndexError(f"{nifti_file} has no data.")
+        d2 = n1.dataobj[..., -1]
+        n2 = nb.Nifti1Image(d2, n1.affine, header=n1.header)
+        nb.save(n2, nifti_file)
+        log.info(f"Generated coil combined data for {nifti_file}")
 
-            log.error(
-                f"Could not generate coil combined data for {nifti_file}. Exiting."
-            )
-            log.exception(e)
-            os.sys.exit(1)
+    except Exception as e:
+
+        log.error(f"Could not generate coil combined data for {nifti_file}. Exiting.")
+        log.exception(e)
+        os.sys.exit(1)
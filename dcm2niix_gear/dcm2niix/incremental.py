@@ -0,0 +1,374 @@
+"""Functions to convert only the new or changed series of a session."""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from types import SimpleNamespace
+
+import pydicom
+from pydicom.filereader import InvalidDicomError
+
+from dcm2niix_gear.dcm2niix import conversion_cache
+from dcm2niix_gear.dcm2niix import dcm2niix_run
+from dcm2niix_gear.utils import cache
+
+
+log = logging.getLogger(__name__)
+
+NAMESPACE = "series"
+INCREMENTAL_DIR = ".incremental"
+
+# Extensions of the dcm2niix outputs, to match each output to its sidecar
+OUTPUT_EXTENSIONS = [
+    ".nii.gz",
+    ".nii",
+    ".nrrd",
+    ".nhdr",
+    ".raw.gz",
+    ".raw",
+    ".bval",
+    ".bvec",
+]
+
+
+def convert(
+    dcm2niix_input_dir,
+    work_dir,
+    prepare_args,
+    dcm2niix_args,
+    cache_dir,
+    cache_max_size=None,
+    copy_files=False,
+):
+    """Convert the new or changed series of a session, reusing the other series.
+
+        Each DICOM series is fingerprinted by its SeriesInstanceUID and the hash of its
+        SOPInstanceUIDs. The dcm2niix outputs of each series are cached under a key of
+        the fingerprint and the conversion options, which serves as the manifest of the
+        series converted by previous runs. The series without a cache entry are
+        converted together in one dcm2niix run, and the outputs of every series are
+        restored from the cache into work_dir.
+
+    Args:
+        dcm2niix_input_dir (str): The absolute path to the input directory to dcm2niix.
+        work_dir (str): The absolute path to the output directory of dcm2niix.
+        prepare_args (dict): The gear args of the prepare stage.
+        dcm2niix_args (dict): The gear args of the dcm2niix stage.
+        cache_dir (str): The absolute path to the cache directory.
+        cache_max_size (int): The maximum cache size in bytes.
+        copy_files (bool): If true, copy files instead of hardlinking them.
+
+    Returns:
+        output (types.SimpleNamespace): The dcm2niix outputs, with the fields of the
+            nipype interface result used by the gear; None if the session cannot be
+            converted incrementally and must be converted as a whole.
+
+    """
+    series = separable_series(dcm2niix_input_dir, dcm2niix_args)
+    if series is None:
+        return None
+
+    options = conversion_cache.conversion_options(
+        prepare_args, dcm2niix_args, conversion_cache.dcm2niix_version()
+    )
+    options["folder"] = os.path.basename(dcm2niix_input_dir)
+    keys = {
+        series_uid: series_key(series_uid, info["fingerprint"], options)
+        for series_uid, info in series.items()
+    }
+
+    new_series = [
+        series_uid
+        for series_uid in series
+        if cache.get_entry(cache_dir, NAMESPACE, keys[series_uid]) is None
+    ]
+    log.info(
+        f"{len(series) - len(new_series)} of {len(series)} series unchanged. "
+        f"Converting {len(new_series)} new or changed series."
+    )
+
+    incremental_dir = os.path.join(str(work_dir), INCREMENTAL_DIR)
+    try:
+        if new_series:
+            series_outputs = convert_series(
+                dcm2niix_input_dir,
+                {series_uid: series[series_uid] for series_uid in new_series},
+                incremental_dir,
+                dcm2niix_args,
+            )
+            if series_outputs is None:
+                return None
+
+            # Evicted once all series are stored, so no series of the session is
+            # evicted by storing another
+            for series_uid, outputs in series_outputs.items():
+                conversion_cache.store(
+                    keys[series_uid],
+                    SimpleNamespace(outputs=SimpleNamespace(**outputs)),
+                    None,
+                    cache_dir=cache_dir,
+                    copy_files=copy_files,
+                    namespace=NAMESPACE,
+                )
+
+        output = restore_series(keys.values(), work_dir, cache_dir, copy_files)
+
+        if cache_max_size:
+            cache.evict(
+                cache_dir,
+                cache_max_size,
+                keep=[os.path.join(cache_dir, NAMESPACE, key) for key in keys.values()],
+            )
+
+        return output
+
+    finally:
+        shutil.rmtree(incremental_dir, ignore_errors=True)
+
+
+def separable_series(dcm2niix_input_dir, dcm2niix_args):
+    """Return the series of the input if they can be converted separately, or None.
+
+    Args:
+        dcm2niix_input_dir (str): The absolute path to the input directory to dcm2niix.
+        dcm2niix_args (dict): The gear args of the dcm2niix stage.
+
+    Returns:
+        series (dict): The series of the input, from fingerprint_series, in order of
+            series number; None if the input must be converted as a whole.
+
+    """
+    if not applicable(dcm2niix_args):
+        return None
+
+    series = fingerprint_series(dcm2niix_input_dir)
+    series_numbers = [info["series_number"] for info in series.values()]
+    if not series or len(set(series_numbers)) < len(series_numbers):
+        log.info(
+            "No DICOM series with unique series numbers found. "
+            "Converting the session as a whole."
+        )
+        return None
+
+    def order(series_uid):
+        series_number = series[series_uid]["series_number"]
+        return (
+            (0, int(series_number), "")
+            if series_number.isdigit()
+            else (1, 0, series_number)
+        )
+
+    return {series_uid: series[series_uid] for series_uid in sorted(series, key=order)}
+
+
+def applicable(dcm2niix_args):
+    """Return true if the outputs of each series are independent of other series."""
+    filename = dcm2niix_args["filename"]
+    if dcm2niix_args["compress_images"] == "3":
+        filename = "%p_%s"
+
+    if dcm2niix_args["merge2d"]:
+        log.info("Series are merged with merge2d. Not converting series separately.")
+        return False
+
+    if "%s" not in filename:
+        log.info(
+            "The filename does not contain the series number (%s). "
+            "Not converting series separately."
+        )
+        return False
+
+    return True
+
+
+def fingerprint_series(dcm2niix_input_dir, files=None):
+    """Return the files, series number and fingerprint of each DICOM series.
+
+    Args:
+        dcm2niix_input_dir (str): The absolute path to the input directory to dcm2niix.
+        files (list): If set, the absolute paths to the files to fingerprint instead
+            of every file in dcm2niix_input_dir.
+
+    Returns:
+        series (dict): The files, series number and fingerprint, the hash of the
+            sorted SOPInstanceUIDs, of each series, by SeriesInstanceUID.
+
+    """
+    series = {}
+
+    if files is None:
+        files = Path(dcm2niix_input_dir).rglob("*")
+
+    for dicom in sorted(Path(file) for file in files):
+        if dicom.is_dir():
+            continue
+
+        try:
+            dicom_header = pydicom.dcmread(
+                str(dicom),
+                stop_before_pixels=True,
+                specific_tags=["SeriesInstanceUID", "SOPInstanceUID", "SeriesNumber"],
+            )
+            series_uid = str(dicom_header.SeriesInstanceUID)
+            sop_uid = str(dicom_header.SOPInstanceUID)
+            series_number = str(dicom_header.get("SeriesNumber", ""))
+        except (InvalidDicomError, AttributeError):
+            continue
+
+        info = series.setdefault(
+            series_uid, {"files": [], "sop_uids": [], "series_number": series_number}
+        )
+        info["files"].append(str(dicom))
+        info["sop_uids"].append(sop_uid)
+
+    for info in series.values():
+        info["fingerprint"] = hashlib.sha256(
+            "\n".join(sorted(info.pop("sop_uids"))).encode()
+        ).hexdigest()
+
+    return series
+
+
+def series_key(series_uid, fingerprint, options):
+    """Return the cache key of the dcm2niix outputs of a series."""
+    key_info = {"series": series_uid, "fingerprint": fingerprint, **options}
+    return hashlib.sha256(json.dumps(key_info, sort_keys=True).encode()).hexdigest()
+
+
+def convert_series(
+    dcm2niix_input_dir,
+    series,
+    incremental_dir,
+    dcm2niix_args,
+    folder=None,
+    flatten=False,
+):
+    """Convert a subset of series in one dcm2niix run and split the outputs by series.
+
+        The DICOMs of the series are linked into a directory of the same name as the
+        input directory, so filenames with the folder name (%f) are unchanged.
+
+    Args:
+        dcm2niix_input_dir (str): The absolute path to the input directory to dcm2niix.
+        series (dict): The series to convert, from fingerprint_series.
+        incremental_dir (str): The absolute path to a scratch directory.
+        dcm2niix_args (dict): The gear args of the dcm2niix stage.
+        folder (str): If set, the name of the staged input directory, instead of the
+            name of dcm2niix_input_dir.
+        flatten (bool): If true, link the DICOMs into the staged input directory by
+            filename, instead of by their path relative to dcm2niix_input_dir.
+
+    Returns:
+        series_outputs (dict): The dcm2niix output files of each series, by field;
+            None if an output cannot be matched to a series.
+
+    """
+    stage_dir = os.path.join(
+        incremental_dir, folder or os.path.basename(dcm2niix_input_dir)
+    )
+    output_dir = os.path.join(incremental_dir, "output")
+    os.makedirs(stage_dir)
+    os.makedirs(output_dir)
+
+    for info in series.values():
+        for file in info["files"]:
+            if flatten:
+                target = os.path.join(stage_dir, os.path.basename(file))
+            else:
+                target = os.path.join(
+                    stage_dir, os.path.relpath(file, dcm2niix_input_dir)
+                )
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            conversion_cache.link_or_copy(file, target)
+
+    output = dcm2niix_run.convert_directory(stage_dir, output_dir, **dcm2niix_args)
+
+    outputs = {}
+    for field in conversion_cache.OUTPUT_FIELDS:
+        files = getattr(output.outputs, field, [])
+        if isinstance(files, str):
+            files = [files]
+        outputs[field] = files if isinstance(files, list) else []
+
+    # Each output is matched to its sidecar, and the sidecar to the series
+    series_by_number = {info["series_number"]: uid for uid, info in series.items()}
+    series_by_stem = {}
+    for sidecar in outputs["bids"]:
+        with open(sidecar, encoding="utf-8") as sidecar_file:
+            series_number = str(
+                json.load(sidecar_file, strict=False).get("SeriesNumber")
+            )
+        if series_number not in series_by_number:
+            log.info(f"Unable to match {sidecar} to a series.")
+            return None
+        series_by_stem[output_stem(sidecar)] = series_by_number[series_number]
+
+    series_outputs = {
+        series_uid: {field: [] for field in conversion_cache.OUTPUT_FIELDS}
+        for series_uid in series
+    }
+    for field, files in outputs.items():
+        for file in files:
+            if output_stem(file) not in series_by_stem:
+                log.info(f"Unable to match {file} to a series.")
+                return None
+            series_outputs[series_by_stem[output_stem(file)]][field].append(file)
+
+    return series_outputs
+
+
+def output_stem(file):
+    """Return the filename of a dcm2niix output without its extension."""
+    name = os.path.basename(file)
+    for extension in OUTPUT_EXTENSIONS + [".json"]:
+        if name.endswith(extension):
+            return name[: -len(extension)]
+    return name
+
+
+def restore_series(keys, work_dir, cache_dir, copy_files=False):
+    """Restore the dcm2niix outputs of each series into work_dir, combined.
+
+        If the outputs of a series were evicted from the cache (e.g., by a
+        concurrent job), the outputs already restored are removed and None is
+        returned, so that the session is converted as a whole.
+
+    Args:
+        keys (list): The cache keys of the series.
+        work_dir (str): The absolute path to the output directory of dcm2niix.
+        cache_dir (str): The absolute path to the cache directory.
+        copy_files (bool): If true, copy files instead of hardlinking them.
+
+    Returns:
+        output (types.SimpleNamespace): The dcm2niix outputs of all series; None if
+            the outputs of a series are no longer cached.
+
+    """
+    outputs = {field: [] for field in conversion_cache.OUTPUT_FIELDS}
+
+    for key in keys:
+        restored, _ = conversion_cache.restore(
+            key,
+            work_dir,
+            cache_dir=cache_dir,
+            copy_files=copy_files,
+            namespace=NAMESPACE,
+        )
+        if restored is None:
+            log.warning(
+                f"Series outputs {key} were removed from the cache. "
+                "Converting the session as a whole."
+            )
+            for files in outputs.values():
+                for file in files:
+                    if os.path.exists(file):
+                        os.remove(file)
+            return None
+
+        for field in conversion_cache.OUTPUT_FIELDS:
+            outputs[field].extend(getattr(restored.outputs, field))
+
+    return SimpleNamespace(outputs=SimpleNamespace(**outputs))
@@ -1,13 +1,30 @@
 """The interfaces module
 Temporary resolution to fix bug with dcm2niix not escaping metacharacters in filename.
 """
-from nipype.interfaces.dcm2nii import Dcm2niix
+from nipype.interfaces.base import traits
+from nipype.interfaces.dcm2nii import Dcm2niix, Dcm2niixInputSpec
 import re
 import glob
 import os
 
+
+class Dcm2niixEnhancedInputSpec(Dcm2niixInputSpec):
+    bids_only = traits.Bool(
+        False,
+        usedefault=True,
+        desc="Create only the BIDS sidecar, without converting images (-b o)",
+    )
+
+
 class Dcm2niixEnhanced(Dcm2niix):
-    
+    input_spec = Dcm2niixEnhancedInputSpec
+
+    def _format_arg(self, opt, spec, val):
+        # nipype formats bids_format as a boolean, without the sidecar only option
+        if opt == "bids_format" and val and self.inputs.bids_only:
+            return "-b o"
+        return super()._format_arg(opt, spec, val)
+
     def _parse_stdout(self, stdout):
         filenames = []
         for line in stdout.split("\n"):
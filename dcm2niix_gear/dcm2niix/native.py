@@ -0,0 +1,481 @@
+"""Functions to convert a simple DICOM series in-process, reading from the archive."""
+
+import gzip
+import io
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import traceback
+import zipfile
+from types import SimpleNamespace
+
+import nibabel as nb
+import numpy as np
+import pydicom
+from pydicom.filereader import InvalidDicomError
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+from dcm2niix_gear.dcm2niix import arrange
+from dcm2niix_gear.utils import metadata
+from dcm2niix_gear.utils import planner
+from dcm2niix_gear.utils import profiling
+
+
+log = logging.getLogger(__name__)
+
+# Uncompressed transfer syntaxes whose pixel data is read as stored
+TRANSFER_SYNTAXES = [ExplicitVRLittleEndian, ImplicitVRLittleEndian]
+
+MODALITIES = ["CT", "MR"]
+
+# Vendors whose images dcm2niix scales or arranges with private tags
+VENDOR_HANDLING = ["philips", "siemens"]
+
+# The smallest z component of the slice normal of a series converted natively; other
+# series are converted by dcm2niix
+AXIAL_NORMAL = 0.9
+
+# Attributes that must be the same for every slice of the series
+SLICE_ATTRIBUTES = [
+    "SeriesInstanceUID",
+    "Rows",
+    "Columns",
+    "BitsAllocated",
+    "BitsStored",
+    "PixelRepresentation",
+    "PixelSpacing",
+    "ImageOrientationPatient",
+    "RescaleSlope",
+    "RescaleIntercept",
+    "EchoNumbers",
+]
+
+# Filename fields, as the dcm2niix filename template, from the DICOM header
+FILENAME_FIELDS = {
+    "d": "SeriesDescription",
+    "m": "Manufacturer",
+    "p": "ProtocolName",
+    "s": "SeriesNumber",
+}
+
+# Sidecar fields, as dcm2niix names them, with the DICOM attribute and scale factor
+SIDECAR_FIELDS = [
+    ("Modality", "Modality", None),
+    ("MagneticFieldStrength", "MagneticFieldStrength", None),
+    ("Manufacturer", "Manufacturer", None),
+    ("ManufacturersModelName", "ManufacturerModelName", None),
+    ("BodyPartExamined", "BodyPartExamined", None),
+    ("PatientPosition", "PatientPosition", None),
+    ("SeriesDescription", "SeriesDescription", None),
+    ("ProtocolName", "ProtocolName", None),
+    ("ScanningSequence", "ScanningSequence", None),
+    ("SequenceVariant", "SequenceVariant", None),
+    ("ImageType", "ImageType", None),
+    ("SeriesNumber", "SeriesNumber", None),
+    ("AcquisitionNumber", "AcquisitionNumber", None),
+    ("SliceThickness", "SliceThickness", None),
+    ("SpacingBetweenSlices", "SpacingBetweenSlices", None),
+    ("EchoTime", "EchoTime", 0.001),
+    ("RepetitionTime", "RepetitionTime", 0.001),
+    ("InversionTime", "InversionTime", 0.001),
+    ("FlipAngle", "FlipAngle", None),
+    ("XRayExposure", "Exposure", None),
+    ("ConvolutionKernel", "ConvolutionKernel", None),
+]
+
+
+def convert_archive(prepare_args, work_dir, dcm2niix_args):
+    """Convert a zip archive of one simple DICOM series without extracting it.
+
+        The DICOM headers are read from the archive members, and the pixel data of
+        members stored uncompressed is memory-mapped from the archive. The slices are
+        sorted along the slice normal, checked to be evenly spaced, and copied into a
+        preallocated volume, with the rows flipped as dcm2niix, written as a NIfTI
+        with a sidecar of the fields dcm2niix writes. Series that are not axial, with
+        more than one volume, compressed or multi-frame pixel data, mosaics, vendor
+        specific scaling or filename fields other than %f, %d, %m, %p and %s are
+        converted by dcm2niix instead.
+
+    Args:
+        prepare_args (dict): The gear args of the prepare stage.
+        work_dir (str): The absolute path to the output directory of dcm2niix.
+        dcm2niix_args (dict): The gear args of the dcm2niix stage.
+
+    Returns:
+        output (types.SimpleNamespace): The outputs, with the fields of the nipype
+            interface result used by the gear; None if the input is converted by
+            dcm2niix.
+        dicom_index (dict): The DICOM header metadata of the series, as
+            metadata.build_dicom_index; None if the input is converted by dcm2niix.
+
+    """
+    if not applicable(prepare_args, dcm2niix_args):
+        return None, None
+
+    infile = prepare_args["infile"]
+
+    # Size the post-processing stages, as the input is not staged
+    with profiling.span("planning"):
+        planner.plan(infile)
+
+    with profiling.span("native"), open(infile, "rb") as archive_file:
+        mapped = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            output, dicom_index = convert_mapped(
+                infile, archive_file, mapped, work_dir, dcm2niix_args
+            )
+        except BaseException as exception:
+            # The pixel data must be released before the memory map is closed; on
+            # error, it is held by the frames of the traceback, and closing the map
+            # would raise a BufferError in place of the exception
+            traceback.clear_frames(exception.__traceback__)
+            raise
+        finally:
+            mapped.close()
+
+    return output, dicom_index
+
+
+def convert_mapped(infile, archive_file, mapped, work_dir, dcm2niix_args):
+    """Convert the memory-mapped zip archive, as convert_archive."""
+    with zipfile.ZipFile(archive_file) as zip_obj:
+        slices = read_slices(zip_obj, mapped)
+        folder = archive_folder(infile, zip_obj)
+    if not slices:
+        return None, None
+
+    headers = [dicom_slice["header"] for dicom_slice in slices]
+    geometry = slice_geometry(headers)
+    if geometry is None:
+        return None, None
+    order, affine = geometry
+
+    stem = output_filename(dcm2niix_args["filename"], folder, headers[0])
+    if stem is None:
+        log.info(
+            "Filename not supported by the native engine. Converting with dcm2niix."
+        )
+        return None, None
+    stem = os.path.join(str(work_dir), stem)
+
+    converted_files = []
+    if dcm2niix_args["bids_sidecar"] != "o":
+        extension = ".nii.gz" if dcm2niix_args["compress_images"] == "y" else ".nii"
+        write_nifti(
+            f"{stem}{extension}",
+            [slices[index] for index in order],
+            affine,
+            comment=dcm2niix_args["comment"],
+            compression_level=dcm2niix_args["compression_level"],
+        )
+        converted_files.append(f"{stem}{extension}")
+
+    with open(f"{stem}.json", "w") as sidecar_file:
+        json.dump(sidecar(headers[order[0]]), sidecar_file, indent=4)
+
+    series_key, dicom_data = metadata.dicom_index_entry(headers[order[0]])
+    log.info(f"Converted {len(slices)} DICOMs with the native engine.")
+
+    output = SimpleNamespace(
+        outputs=SimpleNamespace(
+            converted_files=converted_files,
+            bids=[f"{stem}.json"],
+            bvals=[],
+            bvecs=[],
+        )
+    )
+    return output, {series_key: dicom_data}
+
+
+def applicable(prepare_args, dcm2niix_args):
+    """Return true if the input and options may be converted by the native engine."""
+    if (
+        prepare_args["remove_incomplete_volumes"]
+        or prepare_args["decompress_dicoms"]
+        or prepare_args.get("remove_duplicate_dicoms")
+    ):
+        return False
+
+    if prepare_args["rec_infile"] or not zipfile.is_zipfile(prepare_args["infile"]):
+        log.info("Input is not a zip archive. Converting with dcm2niix.")
+        return False
+
+    if (
+        dcm2niix_args["output_nrrd"]
+        or dcm2niix_args["compress_images"] not in ["y", "n"]
+        or dcm2niix_args["convert_only_series"] != "all"
+        or dcm2niix_args["crop"]
+        or dcm2niix_args["ignore_derived"]
+        or dcm2niix_args["ignore_errors"]
+        or dcm2niix_args["lossless_scaling"] != "n"
+        or dcm2niix_args["single_file_mode"]
+    ):
+        log.info(
+            "Options not supported by the native engine. Converting with dcm2niix."
+        )
+        return False
+
+    return True
+
+
+def read_slices(zip_obj, mapped):
+    """Read the DICOM header of each archive member and locate its pixel data.
+
+    Args:
+        zip_obj (zipfile.ZipFile): The zip archive.
+        mapped (mmap.mmap): The zip archive, memory-mapped.
+
+    Returns:
+        slices (list): The 'header' and 'pixels' of each DICOM, the pixel data as a
+            numpy array of the stored values; None if a member is not a DICOM slice
+            of the simple series the native engine converts.
+
+    """
+    slices = []
+    for info in zip_obj.infolist():
+        # Files starting with a period are dropped when the input is arranged
+        if info.is_dir() or os.path.basename(info.filename).startswith("."):
+            continue
+
+        if info.flag_bits & 0x1:
+            return None
+
+        if info.compress_type == zipfile.ZIP_STORED:
+            source = mapped
+            dicom_file = zip_obj.open(info)
+            data_offset = member_data_offset(mapped, info)
+        else:
+            source = zip_obj.read(info)
+            dicom_file = io.BytesIO(source)
+            data_offset = 0
+
+        try:
+            with dicom_file:
+                header = pydicom.dcmread(dicom_file, stop_before_pixels=True)
+                pixel_offset = data_offset + dicom_file.tell()
+        except (InvalidDicomError, EOFError):
+            log.info(f"{info.filename} is not a DICOM. Converting with dcm2niix.")
+            return None
+
+        if not simple_slice(header):
+            return None
+
+        pixels = slice_pixels(header, source, pixel_offset)
+        if pixels is None:
+            return None
+        slices.append({"header": header, "pixels": pixels})
+
+    if len(slices) < 2:
+        return None
+
+    first = slices[0]["header"]
+    for dicom_slice in slices:
+        header = dicom_slice["header"]
+        if any(
+            header.get(attribute) != first.get(attribute)
+            for attribute in SLICE_ATTRIBUTES
+        ):
+            log.info("Input is not one series of one volume. Converting with dcm2niix.")
+            return None
+
+    return slices
+
+
+def member_data_offset(mapped, info):
+    """Return the offset of the data of a zip member, after its local file header."""
+    name_length, extra_length = struct.unpack_from(
+        "<HH", mapped, info.header_offset + 26
+    )
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def simple_slice(header):
+    """Return true if the DICOM is a single uncompressed slice without vendor handling."""
+    file_meta = getattr(header, "file_meta", None)
+    transfer_syntax = file_meta.get("TransferSyntaxUID") if file_meta else None
+    manufacturer = str(header.get("Manufacturer", "")).lower()
+    image_type = [str(value).upper() for value in header.get("ImageType", [])]
+
+    return (
+        transfer_syntax in TRANSFER_SYNTAXES
+        and header.get("Modality") in MODALITIES
+        and not any(vendor in manufacturer for vendor in VENDOR_HANDLING)
+        and "MOSAIC" not in image_type
+        and int(header.get("NumberOfFrames", 1) or 1) == 1
+        and header.get("SamplesPerPixel", 1) == 1
+        and header.get("PhotometricInterpretation") == "MONOCHROME2"
+        and header.get("BitsAllocated") in [8, 16]
+        and header.get("ImagePositionPatient") is not None
+        and header.get("ImageOrientationPatient") is not None
+        and header.get("PixelSpacing") is not None
+    )
+
+
+def slice_pixels(header, source, pixel_offset):
+    """Return the stored pixel values of a slice, without copying them from source."""
+    is_implicit_vr = header.file_meta.TransferSyntaxUID == ImplicitVRLittleEndian
+    if bytes(source[pixel_offset : pixel_offset + 4]) != b"\xe0\x7f\x10\x00":
+        return None
+
+    if is_implicit_vr:
+        (length,) = struct.unpack_from("<L", source, pixel_offset + 4)
+        pixel_offset += 8
+    else:
+        (length,) = struct.unpack_from("<L", source, pixel_offset + 8)
+        pixel_offset += 12
+
+    dtype = np.dtype(
+        f"<{'i' if header.PixelRepresentation else 'u'}{header.BitsAllocated // 8}"
+    )
+    count = int(header.Rows) * int(header.Columns)
+    if length == 0xFFFFFFFF or length < count * dtype.itemsize:
+        return None
+
+    pixels = np.frombuffer(source, dtype=dtype, count=count, offset=pixel_offset)
+    return pixels.reshape((int(header.Rows), int(header.Columns)))
+
+
+def slice_geometry(headers):
+    """Sort the slices along the slice normal and return the NIfTI affine.
+
+    Args:
+        headers (list): The DICOM headers of the slices.
+
+    Returns:
+        order (numpy.ndarray): The index of each slice, in order along the normal.
+        affine (numpy.ndarray): The RAS+ affine of the volume, with the columns of
+            the slices along the first axis and the rows, flipped as by write_nifti,
+            along the second; None if the slices are not axial or not evenly spaced
+            along the normal of the first slice.
+
+    """
+    orientation = np.array(headers[0].ImageOrientationPatient, dtype=float)
+    row_direction, column_direction = orientation[:3], orientation[3:]
+    normal = np.cross(row_direction, column_direction)
+    if abs(normal[2]) < AXIAL_NORMAL:
+        log.info("Slices are not axial. Converting with dcm2niix.")
+        return None
+
+    positions = np.array(
+        [header.ImagePositionPatient for header in headers], dtype=float
+    )
+
+    distances = positions @ normal
+    order = np.argsort(distances, kind="stable")
+    spacings = np.diff(distances[order])
+    # Without gantry tilt, the slices are offset along the normal only
+    offsets = positions - np.outer(distances, normal)
+    if (
+        np.any(spacings <= 1e-3)
+        or not np.allclose(spacings, spacings.mean(), rtol=1e-2, atol=1e-3)
+        or not np.allclose(offsets, offsets[0], atol=1e-2)
+    ):
+        log.info(
+            "Slices are not evenly spaced along the normal. Converting with dcm2niix."
+        )
+        return None
+
+    row_spacing, column_spacing = [float(value) for value in headers[0].PixelSpacing]
+    rows = int(headers[0].Rows)
+    affine = np.eye(4)
+    affine[:3, 0] = row_direction * column_spacing
+    # The first row of the volume is the last row of the slices
+    affine[:3, 1] = -column_direction * row_spacing
+    affine[:3, 2] = (positions[order[-1]] - positions[order[0]]) / (len(order) - 1)
+    affine[:3, 3] = positions[order[0]] + column_direction * row_spacing * (rows - 1)
+
+    # DICOM patient coordinates are left-posterior-superior
+    return order, np.diag([-1, -1, 1, 1]) @ affine
+
+
+def archive_folder(infile, zip_obj):
+    """Return the name of the input directory the archive is extracted to, for %f."""
+    subdirs = [info.filename for info in zip_obj.infolist() if info.is_dir()]
+    return arrange.clean_filename(subdirs[0] if subdirs else os.path.basename(infile))
+
+
+def output_filename(template, folder, header):
+    """Return the output filename of the template, or None for unsupported fields."""
+    values = {"f": folder}
+    for field, attribute in FILENAME_FIELDS.items():
+        values[field] = str(header.get(attribute, ""))
+
+    if any(field not in values for field in re.findall("%(.)", template)):
+        return None
+
+    filename = re.sub("%(.)", lambda match: values[match.group(1)], template)
+    return re.sub("[^0-9a-zA-Z._+-]", "_", filename)
+
+
+def write_nifti(nifti_file, slices, affine, comment="", compression_level=6):
+    """Stack the sorted slices into a preallocated volume and write it as a NIfTI."""
+    first = slices[0]["header"]
+    shape = (int(first.Columns), int(first.Rows), len(slices))
+    dtype = slices[0]["pixels"].dtype
+
+    # The columns of each slice are along the first axis, as in the NIfTI data, and
+    # the rows are flipped, as dcm2niix stores them bottom to top
+    volume = np.empty(shape, dtype=dtype, order="F")
+    for index, dicom_slice in enumerate(slices):
+        volume[:, :, index] = dicom_slice["pixels"][::-1].T
+
+    # As dcm2niix, unsigned 16-bit values are stored as signed if they fit
+    if dtype == np.uint16 and volume.max() <= np.iinfo(np.int16).max:
+        volume = volume.view(np.int16)
+
+    header = nb.Nifti1Header()
+    header.set_data_dtype(volume.dtype)
+    header.set_data_shape(shape)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_xyzt_units("mm", "sec")
+    slope = float(first.get("RescaleSlope", 1) or 1)
+    intercept = float(first.get("RescaleIntercept", 0) or 0)
+    if slope != 1 or intercept != 0:
+        header["scl_slope"] = slope
+        header["scl_inter"] = intercept
+    if comment:
+        header["aux_file"] = comment
+    header["vox_offset"] = 352
+
+    if nifti_file.endswith(".gz"):
+        nifti = gzip.open(nifti_file, "wb", compresslevel=compression_level)
+    else:
+        nifti = open(nifti_file, "wb")
+    with nifti:
+        nifti.write(header.binaryblock)
+        nifti.write(b"\x00" * 4)
+        nifti.write(volume.ravel(order="F"))
+
+
+def sidecar(header):
+    """Return the sidecar of the series, with the fields dcm2niix writes."""
+    sidecar_info = {}
+    for field, attribute, scale in SIDECAR_FIELDS:
+        value = header.get(attribute)
+        if value is None or value == "":
+            continue
+        value = metadata.json_safe(value)
+        if scale and isinstance(value, (int, float)):
+            value = value * scale
+        sidecar_info[field] = value
+
+    # As dcm2niix, spaces are replaced with underscores
+    if "SeriesDescription" in sidecar_info:
+        sidecar_info["SeriesDescription"] = str(
+            sidecar_info["SeriesDescription"]
+        ).replace(" ", "_")
+    if "ProtocolName" in sidecar_info:
+        sidecar_info["ProtocolName"] = str(sidecar_info["ProtocolName"]).replace(
+            " ", "_"
+        )
+
+    sidecar_info["ImageOrientationPatientDICOM"] = [
+        float(value) for value in header.ImageOrientationPatient
+    ]
+    sidecar_info["ConversionSoftware"] = "dcm2niix_gear native"
+
+    return sidecar_info
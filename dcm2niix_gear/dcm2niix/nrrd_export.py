@@ -0,0 +1,203 @@
+"""Functions to write NRRDs from the voxel data of converted NIfTIs."""
+
+import gzip
+import logging
+import os
+import sys
+
+import nibabel as nb
+import numpy as np
+
+from dcm2niix_gear.utils import profiling
+
+
+log = logging.getLogger(__name__)
+
+# NRRD types of the NIfTI datatypes dcm2niix writes, by numpy dtype
+NRRD_TYPES = {
+    "uint8": "uint8",
+    "int8": "int8",
+    "uint16": "uint16",
+    "int16": "int16",
+    "uint32": "uint32",
+    "int32": "int32",
+    "uint64": "uint64",
+    "int64": "int64",
+    "float32": "float",
+    "float64": "double",
+}
+
+# Bytes of image data copied at a time
+COPY_SIZE = 16 * 1024**2
+
+
+def write_nrrds(nifti_files, compression_level=6, reference_nifti=True):
+    """Write an NRRD with the voxel data of each NIfTI, without converting again.
+
+        A compressed NIfTI is written as a detached header (.nhdr) and its image data
+        streamed into gzip compressed data (.raw.gz), as dcm2niix writes NRRDs. An
+        uncompressed NIfTI is written as a detached header referencing the image data
+        of the NIfTI itself, if the NIfTI is retained, or else as an NRRD with the
+        image data attached (.nrrd). The image data is copied as stored, unless the
+        NIfTI is scaled, in which case the scaled values are written as floats.
+
+    Args:
+        nifti_files (list): The absolute paths to the NIfTIs; other files are ignored.
+        compression_level (int): The gzip compression level of the image data.
+        reference_nifti (bool): If true, the NIfTIs are retained in the gear outputs,
+            so that detached headers may reference uncompressed NIfTIs.
+
+    Returns:
+        nrrd_files (list): The absolute paths to the NRRD files written.
+
+    """
+    nrrd_files = []
+    nifti_files = [file for file in nifti_files if file.endswith((".nii", ".nii.gz"))]
+
+    with profiling.span("nrrd", files=len(nifti_files)):
+        for nifti_file in nifti_files:
+            nrrd_files.extend(
+                write_nrrd(
+                    nifti_file,
+                    compression_level=compression_level,
+                    reference_nifti=reference_nifti,
+                )
+            )
+
+    return nrrd_files
+
+
+def write_nrrd(nifti_file, compression_level=6, reference_nifti=True):
+    """Write an NRRD with the voxel data of a NIfTI, next to the NIfTI.
+
+    Args:
+        nifti_file (str): The absolute path to the NIfTI.
+        compression_level (int): The gzip compression level of the image data.
+        reference_nifti (bool): If true, a detached header may reference the image
+            data of an uncompressed NIfTI.
+
+    Returns:
+        nrrd_files (list): The absolute paths to the NRRD files written; empty if the
+            datatype of the NIfTI is not supported.
+
+    """
+    compressed = nifti_file.endswith(".gz")
+    stem = nifti_file[: -len(".nii.gz")] if compressed else nifti_file[: -len(".nii")]
+
+    with open_nifti(nifti_file) as nifti:
+        header = nb.Nifti1Header.from_fileobj(nifti)
+
+    dtype = header.get_data_dtype()
+    shape = header.get_data_shape()
+    slope, inter = header.get_slope_inter()
+    scaled = slope is not None and (slope != 1 or (inter or 0) != 0)
+    rgb = dtype.names == ("R", "G", "B")
+
+    if len(shape) < 3 or not (rgb or dtype.name in NRRD_TYPES):
+        log.warning(f"Unable to write {os.path.basename(nifti_file)} as NRRD.")
+        return []
+
+    endianness = header.endianness
+    if scaled:
+        dtype = np.dtype(np.float32)
+        endianness = "<" if sys.byteorder == "little" else ">"
+
+    fields = nrrd_fields(header, shape, dtype, endianness, rgb)
+
+    if compressed:
+        data_file = f"{stem}.raw.gz"
+        fields["encoding"] = "gzip"
+        fields["data file"] = os.path.basename(data_file)
+        write_header(f"{stem}.nhdr", fields)
+        with gzip.open(data_file, "wb", compresslevel=compression_level) as target:
+            write_data(nifti_file, header, target, scaled)
+        return [f"{stem}.nhdr", data_file]
+
+    if reference_nifti and not scaled:
+        fields["encoding"] = "raw"
+        fields["data file"] = os.path.basename(nifti_file)
+        fields["byte skip"] = str(int(header["vox_offset"]))
+        write_header(f"{stem}.nhdr", fields)
+        return [f"{stem}.nhdr"]
+
+    fields["encoding"] = "raw"
+    write_header(f"{stem}.nrrd", fields)
+    with open(f"{stem}.nrrd", "ab") as target:
+        write_data(nifti_file, header, target, scaled)
+    return [f"{stem}.nrrd"]
+
+
+def nrrd_fields(header, shape, dtype, endianness, rgb=False):
+    """Return the NRRD fields of the NIfTI voxel grid, in left-posterior-superior."""
+    affine = header.get_best_affine()
+    # NIfTI world coordinates are right-anterior-superior
+    affine = np.diag([-1, -1, 1, 1]) @ affine
+
+    def vector(values):
+        return "(" + ",".join(f"{value:.17g}" for value in values) + ")"
+
+    sizes = [str(size) for size in shape]
+    directions = [vector(affine[:3, axis]) for axis in range(3)]
+    directions += ["none"] * (len(shape) - 3)
+    kinds = ["space"] * 3 + ["list"] * (len(shape) - 3)
+    if rgb:
+        sizes.insert(0, "3")
+        directions.insert(0, "none")
+        kinds.insert(0, "RGB-color")
+
+    fields = {
+        "type": "uint8" if rgb else NRRD_TYPES[dtype.name],
+        "dimension": str(len(sizes)),
+        "space": "left-posterior-superior",
+        "sizes": " ".join(sizes),
+        "space directions": " ".join(directions),
+        "kinds": " ".join(kinds),
+    }
+    if dtype.itemsize > 1 and not rgb:
+        fields["endian"] = "big" if endianness == ">" else "little"
+    fields["space origin"] = vector(affine[:3, 3])
+
+    return fields
+
+
+def write_header(nrrd_file, fields):
+    """Write the NRRD header, with the blank line ending an attached header."""
+    lines = ["NRRD0004", "# Complete NRRD file format specification at:"]
+    lines.append("# http://teem.sourceforge.net/nrrd/format.html")
+    lines.extend(f"{field}: {value}" for field, value in fields.items())
+
+    with open(nrrd_file, "w") as header_file:
+        header_file.write("\n".join(lines) + "\n")
+        if not nrrd_file.endswith(".nhdr"):
+            header_file.write("\n")
+
+
+def write_data(nifti_file, header, target, scaled=False):
+    """Write the image data of a NIfTI to target, streamed or one volume at a time."""
+    shape = header.get_data_shape()
+
+    if scaled:
+        # Scaling applies to the stored values; write the scaled values as floats
+        dataobj = nb.load(nifti_file).dataobj
+        # NRRD data is ordered as NIfTI data, with the first axis fastest
+        for volume_index in np.ndindex(*shape[:2:-1]):
+            data = np.asarray(dataobj[(slice(None),) * 3 + volume_index[::-1]])
+            target.write(data.astype(np.float32).tobytes(order="F"))
+        return
+
+    remaining = int(np.prod(shape)) * header.get_data_dtype().itemsize
+    with open_nifti(nifti_file) as nifti:
+        nifti.seek(int(header["vox_offset"]))
+        while remaining > 0:
+            data = nifti.read(min(remaining, COPY_SIZE))
+            if not data:
+                break
+            target.write(data)
+            remaining -= len(data)
+
+
+def open_nifti(nifti_file):
+    """Open a NIfTI for reading, decompressing it if gzip compressed."""
+    if nifti_file.endswith(".gz"):
+        return gzip.open(nifti_file, "rb")
+    return open(nifti_file, "rb")
@@ -8,15 +8,30 @@ import pydicom
 
 from dcm2niix_gear.dcm2niix import arrange
 from dcm2niix_gear.dcm2niix import dcm2niix_utils
+from dcm2niix_gear.utils import planner
+from dcm2niix_gear.utils import profiling
 
 
 log = logging.getLogger(__name__)
 
 
-def setup(infile, rec_infile, work_dir, remove_incomplete_volumes, decompress_dicoms):
+def setup(
+    infile,
+    rec_infile,
+    work_dir,
+    remove_incomplete_volumes,
+    decompress_dicoms,
+    remove_duplicate_dicoms=False,
+):
     """Prepare dcm2niix input, remove incomplete volumes, and decompress dicom files."""
     log.info("Prepare dcm2niix input.")
-    dcm2niix_input_dir = arrange.prepare_dcm2niix_input(infile, rec_infile, work_dir)
+    dcm2niix_input_dir = arrange.prepare_dcm2niix_input(
+        infile, rec_infile, work_dir, remove_duplicates=remove_duplicate_dicoms
+    )
+
+    # Size the parallel stages from the staged input and the job resources
+    with profiling.span("planning"):
+        planner.plan(dcm2niix_input_dir)
 
     if remove_incomplete_volumes:
         log.info("Remove incomplete volumes.")
@@ -33,7 +48,8 @@ def setup(infile, rec_infile, work_dir, remove_incomplete_volumes, decompress_di
             )
             os.sys.exit(1)
 
-        dcm2niix_utils.remove_incomplete_volumes(dcm2niix_input_dir)
+        with profiling.span("remove_incomplete_volumes"):
+            dcm2niix_utils.remove_incomplete_volumes(dcm2niix_input_dir)
 
     if decompress_dicoms:
         log.info("Decompress dicom files.")
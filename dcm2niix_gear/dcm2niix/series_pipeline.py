@@ -0,0 +1,194 @@
+"""Functions to convert and post-process the series of a session as a pipeline."""
+
+import contextlib
+import logging
+import os
+import shutil
+from types import SimpleNamespace
+
+from dcm2niix_gear.dcm2niix import conversion_cache
+from dcm2niix_gear.dcm2niix import dcm2niix_utils
+from dcm2niix_gear.dcm2niix import incremental
+from dcm2niix_gear.pydeface import pydeface_run
+from dcm2niix_gear.utils import checkpoint
+from dcm2niix_gear.utils import metadata
+from dcm2niix_gear.utils import pipeline
+from dcm2niix_gear.utils import planner
+from dcm2niix_gear.utils import profiling
+
+
+log = logging.getLogger(__name__)
+
+PIPELINE_DIR = ".pipeline"
+
+
+def convert_and_process(
+    dcm2niix_input_dir,
+    work_dir,
+    dcm2niix_args,
+    coil_combine=False,
+    pydeface_args=None,
+    queue_size=1,
+):
+    """Convert, coil combine, deface and index each series of a session as a pipeline.
+
+        Each series is converted by its own dcm2niix run, then coil combined and
+        defaced, and its DICOM headers indexed for metadata capture, so that the
+        conversion of the next series overlaps the post-processing of the previous
+        one, if the resource plan fits both at a time. The outputs and DICOM index
+        are the same as when the session is converted as a whole and then
+        post-processed, listed in order of series number. Each series is journaled
+        once indexed, so that the series processed before a restart are skipped.
+
+    Args:
+        dcm2niix_input_dir (str): The absolute path to the input directory to dcm2niix.
+        work_dir (str): The absolute path to the output directory of dcm2niix.
+        dcm2niix_args (dict): The gear args of the dcm2niix stage.
+        coil_combine (bool): If true, apply the coil combined method to the NIfTIs.
+        pydeface_args (dict): The gear args of the pydeface stage, if PyDeface is
+            applied.
+        queue_size (int): The maximum number of converted series waiting for
+            post-processing.
+
+    Returns:
+        output (types.SimpleNamespace): The dcm2niix outputs, with the fields of the
+            nipype interface result used by the gear; None if the series cannot be
+            converted separately.
+        pydeface_skipped (dict): The absolute paths to NIfTI files not defaced by
+            PyDeface, with the reason.
+        dicom_index (dict): The DICOM header metadata of each series, as
+            metadata.build_dicom_index.
+
+    """
+    if pydeface_args and pydeface_args["pydeface_reuse_registration"]:
+        log.info(
+            "Registrations are reused across series with pydeface_reuse_registration. "
+            "Not converting series separately."
+        )
+        return None, None, None
+
+    if planner.workers("pipeline", 2) < 2:
+        log.info(
+            "The resource plan fits one stage at a time. Not converting series "
+            "separately."
+        )
+        return None, None, None
+
+    series = incremental.separable_series(dcm2niix_input_dir, dcm2niix_args)
+    if series is None:
+        return None, None, None
+
+    # Skip the series processed before the job was restarted
+    processed = {}
+    for series_uid in series:
+        resumed = checkpoint.completed(f"pipeline {series_uid}")
+        if resumed is not None:
+            processed[series_uid] = resumed
+    if processed:
+        log.info(f"{len(processed)} series processed before the restart. Skipping.")
+
+    log.info(f"Converting and post-processing {len(series)} series as a pipeline.")
+    pipeline_dir = os.path.join(str(work_dir), PIPELINE_DIR)
+
+    if pydeface_args:
+        deface_session = pydeface_run.deface_session(**pydeface_args)
+    else:
+        deface_session = contextlib.nullcontext()
+
+    try:
+        with deface_session as deface:
+
+            def convert(series_uid):
+                """Convert one series and move its outputs to work_dir."""
+                with profiling.span("dcm2niix", series=series_uid):
+                    series_outputs = incremental.convert_series(
+                        dcm2niix_input_dir,
+                        {series_uid: series[series_uid]},
+                        os.path.join(pipeline_dir, series_uid),
+                        dcm2niix_args,
+                    )
+
+                if series_outputs is None:
+                    log.error(f"Unable to match the outputs of series {series_uid}.")
+                    os.sys.exit(1)
+
+                outputs = move_outputs(series_outputs[series_uid], work_dir)
+                return {"series_uid": series_uid, "outputs": outputs}
+
+            def post_process(result):
+                """Coil combine and deface the NIfTIs of one series."""
+                image_files = result["outputs"]["converted_files"]
+                if coil_combine and image_files:
+                    with profiling.span("coil_combine", files=len(image_files)):
+                        dcm2niix_utils.coil_combine(image_files)
+
+                result["pydeface_skipped"] = {}
+                if deface and image_files:
+                    with profiling.span("pydeface", files=len(image_files)):
+                        result["pydeface_skipped"] = deface(
+                            image_files, dcm2niix_input_dir=dcm2niix_input_dir
+                        )
+
+                return result
+
+            def index(result):
+                """Index the DICOM headers of one series and journal the series."""
+                series_uid = result.pop("series_uid")
+                with profiling.span("metadata", series=series_uid):
+                    result["dicom_index"] = metadata.build_dicom_index(
+                        dcm2niix_input_dir, files=series[series_uid]["files"]
+                    )
+
+                files = [
+                    file
+                    for field in conversion_cache.OUTPUT_FIELDS
+                    for file in result["outputs"][field]
+                    if field != "converted_files"
+                ] + [
+                    file
+                    for image_file in result["outputs"]["converted_files"]
+                    for file in pydeface_run.defaced_files(image_file)
+                ]
+                checkpoint.record(f"pipeline {series_uid}", files=files, result=result)
+
+                return series_uid, result
+
+            results = pipeline.run(
+                [series_uid for series_uid in series if series_uid not in processed],
+                [convert, post_process, index],
+                queue_size=queue_size,
+            )
+
+    finally:
+        shutil.rmtree(pipeline_dir, ignore_errors=True)
+
+    processed.update(results)
+
+    outputs = {field: [] for field in conversion_cache.OUTPUT_FIELDS}
+    pydeface_skipped = {}
+    dicom_index = {}
+    for series_uid in series:
+        result = processed[series_uid]
+        for field in conversion_cache.OUTPUT_FIELDS:
+            outputs[field].extend(result["outputs"][field])
+        pydeface_skipped.update(result["pydeface_skipped"])
+        dicom_index.update(result["dicom_index"])
+
+    output = SimpleNamespace(outputs=SimpleNamespace(**outputs))
+    return output, pydeface_skipped, dicom_index
+
+
+def move_outputs(outputs, work_dir):
+    """Move the dcm2niix outputs of a series to work_dir and return the new paths."""
+    moved = {}
+    for field, files in outputs.items():
+        moved[field] = []
+        for file in files:
+            target = os.path.join(str(work_dir), os.path.basename(file))
+            if os.path.exists(target):
+                log.error(f"{target} was converted from more than one series. Exiting.")
+                os.sys.exit(1)
+            shutil.move(file, target)
+            moved[field].append(target)
+
+    return moved
@@ -0,0 +1,335 @@
+"""Functions to convert the series of an archive while it is being extracted."""
+
+import logging
+import os
+import shutil
+import tarfile
+import zipfile
+from types import SimpleNamespace
+
+from dcm2niix_gear.dcm2niix import arrange
+from dcm2niix_gear.dcm2niix import conversion_cache
+from dcm2niix_gear.dcm2niix import incremental
+from dcm2niix_gear.dcm2niix import series_pipeline
+from dcm2niix_gear.utils import pipeline
+from dcm2niix_gear.utils import planner
+from dcm2niix_gear.utils import profiling
+
+
+log = logging.getLogger(__name__)
+
+STREAMING_DIR = ".streaming"
+
+
+def extract_and_convert(prepare_args, work_dir, dcm2niix_args):
+    """Extract an archive and convert each directory of series as it is extracted.
+
+        Archives exported by series hold the files of each series in one directory.
+        The archive is extracted member by member, in archive order, and once the
+        extraction moves on to another directory, the series of the previous
+        directory are converted while the extraction continues, if the resource
+        plan fits both at a time. Once extracted, the input is arranged as by
+        arrange.prepare_dcm2niix_input and every series is fingerprinted again; the
+        series that were not entirely within one directory, or were converted with
+        another folder name (%f), are converted again. The outputs are the same as
+        when the input is converted as a whole.
+
+    Args:
+        prepare_args (dict): The gear args of the prepare stage.
+        work_dir (str): The absolute path to the working directory.
+        dcm2niix_args (dict): The gear args of the dcm2niix stage.
+
+    Returns:
+        dcm2niix_input_dir (str): The absolute path to the input directory to dcm2niix;
+            None if the input cannot be extracted as a stream.
+        output (types.SimpleNamespace): The dcm2niix outputs, with the fields of the
+            nipype interface result used by the gear; None if the input must be
+            converted as a whole.
+
+    """
+    if not applicable(prepare_args, dcm2niix_args):
+        return None, None
+
+    infile = prepare_args["infile"]
+
+    # Size the stages from the archive, as the input is not staged before conversion
+    with profiling.span("planning"):
+        planner.plan(infile)
+    if planner.workers("streaming", 2) < 2:
+        log.info(
+            "The resource plan fits one stage at a time. Not converting during "
+            "extraction."
+        )
+        return None, None
+    streaming_dir = os.path.join(str(work_dir), STREAMING_DIR)
+    extract_dir = os.path.join(streaming_dir, "extract")
+    os.makedirs(extract_dir)
+    extraction = {}
+
+    def convert(group):
+        """Convert the series of one extracted directory."""
+        series = incremental.fingerprint_series(extract_dir, files=group["files"])
+        if not series:
+            return {}
+
+        with profiling.span("dcm2niix", files=len(group["files"])):
+            series_outputs = incremental.convert_series(
+                extract_dir,
+                series,
+                os.path.join(streaming_dir, str(group["index"])),
+                dcm2niix_args,
+                folder=group["folder"],
+                flatten=group["flatten"],
+            )
+
+        if series_outputs is None:
+            return {}
+
+        return {
+            series_uid: {
+                "fingerprint": series[series_uid]["fingerprint"],
+                "folder": group["folder"],
+                "flatten": group["flatten"],
+                "outputs": outputs,
+            }
+            for series_uid, outputs in series_outputs.items()
+        }
+
+    try:
+        with profiling.span("streaming"):
+            streamed = {}
+            for converted in pipeline.run(
+                extract_directories(infile, extract_dir, extraction),
+                [convert],
+                queue_size=0,
+            ):
+                streamed.update(converted)
+
+        with profiling.span("flattening"):
+            dcm2niix_input_dir = arrange_extracted(
+                infile, extract_dir, work_dir, extraction
+            )
+
+        output = combine_outputs(
+            dcm2niix_input_dir,
+            work_dir,
+            dcm2niix_args,
+            streamed,
+            os.path.join(streaming_dir, "remaining"),
+            flatten=bool(extraction["subdirs"]),
+        )
+
+    finally:
+        shutil.rmtree(streaming_dir, ignore_errors=True)
+
+    return dcm2niix_input_dir, output
+
+
+def applicable(prepare_args, dcm2niix_args):
+    """Return true if the input is an archive whose series can be converted apart."""
+    infile = prepare_args["infile"]
+
+    if (
+        prepare_args["remove_incomplete_volumes"]
+        or prepare_args["decompress_dicoms"]
+        or prepare_args.get("remove_duplicate_dicoms")
+    ):
+        log.info(
+            "Files are corrected after extraction. Not converting during extraction."
+        )
+        return False
+
+    if dcm2niix_args["ignore_errors"]:
+        return False
+
+    if not (
+        zipfile.is_zipfile(infile)
+        or arrange.compressed_tar_format(infile)
+        or tarfile.is_tarfile(infile)
+    ):
+        return False
+
+    return incremental.applicable(dcm2niix_args)
+
+
+def extract_directories(infile, extract_dir, extraction):
+    """Extract an archive member by member, yielding each completed directory.
+
+        A directory is complete once a file of another directory is extracted, as
+        archives are written directory by directory. The names of the directories and
+        files and the size of the archive contents are recorded in extraction, once
+        the extraction completes.
+
+    Args:
+        infile (str): The absolute path to the zip or tar archive.
+        extract_dir (str): The absolute path to the directory to extract to.
+        extraction (dict): Updated with the 'subdirs', 'filelist' and 'size' of the
+            archive contents.
+
+    Yields:
+        group (dict): The 'files' extracted from one directory, with the 'folder'
+            name and layout ('flatten') the input directory has if the archive has
+            no more directories than those extracted so far.
+
+    """
+    subdirs = []
+    filelist = []
+    size = 0
+    group = None
+
+    with profiling.span("extraction"):
+        for name, is_dir, member_size in extract_members(infile, extract_dir):
+            filelist.append(name)
+            if is_dir:
+                subdirs.append(name)
+                continue
+            size += member_size
+
+            # Files starting with a period are dropped when the input is flattened
+            if subdirs and os.path.basename(name).startswith("."):
+                continue
+
+            directory = os.path.dirname(name)
+            if group and group["directory"] != directory:
+                yield group
+                group = None
+
+            if group is None:
+                group = {
+                    "index": len(filelist),
+                    "directory": directory,
+                    "files": [],
+                    "folder": arrange.clean_filename(
+                        subdirs[0] if subdirs else os.path.basename(infile)
+                    ),
+                    "flatten": bool(subdirs),
+                }
+            group["files"].append(os.path.join(extract_dir, name))
+
+        if group:
+            yield group
+
+    extraction.update({"subdirs": subdirs, "filelist": filelist, "size": size})
+
+
+def extract_members(infile, extract_dir):
+    """Extract the members of a zip or tar archive in order, yielding each name."""
+    if zipfile.is_zipfile(infile):
+        with zipfile.ZipFile(infile, "r") as zip_obj:
+            for info in zip_obj.infolist():
+                zip_obj.extract(info, extract_dir)
+                yield info.filename, info.is_dir(), info.file_size
+
+    else:
+        # Read as a stream, so that members are extracted as they are decompressed
+        with arrange.open_tar_stream(infile) as tar_obj:
+            for info in tar_obj:
+                if not (info.isdir() or info.isreg()):
+                    continue
+                tar_obj.extract(info, extract_dir)
+                yield info.name, info.isdir(), info.size
+
+
+def arrange_extracted(infile, extract_dir, work_dir, extraction):
+    """Arrange the extracted archive as the input directory to dcm2niix.
+
+        The input directory is the same as created by
+        arrange.extract_archive_contents: named by the first directory of the archive
+        and flattened, or named by the archive, if the archive has no directories.
+
+    Args:
+        infile (str): The absolute path to the archive.
+        extract_dir (str): The absolute path to the extracted archive.
+        work_dir (str): The absolute path to the working directory.
+        extraction (dict): The extraction record from extract_directories.
+
+    Returns:
+        dcm2niix_input_dir (str): The absolute path to the input directory to dcm2niix.
+
+    """
+    if extraction["size"] == 0:
+        log.error("Incorrect gear input. Input archive is empty. Exiting.")
+        os.sys.exit(1)
+
+    subdirs = extraction["subdirs"]
+    if subdirs:
+        dcm2niix_input_dir, dirname = arrange.setup_dcm2niix_input_dir(
+            subdirs[0], str(work_dir)
+        )
+        shutil.rmtree(dcm2niix_input_dir)
+        arrange.flatten_directory(extract_dir, dcm2niix_input_dir)
+    else:
+        dcm2niix_input_dir, dirname = arrange.setup_dcm2niix_input_dir(
+            infile, str(work_dir)
+        )
+        os.rmdir(dcm2niix_input_dir)
+        os.rename(extract_dir, dcm2niix_input_dir)
+
+    if [file for file in extraction["filelist"] if file.lower().endswith(".par")]:
+        arrange.adjust_parrec_filenames(dcm2niix_input_dir, dirname)
+
+    return dcm2niix_input_dir
+
+
+def combine_outputs(
+    dcm2niix_input_dir, work_dir, dcm2niix_args, streamed, scratch_dir, flatten=False
+):
+    """Combine the outputs of the series converted during extraction.
+
+        The series of the input directory are fingerprinted. The outputs of each
+        series converted during the extraction with the same fingerprint, folder name
+        and layout are reused; the other series are converted in one dcm2niix run.
+
+    Args:
+        dcm2niix_input_dir (str): The absolute path to the input directory to dcm2niix.
+        work_dir (str): The absolute path to the output directory of dcm2niix.
+        dcm2niix_args (dict): The gear args of the dcm2niix stage.
+        streamed (dict): The outputs of the series converted during the extraction.
+        scratch_dir (str): The absolute path to a scratch directory.
+        flatten (bool): If true, the input directory was flattened.
+
+    Returns:
+        output (types.SimpleNamespace): The dcm2niix outputs, in order of series
+            number; None if the input must be converted as a whole.
+
+    """
+    series = incremental.separable_series(dcm2niix_input_dir, dcm2niix_args)
+    if series is None:
+        return None
+
+    folder = os.path.basename(dcm2niix_input_dir)
+    series_outputs = {
+        series_uid: streamed[series_uid]["outputs"]
+        for series_uid, info in series.items()
+        if series_uid in streamed
+        and streamed[series_uid]["fingerprint"] == info["fingerprint"]
+        and streamed[series_uid]["folder"] == folder
+        and streamed[series_uid]["flatten"] == flatten
+    }
+
+    remaining = {
+        series_uid: info
+        for series_uid, info in series.items()
+        if series_uid not in series_outputs
+    }
+    log.info(
+        f"{len(series_outputs)} of {len(series)} series converted during extraction. "
+        f"Converting {len(remaining)} series."
+    )
+
+    if remaining:
+        with profiling.span("dcm2niix", files=len(remaining)):
+            remaining_outputs = incremental.convert_series(
+                dcm2niix_input_dir, remaining, scratch_dir, dcm2niix_args
+            )
+        if remaining_outputs is None:
+            return None
+        series_outputs.update(remaining_outputs)
+
+    outputs = {field: [] for field in conversion_cache.OUTPUT_FIELDS}
+    for series_uid in series:
+        moved = series_pipeline.move_outputs(series_outputs[series_uid], work_dir)
+        for field in conversion_cache.OUTPUT_FIELDS:
+            outputs[field].extend(moved[field])
+
+    return SimpleNamespace(outputs=SimpleNamespace(**outputs))
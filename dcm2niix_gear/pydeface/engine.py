@@ -0,0 +1,243 @@
+"""PyDeface engine calling the PyDeface Python API in a long-lived worker process."""
+
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import nibabel as nb
+from pydeface.utils import cleanup_files, deface_image, initial_checks
+
+from dcm2niix_gear.utils import processes
+
+
+log = logging.getLogger(__name__)
+
+# Template and facemask resolved once per worker process
+_worker_state = {}
+
+# The resource usage of a run is that of the worker and its FSL-FLIRT processes
+_RUSAGE = [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]
+_USAGE_FIELDS = [
+    "ru_utime",
+    "ru_stime",
+    "ru_inblock",
+    "ru_oublock",
+    "ru_nvcsw",
+    "ru_nivcsw",
+]
+
+
+class PyDefaceEngine:
+    """Deface NIfTI files in a single worker process started once per gear stage.
+
+        The worker imports PyDeface, nipype and nibabel, and resolves the template
+        and facemask and checks their headers, once. Each NIfTI file is then
+        defaced through pydeface.utils.deface_image. Only the interpreter start and
+        imports are saved per file: PyDeface passes the template and facemask to
+        FSL-FLIRT by path, so FLIRT reads both images for each file. The log
+        records and prints of the worker are handled by the log handlers of the
+        gear as they are produced. The resource usage of each run in the worker,
+        including its FSL-FLIRT processes, is recorded in the run profile as that of
+        pydeface. If the worker cannot be started or dies, deface returns False so
+        that the caller can fall back to the PyDeface executable.
+
+    Args:
+        template (str): The absolute path to an optional template image that will be
+            used as the registration target instead of the default.
+        facemask (str): The absolute path to an optional facemask image that will be
+            used instead of the default.
+
+    """
+
+    def __init__(self, template=None, facemask=None):
+        self.template = str(template) if template else None
+        self.facemask = str(facemask) if facemask else None
+        self.executor = None
+        self.listener = None
+
+    def __enter__(self):
+        log_queue = multiprocessing.Queue()
+        self.listener = logging.handlers.QueueListener(log_queue, _ParentHandler())
+        self.listener.start()
+        self.executor = ProcessPoolExecutor(
+            max_workers=1,
+            initializer=_initialize_worker,
+            initargs=(
+                self.template,
+                self.facemask,
+                log_queue,
+                logging.getLogger().getEffectiveLevel(),
+            ),
+        )
+        return self
+
+    def __exit__(self, *args):
+        self.executor.shutdown(wait=True)
+        self.executor = None
+        self.listener.stop()
+        self.listener = None
+
+    def deface(
+        self,
+        infile,
+        pydeface_cost="mutualinfo",
+        pydeface_nocleanup=False,
+        pydeface_verbose=False,
+    ):
+        """Deface infile in the worker process.
+
+        Args:
+            infile (str): The absolute path to the input NIfTI file to be defaced.
+            pydeface_cost (str): FSL-FLIRT cost function.
+            pydeface_nocleanup (bool): If true, do not clean up temporary files.
+            pydeface_verbose (bool): If true, show additional status prints.
+
+        Returns:
+            success (bool): False if the worker is unavailable; replaces input NIfTI
+                with defaced version otherwise.
+
+        """
+        log.info(f"Running PyDeface engine on {infile}")
+
+        try:
+            future = self.executor.submit(
+                _deface,
+                str(infile),
+                pydeface_cost,
+                pydeface_nocleanup,
+                pydeface_verbose,
+            )
+            usage, wall_time, sampled_peak_rss = future.result()
+
+        except BrokenProcessPool:
+            log.warning("PyDeface engine worker is unavailable.")
+            return False
+
+        except Exception:
+            log.exception("Error defacing nifti using PyDeface engine. Exiting.")
+            os.sys.exit(1)
+
+        processes.record_usage(
+            "pydeface",
+            usage,
+            wall_time=wall_time,
+            sampled_peak_rss=sampled_peak_rss,
+            returncode=0,
+        )
+
+        log.info(f"Success. PyDeface completed on {infile}.")
+        return True
+
+
+class _ParentHandler(logging.Handler):
+    """Handle the log records of the worker with the loggers of the gear."""
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+class _LogStream:
+    """Log each line printed to the stream, e.g., by PyDeface."""
+
+    def __init__(self, logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+        self.buffer = ""
+
+    def write(self, text):
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        for line in lines:
+            if line.strip():
+                self.logger.log(self.level, line.rstrip())
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def _initialize_worker(template, facemask, log_queue, log_level):
+    """Resolve the template and facemask and check their headers once per worker."""
+    # Send log records and PyDeface prints to the gear log handlers, in the parent
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(log_level)
+    sys.stdout = _LogStream(log)
+
+    template, facemask = initial_checks(template, facemask)
+    _worker_state["template"] = str(template)
+    _worker_state["facemask"] = str(facemask)
+
+    # Fail at worker start, not per file, if either header cannot be read. The
+    # voxel data is not loaded, as PyDeface reads both images from their paths
+    nb.load(str(template))
+    nb.load(str(facemask))
+
+
+def _deface(infile, pydeface_cost, pydeface_nocleanup, pydeface_verbose):
+    """Deface infile in place, as the PyDeface executable with --outfile and --force.
+
+        The resource usage of the run is measured in the worker, where it runs with
+        its FSL-FLIRT processes, and returned for the run profile of the gear.
+
+    Returns:
+        usage (dict): The difference in the resource usage of the worker and its
+            children, as in processes.record_usage.
+        wall_time (float): The elapsed time in seconds.
+        sampled_peak_rss (int): The peak RSS in bytes of the worker and its
+            children, sampled during the run.
+
+    """
+    start = time.perf_counter()
+    before = [resource.getrusage(who) for who in _RUSAGE]
+
+    with processes.sample_rss(os.getpid()) as sampled:
+        _deface_image(infile, pydeface_cost, pydeface_nocleanup, pydeface_verbose)
+
+    after = [resource.getrusage(who) for who in _RUSAGE]
+    usage = {
+        field: sum(
+            getattr(end, field) - getattr(begin, field)
+            for begin, end in zip(before, after)
+        )
+        for field in _USAGE_FIELDS
+    }
+    # The maximum RSS is only known if the run exceeds the previous runs
+    usage["ru_maxrss"] = max(
+        end.ru_maxrss if end.ru_maxrss > begin.ru_maxrss else 0
+        for begin, end in zip(before, after)
+    )
+
+    return usage, time.perf_counter() - start, sampled["peak_rss"]
+
+
+def _deface_image(infile, pydeface_cost, pydeface_nocleanup, pydeface_verbose):
+    """Run PyDeface on infile and keep or clean up its intermediates."""
+    warped_mask_img, warped_mask, template_reg, template_reg_mat = deface_image(
+        infile=infile,
+        outfile=infile,
+        facemask=_worker_state["facemask"],
+        template=_worker_state["template"],
+        cost=pydeface_cost,
+        force=True,
+        forcecleanup=False,
+        verbose=pydeface_verbose,
+    )
+
+    if pydeface_nocleanup:
+        unclean_mask = infile.replace(".gz", "").replace(
+            ".nii", "_pydeface_mask.nii.gz"
+        )
+        unclean_mat = infile.replace(".gz", "").replace(".nii", "_pydeface.mat")
+        shutil.move(warped_mask, unclean_mask)
+        shutil.move(template_reg_mat, unclean_mat)
+        cleanup_files(template_reg)
+    else:
+        cleanup_files(warped_mask, template_reg, template_reg_mat)
@@ -1,8 +1,26 @@
 """Functions to execute PyDeface on a list of NIfTI files or a single NIfTI file."""
 
+import contextlib
+import glob
+import json
 import logging
 import os
-import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import nibabel as nb
+import numpy as np
+import pydicom
+
+from dcm2niix_gear.pydeface import engine
+from dcm2niix_gear.pydeface import registration
+from dcm2niix_gear.pydeface import selection
+from dcm2niix_gear.pydeface import template_cache
+from dcm2niix_gear.utils import checkpoint
+from dcm2niix_gear.utils import planner
+from dcm2niix_gear.utils import processes
+from dcm2niix_gear.utils import profiling
 
 
 log = logging.getLogger(__name__)
@@ -15,6 +33,15 @@ def deface_multiple_niftis(
     facemask=False,
     pydeface_nocleanup=False,
     pydeface_verbose=False,
+    pydeface_reuse_registration=False,
+    pydeface_downsample=0,
+    pydeface_select=False,
+    pydeface_skip_series_pattern=selection.DEFAULT_SKIP_SERIES_PATTERN,
+    pydeface_min_fov=100,
+    pydeface_engine="cli",
+    cache_dir=None,
+    cache_max_size=None,
+    dcm2niix_input_dir=None,
 ):
     """Run PyDeface on a list of NIfTI files.
 
@@ -28,21 +55,339 @@ def deface_multiple_niftis(
             used instead of the default.
         pydeface_nocleanup (bool): If true, do not clean up temporary files.
         pydeface_verbose (bool): If true, show additional status prints.
+        pydeface_reuse_registration (bool): If true, register only the first NIfTI
+            of each frame of reference to the template and resample the facemask onto
+            the others with the saved registration.
+        pydeface_downsample (float): If non-zero, the voxel size in millimetres of a
+            downsampled copy of each NIfTI registered in place of the full resolution
+            NIfTI; the facemask is still applied at full resolution.
+        pydeface_select (bool): If true, skip NIfTIs matching the selection policy
+            (see selection.select_niftis), e.g., 4D, diffusion and localizer images.
+        pydeface_skip_series_pattern (str): Case-insensitive regular expression for
+            the SeriesDescription or ProtocolName of NIfTIs to skip.
+        pydeface_min_fov (float): The minimum field of view in millimetres along
+            every axis of NIfTIs to deface.
+        pydeface_engine (str): 'cli' to start the PyDeface executable for each
+            NIfTI; 'worker' to call the PyDeface Python API in a single long-lived
+            worker process, with the PyDeface executable as fallback.
+        cache_dir (str): If set, the absolute path to a persistent cache directory
+            for the preprocessed template and facemask.
+        cache_max_size (int): The maximum cache size in bytes.
+        dcm2niix_input_dir (str): The absolute path to the set of dicoms converted;
+            used to look up the FrameOfReferenceUID of each NIfTI.
+
+    Returns:
+        skipped_files (dict): The paths to NIfTI files not defaced, with the reason;
+            replaces input NIfTI with defaced version.
+
+    """
+    with deface_session(
+        pydeface_cost=pydeface_cost,
+        template=template,
+        facemask=facemask,
+        pydeface_nocleanup=pydeface_nocleanup,
+        pydeface_verbose=pydeface_verbose,
+        pydeface_reuse_registration=pydeface_reuse_registration,
+        pydeface_downsample=pydeface_downsample,
+        pydeface_select=pydeface_select,
+        pydeface_skip_series_pattern=pydeface_skip_series_pattern,
+        pydeface_min_fov=pydeface_min_fov,
+        pydeface_engine=pydeface_engine,
+        cache_dir=cache_dir,
+        cache_max_size=cache_max_size,
+    ) as deface:
+        # Skip the NIfTIs defaced before the job was restarted
+        resumed = [
+            file
+            for file in nifti_files
+            if checkpoint.completed(f"pydeface {file}") is not None
+        ]
+        if resumed:
+            log.info(f"{len(resumed)} NIfTIs defaced before the restart. Skipping.")
+
+        def record(group):
+            for file in group:
+                checkpoint.record(f"pydeface {file}", files=defaced_files(file))
+
+        return deface(
+            [file for file in nifti_files if file not in resumed],
+            dcm2niix_input_dir=dcm2niix_input_dir,
+            defaced=record if checkpoint.enabled() else None,
+        )
+
+
+def defaced_files(nifti_file):
+    """Return the defaced NIfTI file with the PyDeface intermediates kept beside it."""
+    stem = (
+        nifti_file[: -len(".nii.gz")] if nifti_file.endswith(".gz") else nifti_file[:-4]
+    )
+    return [nifti_file] + glob.glob(f"{glob.escape(stem)}_pydeface*")
+
+
+@contextlib.contextmanager
+def deface_session(
+    pydeface_cost="mutualinfo",
+    template=False,
+    facemask=False,
+    pydeface_nocleanup=False,
+    pydeface_verbose=False,
+    pydeface_reuse_registration=False,
+    pydeface_downsample=0,
+    pydeface_select=False,
+    pydeface_skip_series_pattern=selection.DEFAULT_SKIP_SERIES_PATTERN,
+    pydeface_min_fov=100,
+    pydeface_engine="cli",
+    cache_dir=None,
+    cache_max_size=None,
+):
+    """Set up the template and PyDeface engine once to deface batches of NIfTI files.
+
+        The arguments are those of deface_multiple_niftis. The yielded function
+        defaces a list of NIfTI files, e.g., the NIfTI files of one series as each
+        series is converted, and returns the NIfTI files not defaced, with the reason.
+
+    Yields:
+        deface (callable): Called with a list of NIfTI files and the optional
+            dcm2niix_input_dir, as deface_multiple_niftis, and an optional callable
+            called with each group of NIfTI files once defaced.
+
+    """
+    if cache_dir:
+        template, facemask = template_cache.cached_template(
+            template, facemask, cache_dir=cache_dir, cache_max_size=cache_max_size
+        )
+
+    if pydeface_engine == "worker":
+        deface_engine = engine.PyDefaceEngine(template=template, facemask=facemask)
+    else:
+        deface_engine = contextlib.nullcontext()
+
+    def deface(nifti_files, dcm2niix_input_dir=None, defaced=None):
+        skipped_files = {}
+        if pydeface_select:
+            nifti_files, skipped_files = selection.select_niftis(
+                nifti_files,
+                skip_series_pattern=pydeface_skip_series_pattern,
+                min_fov=pydeface_min_fov,
+            )
+
+        if pydeface_reuse_registration:
+            groups = group_by_frame_of_reference(nifti_files, dcm2niix_input_dir)
+        else:
+            groups = [[file] for file in nifti_files]
+
+        span_names = profiling.open_spans()
+
+        def deface_group(group):
+            profiling.attach(span_names)
+            deface_frame_of_reference(
+                group,
+                pydeface_cost=pydeface_cost,
+                template=template,
+                facemask=facemask,
+                pydeface_nocleanup=pydeface_nocleanup,
+                pydeface_verbose=pydeface_verbose,
+                pydeface_downsample=pydeface_downsample,
+                deface_engine=deface_engine if pydeface_engine == "worker" else None,
+                cache_dir=cache_dir,
+                cache_max_size=cache_max_size,
+            )
+
+        # Groups are defaced apart, as many at a time as the resource plan fits; the
+        # worker engine defaces one NIfTI at a time
+        workers = 1
+        if pydeface_engine != "worker":
+            workers = min(len(groups), planner.workers("pydeface")) or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(deface_group, group) for group in groups]
+            for group, future in zip(groups, futures):
+                future.result()
+                if defaced is not None:
+                    defaced(group)
+
+        return skipped_files
+
+    with deface_engine:
+        yield deface
+
+
+def deface_frame_of_reference(
+    nifti_files,
+    pydeface_cost="mutualinfo",
+    template=None,
+    facemask=None,
+    pydeface_nocleanup=False,
+    pydeface_verbose=False,
+    pydeface_downsample=0,
+    deface_engine=None,
+    cache_dir=None,
+    cache_max_size=None,
+):
+    """Run PyDeface on NIfTI files sharing a frame of reference.
+
+        The first NIfTI file is registered to the template. The registration is then
+        reused for the remaining files, for which the facemask is only resampled. If
+        the resampled facemask fails the sanity check, the file is registered in full.
+
+     Args:
+        nifti_files (list): The paths to NIfTI files to be defaced.
+        pydeface_cost (str): FSL-FLIRT cost function.
+        template (str): The absolute path to an optional template image.
+        facemask (str): The absolute path to an optional facemask image.
+        pydeface_nocleanup (bool): If true, do not clean up temporary files.
+        pydeface_verbose (bool): If true, show additional status prints.
+        pydeface_downsample (float): If non-zero, the voxel size in millimetres of
+            the downsampled copy registered to the template.
+        deface_engine (engine.PyDefaceEngine): If set, the PyDeface worker used
+            instead of the PyDeface executable.
+        cache_dir (str): If set, the absolute path to a persistent cache directory
+            for the preprocessed template.
+        cache_max_size (int): The maximum cache size in bytes.
 
     Returns:
         None; replaces input NIfTI with defaced version.
 
     """
-    for file in nifti_files:
+    reference = nifti_files[0]
+    with profiling.span("deface", file=Path(reference).name):
         deface_single_nifti(
-            file,
+            reference,
             pydeface_cost=pydeface_cost,
             template=template,
             facemask=facemask,
-            pydeface_nocleanup=pydeface_nocleanup,
+            pydeface_nocleanup=pydeface_nocleanup or len(nifti_files) > 1,
             pydeface_verbose=pydeface_verbose,
+            pydeface_downsample=pydeface_downsample,
+            deface_engine=deface_engine,
+            cache_dir=cache_dir,
+            cache_max_size=cache_max_size,
         )
 
+    if len(nifti_files) == 1:
+        return
+
+    reference = str(reference)
+    reference_mat = reference.replace(".gz", "").replace(".nii", "_pydeface.mat")
+    reference_mask = reference.replace(".gz", "").replace(
+        ".nii", "_pydeface_mask.nii.gz"
+    )
+    reference_img = nb.load(reference)
+    matrix = np.loadtxt(reference_mat)
+
+    for file in nifti_files[1:]:
+
+        with profiling.span("deface", file=Path(file).name) as record:
+            log.info(f"Reusing PyDeface registration of {reference} for {file}")
+            file_img = nb.load(str(file))
+            overlap = registration.fov_overlap(reference_img, file_img)
+
+            if overlap < registration.MIN_FOV_OVERLAP:
+                log.warning(
+                    f"Field of view overlap with the reference is {overlap:.1%}. "
+                    "Falling back to full registration."
+                )
+                success = False
+            else:
+                file_matrix = registration.convert_flirt_matrix(
+                    matrix, reference_img, file_img
+                )
+                success = registration.apply_registration(
+                    file,
+                    file_matrix,
+                    facemask=facemask,
+                    pydeface_nocleanup=pydeface_nocleanup,
+                )
+
+            record["reused_registration"] = success
+            if success:
+                log.info(f"Success. PyDeface registration reused for {file}.")
+            else:
+                deface_single_nifti(
+                    file,
+                    pydeface_cost=pydeface_cost,
+                    template=template,
+                    facemask=facemask,
+                    pydeface_nocleanup=pydeface_nocleanup,
+                    pydeface_verbose=pydeface_verbose,
+                    pydeface_downsample=pydeface_downsample,
+                    deface_engine=deface_engine,
+                    cache_dir=cache_dir,
+                    cache_max_size=cache_max_size,
+                )
+
+    if not pydeface_nocleanup:
+        os.remove(reference_mat)
+        os.remove(reference_mask)
+
+
+def group_by_frame_of_reference(nifti_files, dcm2niix_input_dir):
+    """Group NIfTI files by the FrameOfReferenceUID of their source series.
+
+        The series of each NIfTI file is identified by the SeriesNumber and
+        SeriesDescription in its BIDS sidecar. NIfTI files without a sidecar or a
+        matching dicom are placed in a group of their own.
+
+    Args:
+        nifti_files (list): The paths to NIfTI files to be defaced.
+        dcm2niix_input_dir (str): The absolute path to the set of dicoms converted.
+
+    Returns:
+        groups (list): Lists of NIfTI files, in input order, sharing a frame of
+            reference.
+
+    """
+    series_keys = {}
+    for file in nifti_files:
+        sidecar = str(file).replace(".gz", "").replace(".nii", ".json")
+        try:
+            with open(sidecar, encoding="utf-8") as sidecar_file:
+                sidecar_info = json.load(sidecar_file, strict=False)
+            series_keys[file] = (
+                str(sidecar_info.get("SeriesNumber", "")),
+                sidecar_info.get("SeriesDescription", ""),
+            )
+        except (FileNotFoundError, json.JSONDecodeError):
+            series_keys[file] = None
+
+    frames_of_reference = {}
+    if dcm2niix_input_dir:
+        wanted = set(key for key in series_keys.values() if key is not None)
+        for dicom in sorted(Path(dcm2niix_input_dir).rglob("*")):
+            if not wanted:
+                break
+            if dicom.is_dir():
+                continue
+            try:
+                header = pydicom.dcmread(
+                    str(dicom),
+                    stop_before_pixels=True,
+                    specific_tags=[
+                        "SeriesNumber",
+                        "SeriesDescription",
+                        "FrameOfReferenceUID",
+                    ],
+                )
+            except pydicom.errors.InvalidDicomError:
+                continue
+            key = (
+                str(header.get("SeriesNumber", "")),
+                str(header.get("SeriesDescription", "")).replace(" ", "_"),
+            )
+            if key in wanted and header.get("FrameOfReferenceUID"):
+                frames_of_reference[key] = str(header.FrameOfReferenceUID)
+                wanted.discard(key)
+
+    groups = {}
+    for file in nifti_files:
+        uid = frames_of_reference.get(series_keys[file])
+        groups.setdefault(uid or str(file), []).append(file)
+
+    log.info(
+        f"Found {len(groups)} frame(s) of reference across {len(nifti_files)} NIfTI files."
+    )
+
+    return list(groups.values())
+
 
 def deface_single_nifti(
     infile,
@@ -51,6 +396,10 @@ def deface_single_nifti(
     facemask=None,
     pydeface_nocleanup=False,
     pydeface_verbose=False,
+    pydeface_downsample=0,
+    deface_engine=None,
+    cache_dir=None,
+    cache_max_size=None,
 ):
     """Run PyDeface on a single of NIfTI file.
 
@@ -64,11 +413,38 @@ def deface_single_nifti(
             used instead of the default.
         pydeface_nocleanup (bool): If true, do not clean up temporary files.
         pydeface_verbose (bool): If true, show additional status prints.
+        pydeface_downsample (float): If non-zero, the voxel size in millimetres of
+            the downsampled copy registered to the template.
+        deface_engine (engine.PyDefaceEngine): If set, the PyDeface worker used
+            instead of the PyDeface executable, unless the worker is unavailable.
+        cache_dir (str): If set, the absolute path to a persistent cache directory
+            for the downsampled template.
+        cache_max_size (int): The maximum cache size in bytes.
 
     Returns:
         None; replaces input NIfTI with defaced version.
 
     """
+    if pydeface_downsample and deface_downsampled(
+        infile,
+        pydeface_downsample,
+        pydeface_cost=pydeface_cost,
+        template=template,
+        facemask=facemask,
+        pydeface_nocleanup=pydeface_nocleanup,
+        cache_dir=cache_dir,
+        cache_max_size=cache_max_size,
+    ):
+        return
+
+    if deface_engine is not None and deface_engine.deface(
+        infile,
+        pydeface_cost=pydeface_cost,
+        pydeface_nocleanup=pydeface_nocleanup,
+        pydeface_verbose=pydeface_verbose,
+    ):
+        return
+
     log.info(f"Running PyDeface on {infile}")
 
     command = ["pydeface"]
@@ -99,16 +475,10 @@ def deface_single_nifti(
     log.info(f"Command to be executed: \n\n{log_command}\n")
 
     try:
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-        )
-
-        log.info(f"Output from PyDeface: \n\n{process.stdout.read()}")
+        log.info("Output from PyDeface:")
+        process = processes.run(command, tool="pydeface", stream=True)
 
-        if process.wait() != 0:
+        if process.returncode != 0:
             log.error("Error defacing nifti using PyDeface. Exiting.")
             os.sys.exit(1)
 
@@ -117,3 +487,85 @@ def deface_single_nifti(
         os.sys.exit(1)
 
     log.info(f"Success. PyDeface completed on {infile}.")
+
+
+def deface_downsampled(
+    infile,
+    resolution,
+    pydeface_cost="mutualinfo",
+    template=None,
+    facemask=None,
+    pydeface_nocleanup=False,
+    cache_dir=None,
+    cache_max_size=None,
+):
+    """Deface a NIfTI file using the registration of a downsampled copy.
+
+        The template is registered to a block averaged copy of infile at the given
+        resolution. The registration is adjusted back to the native resolution, where
+        the facemask is resampled and applied.
+
+    Args:
+        infile (str): The absolute path to the input NIfTI file to be defaced.
+        resolution (float): The voxel size in millimetres of the downsampled copy.
+        pydeface_cost (str): FSL-FLIRT cost function.
+        template (str): The absolute path to an optional template image.
+        facemask (str): The absolute path to an optional facemask image.
+        pydeface_nocleanup (bool): If true, do not clean up temporary files.
+        cache_dir (str): If set, the absolute path to a persistent cache directory
+            where the template downsampled to the resolution is kept; otherwise, it
+            is downsampled for this registration.
+        cache_max_size (int): The maximum cache size in bytes.
+
+    Returns:
+        success (bool): False if infile is not finer than the resolution or the
+            resampled facemask failed the sanity check; infile is then unmodified.
+
+    """
+    infile_img = nb.load(str(infile))
+    downsampled_img = registration.downsample(infile_img, resolution)
+    if downsampled_img is None:
+        log.info(f"{infile} is not finer than {resolution} mm. Not downsampling.")
+        return False
+
+    log.info(
+        f"Running PyDeface on {infile} with registration downsampled to "
+        f"{downsampled_img.shape[:3]} voxels."
+    )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # The same downsampled template with and without a cache, which memoizes it
+        (
+            registration_template,
+            template_matrix,
+        ) = template_cache.cached_registration_template(
+            template,
+            resolution,
+            cache_dir=cache_dir,
+            cache_max_size=cache_max_size,
+            work_dir=tmpdir,
+        )
+
+        downsampled_file = os.path.join(tmpdir, "downsampled.nii.gz")
+        downsampled_img.to_filename(downsampled_file)
+        matrix = registration.register_template(
+            downsampled_file,
+            os.path.join(tmpdir, "template_reg.mat"),
+            template=registration_template,
+            pydeface_cost=pydeface_cost,
+        )
+        matrix = matrix @ template_matrix
+
+    success = registration.apply_registration(
+        infile,
+        registration.convert_flirt_matrix(matrix, downsampled_img, infile_img),
+        facemask=facemask,
+        pydeface_nocleanup=pydeface_nocleanup,
+    )
+
+    if success:
+        log.info(f"Success. PyDeface completed on {infile}.")
+    else:
+        log.warning("Falling back to full resolution registration.")
+
+    return success
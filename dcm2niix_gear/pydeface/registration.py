@@ -0,0 +1,230 @@
+"""Functions to register the PyDeface template and transfer FSL-FLIRT registrations."""
+
+import logging
+import os
+import shutil
+import tempfile
+
+import nibabel as nb
+import numpy as np
+from nipype.interfaces import fsl
+from pydeface.utils import initial_checks
+
+from dcm2niix_gear.utils import processes
+
+
+log = logging.getLogger(__name__)
+
+# Minimum fraction of the target field of view that must be covered by the reference
+# field of view before a reference registration is reused.
+MIN_FOV_OVERLAP = 0.5
+
+# Maximum fraction of the target voxels that the resampled facemask may remove before
+# the reused registration is considered to be wrong.
+MAX_MASKED_FRACTION = 0.5
+
+
+def vox2fsl(img):
+    """Return the voxel to FSL scaled-millimetre coordinate matrix of an image.
+
+        FSL-FLIRT matrices are expressed in scaled-voxel coordinates, where the
+        x-axis is flipped for images stored in neurological orientation (i.e., an
+        affine with a positive determinant).
+
+    Args:
+        img (nibabel.nifti1.Nifti1Image): The image to build the matrix for.
+
+    Returns:
+        matrix (numpy.ndarray): A 4x4 matrix mapping voxel to FSL coordinates.
+
+    """
+    zooms = img.header.get_zooms()[:3]
+    matrix = np.diag([zooms[0], zooms[1], zooms[2], 1.0])
+
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = img.shape[0] - 1
+        matrix = matrix @ flip
+
+    return matrix
+
+
+def convert_flirt_matrix(matrix, source_img, target_img):
+    """Convert a FLIRT matrix registered to source_img into one for target_img.
+
+        Both images must share a frame of reference (i.e., scanner coordinates), so
+        that their affines map voxels into the same world space.
+
+    Args:
+        matrix (numpy.ndarray): A 4x4 FLIRT matrix mapping the template to source_img.
+        source_img (nibabel.nifti1.Nifti1Image): The image registered with FLIRT.
+        target_img (nibabel.nifti1.Nifti1Image): The image to transfer the
+            registration to.
+
+    Returns:
+        matrix (numpy.ndarray): A 4x4 FLIRT matrix mapping the template to target_img.
+
+    """
+    source_fsl2world = source_img.affine @ np.linalg.inv(vox2fsl(source_img))
+    world2target_fsl = vox2fsl(target_img) @ np.linalg.inv(target_img.affine)
+
+    return world2target_fsl @ source_fsl2world @ matrix
+
+
+def downsample(img, resolution):
+    """Downsample an image to approximately the given resolution by block averaging.
+
+        Each axis is reduced by an integer factor, so that the centre of each block
+        in the downsampled image maps to the centre of the averaged voxels. Trailing
+        voxels which do not fill a block are dropped. For 4D images, only the first
+        volume is downsampled.
+
+    Args:
+        img (nibabel.nifti1.Nifti1Image): The image to downsample.
+        resolution (float): The target voxel size in millimetres.
+
+    Returns:
+        downsampled_img (nibabel.nifti1.Nifti1Image): The downsampled image, or None
+            if the image is already at or above the target resolution.
+
+    """
+    zooms = img.header.get_zooms()[:3]
+    factors = [max(1, int(round(resolution / zoom))) for zoom in zooms]
+    if factors == [1, 1, 1]:
+        return None
+
+    data = np.asanyarray(img.dataobj)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3] + (-1,))[..., 0]
+
+    shape = [size // factor for size, factor in zip(data.shape, factors)]
+    blocks = data[
+        : shape[0] * factors[0], : shape[1] * factors[1], : shape[2] * factors[2]
+    ].reshape(shape[0], factors[0], shape[1], factors[1], shape[2], factors[2])
+    downsampled = blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+
+    scaling = np.diag(factors + [1]).astype(float)
+    scaling[:3, 3] = [(factor - 1) / 2 for factor in factors]
+
+    return nb.Nifti1Image(downsampled, img.affine @ scaling)
+
+
+def register_template(infile, matrix_file, template=None, pydeface_cost="mutualinfo"):
+    """Register the template to infile with FSL-FLIRT and save the matrix.
+
+    Args:
+        infile (str): The absolute path to the NIfTI file used as the reference.
+        matrix_file (str): The absolute path to the FLIRT matrix to create.
+        template (str): The absolute path to an optional template image that will be
+            used as the registration target instead of the default.
+        pydeface_cost (str): FSL-FLIRT cost function.
+
+    Returns:
+        matrix (numpy.ndarray): A 4x4 FLIRT matrix mapping the template to infile.
+
+    """
+    template, _ = initial_checks(template or None, None)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        flirt = fsl.FLIRT()
+        flirt.inputs.cost_func = pydeface_cost
+        flirt.inputs.in_file = str(template)
+        flirt.inputs.out_matrix_file = str(matrix_file)
+        flirt.inputs.out_file = os.path.join(tmpdir, "template_reg.nii.gz")
+        flirt.inputs.output_type = "NIFTI_GZ"
+        flirt.inputs.reference = str(infile)
+        processes.run_interface(flirt, tool="flirt")
+
+    return np.loadtxt(matrix_file)
+
+
+def fov_overlap(source_img, target_img):
+    """Fraction of the target field of view (world bounding box) inside the source."""
+
+    def bounding_box(img):
+        corners = np.array(
+            [
+                [i, j, k, 1]
+                for i in (0, img.shape[0] - 1)
+                for j in (0, img.shape[1] - 1)
+                for k in (0, img.shape[2] - 1)
+            ]
+        ).T
+        world = (img.affine @ corners)[:3]
+        return world.min(axis=1), world.max(axis=1)
+
+    source_min, source_max = bounding_box(source_img)
+    target_min, target_max = bounding_box(target_img)
+
+    extent = np.clip(
+        np.minimum(source_max, target_max) - np.maximum(source_min, target_min), 0, None
+    )
+    target_extent = np.clip(target_max - target_min, 1e-6, None)
+
+    return float(np.prod(extent / target_extent))
+
+
+def apply_registration(infile, matrix, facemask=None, pydeface_nocleanup=False):
+    """Resample the facemask onto infile with an existing FLIRT matrix and deface.
+
+    Args:
+        infile (str): The absolute path to the NIfTI file to be defaced.
+        matrix (numpy.ndarray): A 4x4 FLIRT matrix mapping the template to infile.
+        facemask (str): The absolute path to an optional facemask image that will be
+            used instead of the default.
+        pydeface_nocleanup (bool): If true, the matrix and resampled facemask are
+            retained next to infile, with the same names as produced by PyDeface.
+
+    Returns:
+        success (bool): False if the resampled facemask failed the sanity check,
+            in which case infile has not been modified.
+
+    """
+    _, facemask = initial_checks(None, facemask or None)
+    infile = str(infile)
+    unclean_mask = infile.replace(".gz", "").replace(".nii", "_pydeface_mask.nii.gz")
+    unclean_mat = infile.replace(".gz", "").replace(".nii", "_pydeface.mat")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        matrix_file = os.path.join(tmpdir, "template_reg.mat")
+        np.savetxt(matrix_file, matrix, fmt="%.10f")
+        warped_mask = os.path.join(tmpdir, "warped_mask.nii.gz")
+
+        flirt = fsl.FLIRT()
+        flirt.inputs.in_file = str(facemask)
+        flirt.inputs.in_matrix_file = matrix_file
+        flirt.inputs.apply_xfm = True
+        flirt.inputs.reference = infile
+        flirt.inputs.out_file = warped_mask
+        flirt.inputs.output_type = "NIFTI_GZ"
+        flirt.inputs.out_matrix_file = os.path.join(tmpdir, "warped_mask.mat")
+        processes.run_interface(flirt, tool="flirt")
+
+        infile_img = nb.load(infile)
+        mask_data = np.asarray(nb.load(warped_mask).dataobj)
+
+        masked_fraction = 1.0 - float(np.count_nonzero(mask_data)) / mask_data.size
+        if masked_fraction == 0.0 or masked_fraction > MAX_MASKED_FRACTION:
+            log.warning(
+                f"Resampled facemask removes {masked_fraction:.1%} of {infile}; "
+                "unexpected for a shared registration."
+            )
+            return False
+
+        infile_data = np.asarray(infile_img.dataobj)
+        if infile_data.ndim > mask_data.ndim:
+            mask_data = mask_data.reshape(
+                mask_data.shape + (1,) * (infile_data.ndim - mask_data.ndim)
+            )
+        outdata = infile_data * mask_data
+
+        defaced_img = nb.Nifti1Image(outdata, infile_img.affine, infile_img.header)
+        defaced_img.to_filename(infile)
+
+        if pydeface_nocleanup:
+            shutil.move(warped_mask, unclean_mask)
+            shutil.move(matrix_file, unclean_mat)
+
+    return True
@@ -0,0 +1,101 @@
+"""Functions to select which NIfTI files are defaced with PyDeface."""
+
+import json
+import logging
+import re
+
+import nibabel as nb
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SKIP_SERIES_PATTERN = (
+    "localizer|localiser|scout|survey|calibration|field_?map|b0_?map|dwi|dti|diffusion"
+)
+
+SKIP_IMAGE_TYPES = ["LOCALIZER", "FIELDMAP", "DIFFUSION"]
+
+
+def select_niftis(
+    nifti_files, skip_series_pattern=DEFAULT_SKIP_SERIES_PATTERN, min_fov=100
+):
+    """Select the NIfTI files to deface according to the PyDeface selection policy.
+
+        A NIfTI file is skipped if any of the following applies:
+        (1) it has more than three dimensions (e.g., fMRI),
+        (2) it has an associated bval file (i.e., diffusion),
+        (3) the ImageType of its BIDS sidecar contains LOCALIZER, FIELDMAP or DIFFUSION,
+        (4) the SeriesDescription or ProtocolName of its BIDS sidecar matches
+            skip_series_pattern, or
+        (5) its field of view is smaller than min_fov along any axis, such that the
+            face is unlikely to be covered.
+
+    Args:
+        nifti_files (list): The paths to NIfTI files considered for defacing.
+        skip_series_pattern (str): Case-insensitive regular expression for the
+            SeriesDescription or ProtocolName of NIfTI files to skip.
+        min_fov (float): The minimum field of view in millimetres along every axis.
+
+    Returns:
+        selected_files (list): The paths to NIfTI files to deface.
+        skipped_files (dict): The paths to NIfTI files skipped, with the reason.
+
+    """
+    selected_files = []
+    skipped_files = {}
+
+    for file in nifti_files:
+        reason = skip_reason(file, skip_series_pattern, min_fov)
+        if reason:
+            log.info(f"Skipping PyDeface on {file}: {reason}")
+            skipped_files[file] = reason
+        else:
+            selected_files.append(file)
+
+    log.info(
+        f"Selected {len(selected_files)} of {len(nifti_files)} NIfTI files for PyDeface."
+    )
+
+    return selected_files, skipped_files
+
+
+def skip_reason(nifti_file, skip_series_pattern, min_fov):
+    """Return the reason to skip defacing a NIfTI file, or None to deface it."""
+    stem = str(nifti_file).replace(".gz", "").replace(".nii", "")
+
+    img = nb.load(str(nifti_file))
+    if len([size for size in img.shape if size > 1]) > 3:
+        return f"{len(img.shape)}D image with shape {img.shape}"
+
+    for bval in [f"{stem}.bval", f"{stem}.bvals"]:
+        try:
+            with open(bval):
+                return "diffusion image with bval file"
+        except FileNotFoundError:
+            continue
+
+    try:
+        with open(f"{stem}.json", encoding="utf-8") as sidecar_file:
+            sidecar_info = json.load(sidecar_file, strict=False)
+    except (FileNotFoundError, json.JSONDecodeError):
+        sidecar_info = {}
+
+    image_type = [str(value).upper() for value in sidecar_info.get("ImageType", [])]
+    for skip_image_type in SKIP_IMAGE_TYPES:
+        if skip_image_type in image_type:
+            return f"ImageType contains {skip_image_type}"
+
+    if skip_series_pattern:
+        for field in ["SeriesDescription", "ProtocolName"]:
+            value = str(sidecar_info.get(field, ""))
+            if re.search(skip_series_pattern, value, flags=re.IGNORECASE):
+                return f"{field} '{value}' matches '{skip_series_pattern}'"
+
+    shape = (tuple(img.shape) + (1, 1, 1))[:3]
+    zooms = (tuple(img.header.get_zooms()) + (1, 1, 1))[:3]
+    fov = np.abs(np.array(zooms) * np.array(shape))
+    if min_fov and np.any(fov < min_fov):
+        return f"field of view {np.round(fov, 1).tolist()} mm below {min_fov} mm"
+
+    return None
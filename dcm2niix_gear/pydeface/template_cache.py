@@ -0,0 +1,133 @@
+"""Functions to cache the preprocessed PyDeface template and facemask across jobs."""
+
+import gzip
+import json
+import logging
+import os
+import shutil
+
+import nibabel as nb
+import numpy as np
+from pydeface.utils import initial_checks
+
+from dcm2niix_gear.pydeface import registration
+from dcm2niix_gear.utils import cache
+
+
+log = logging.getLogger(__name__)
+
+NAMESPACE = "pydeface_template"
+
+
+def cached_template(template=None, facemask=None, cache_dir=None, cache_max_size=None):
+    """Return local, uncompressed copies of the template and facemask from the cache.
+
+        Each image is cached by the hash of its contents, along with its header
+        (shape, voxel sizes, affine and FSL coordinate matrix). FLIRT then reads
+        an uncompressed local copy instead of decompressing the input for every
+        registration.
+
+    Args:
+        template (str): The absolute path to an optional template image; the PyDeface
+            default template if not set.
+        facemask (str): The absolute path to an optional facemask image; the PyDeface
+            default facemask if not set.
+        cache_dir (str): The absolute path to the cache directory.
+        cache_max_size (int): The maximum cache size in bytes.
+
+    Returns:
+        template (str): The absolute path to the cached template.
+        facemask (str): The absolute path to the cached facemask.
+
+    """
+    template, facemask = initial_checks(template or None, facemask or None)
+
+    return (
+        cached_image(str(template), cache_dir, cache_max_size),
+        cached_image(str(facemask), cache_dir, cache_max_size),
+    )
+
+
+def cached_image(image, cache_dir, cache_max_size=None):
+    """Return the path to the uncompressed cached copy of an image."""
+
+    def create(entry):
+        open_image = gzip.open if image.endswith(".gz") else open
+        with open_image(image, "rb") as source, open(
+            os.path.join(entry, "image.nii"), "wb"
+        ) as target:
+            shutil.copyfileobj(source, target)
+        write_header(nb.load(image), entry)
+
+    entry = cache.get_or_create(
+        cache_dir, NAMESPACE, cache.file_hash(image), create, max_size=cache_max_size
+    )
+
+    return os.path.join(entry, "image.nii")
+
+
+def cached_registration_template(
+    template, resolution, cache_dir=None, cache_max_size=None, work_dir=None
+):
+    """Return the template downsampled to a registration resolution from the cache.
+
+        A template registered at the resolution of a downsampled NIfTI takes less
+        time to register than the full template. The cache entry also stores the
+        matrix to convert a FLIRT matrix of the downsampled template back to one of
+        the full template, so that the full facemask can be applied. Without a
+        cache, the same downsampled template is written to work_dir.
+
+    Args:
+        template (str): The absolute path to the template image.
+        resolution (float): The voxel size in millimetres of the downsampled template.
+        cache_dir (str): The absolute path to the cache directory; None to not cache.
+        cache_max_size (int): The maximum cache size in bytes.
+        work_dir (str): The absolute path to a directory for the downsampled
+            template, if cache_dir is not set.
+
+    Returns:
+        registration_template (str): The absolute path to the downsampled template,
+            or the template itself if it is not finer than the resolution.
+        template_matrix (numpy.ndarray): A 4x4 matrix mapping FSL coordinates of the
+            template to FSL coordinates of the downsampled template.
+
+    """
+    template, _ = initial_checks(template or None, None)
+
+    def create(entry):
+        img = nb.load(str(template))
+        downsampled_img = registration.downsample(img, resolution)
+        if downsampled_img is None:
+            downsampled_img = img
+        downsampled_img.to_filename(os.path.join(entry, "image.nii"))
+        write_header(downsampled_img, entry)
+
+        # Maps FSL coordinates of the template to those of the downsampled template
+        matrix = registration.convert_flirt_matrix(np.eye(4), img, downsampled_img)
+        np.savetxt(os.path.join(entry, "template.mat"), matrix, fmt="%.10f")
+
+    if cache_dir:
+        key = f"{cache.file_hash(str(template))}_{float(resolution)}mm"
+        entry = cache.get_or_create(
+            cache_dir, NAMESPACE, key, create, max_size=cache_max_size
+        )
+    else:
+        entry = work_dir
+        create(entry)
+
+    return (
+        os.path.join(entry, "image.nii"),
+        np.loadtxt(os.path.join(entry, "template.mat")),
+    )
+
+
+def write_header(img, entry):
+    """Write the header information of a cached image as JSON."""
+    header = {
+        "shape": [int(size) for size in img.shape],
+        "zooms": [float(zoom) for zoom in img.header.get_zooms()],
+        "affine": img.affine.tolist(),
+        "vox2fsl": registration.vox2fsl(img).tolist(),
+    }
+    with open(os.path.join(entry, "header.json"), "w") as header_file:
+        json.dump(header, header_file)
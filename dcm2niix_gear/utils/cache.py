@@ -0,0 +1,241 @@
+"""Functions to manage a persistent on-disk cache shared by gear jobs on one host."""
+
+import contextlib
+import fcntl
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+
+log = logging.getLogger(__name__)
+
+LOCK_FILE = ".lock"
+
+# Directory of the lock files by which jobs pin the cache entries they use
+PIN_DIR = ".pins"
+
+# Entries still being created after this many seconds are left from a killed job
+STALE_CREATE_SECONDS = 24 * 60 * 60
+
+# The open pin files of the entries pinned until release_pins, by entry
+_pins = {}
+
+
+def file_hash(path, chunk_size=2**22):
+    """Return the sha256 hex digest of the contents of a file."""
+    stat = os.stat(path)
+    return _file_hash(os.path.abspath(path), stat.st_size, stat.st_mtime_ns, chunk_size)
+
+
+@functools.lru_cache(maxsize=None)
+def _file_hash(path, size, mtime, chunk_size):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file_obj:
+        for chunk in iter(lambda: file_obj.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def locked(cache_dir):
+    """Hold an exclusive lock on the cache directory, across processes."""
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, LOCK_FILE), "a") as lock_obj:
+        fcntl.flock(lock_obj, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_obj, fcntl.LOCK_UN)
+
+
+def get_entry(cache_dir, namespace, key):
+    """Return the path to a cache entry directory, or None if it is not cached.
+
+        The entry is not pinned, so may be evicted by another job; use pinned or pin
+        to read it.
+
+    """
+    entry = os.path.join(cache_dir, namespace, key)
+    if not os.path.isdir(entry):
+        return None
+
+    # Mark as recently used for eviction
+    os.utime(entry)
+    return entry
+
+
+def pin_file(cache_dir, namespace, key):
+    """Return the path to the lock file pinning a cache entry."""
+    pin_dir = os.path.join(cache_dir, PIN_DIR, namespace)
+    os.makedirs(pin_dir, exist_ok=True)
+    return os.path.join(pin_dir, key)
+
+
+@contextlib.contextmanager
+def pinned(cache_dir, namespace, key):
+    """Pin a cache entry while it is in use, so that no job evicts it.
+
+        A pin is a shared lock on the lock file of the entry; evict only removes an
+        entry it can lock exclusively. The entry is looked up once pinned, as it may
+        have been evicted before.
+
+    Args:
+        cache_dir (str): The absolute path to the cache directory.
+        namespace (str): The cache subdirectory of the entry.
+        key (str): The cache key, unique within the namespace.
+
+    Yields:
+        entry (str): The absolute path to the cache entry directory; None if it is
+            not cached.
+
+    """
+    with open(pin_file(cache_dir, namespace, key), "a") as pin_obj:
+        fcntl.flock(pin_obj, fcntl.LOCK_SH)
+        try:
+            yield get_entry(cache_dir, namespace, key)
+        finally:
+            fcntl.flock(pin_obj, fcntl.LOCK_UN)
+
+
+def pin(cache_dir, namespace, key):
+    """Pin a cache entry until release_pins, e.g., for files read by later stages.
+
+    Returns:
+        entry (str): The absolute path to the cache entry directory; None if it is
+            not cached.
+
+    """
+    pin_obj = open(pin_file(cache_dir, namespace, key), "a")
+    fcntl.flock(pin_obj, fcntl.LOCK_SH)
+
+    entry = get_entry(cache_dir, namespace, key)
+    if entry is None or entry in _pins:
+        pin_obj.close()
+    else:
+        _pins[entry] = pin_obj
+
+    return entry
+
+
+def release_pins():
+    """Release the pins of pin, e.g., between inputs converted by the batch runner."""
+    for pin_obj in _pins.values():
+        pin_obj.close()
+    _pins.clear()
+
+
+def get_or_create(cache_dir, namespace, key, create, max_size=None):
+    """Return the path to a cache entry directory, creating it if it is not cached.
+
+        The entry is created in a temporary directory within the cache and renamed
+        into place, so concurrent jobs never see a partial entry. If two jobs create
+        the same entry, the first one renamed into place is kept.
+
+    Args:
+        cache_dir (str): The absolute path to the cache directory.
+        namespace (str): The cache subdirectory for this kind of entry.
+        key (str): The cache key, unique within the namespace.
+        create (callable): Called with the path to an empty directory to populate.
+        max_size (int): If set, the maximum cache size in bytes enforced after
+            creating the entry.
+
+    Returns:
+        entry (str): The absolute path to the populated cache entry directory, pinned
+            until release_pins.
+
+    """
+    entry = pin(cache_dir, namespace, key)
+    if entry:
+        log.info(f"Cache hit for {namespace}/{key}.")
+        return entry
+
+    log.info(f"Cache miss for {namespace}/{key}. Creating cache entry.")
+    entry = os.path.join(cache_dir, namespace, key)
+    os.makedirs(os.path.join(cache_dir, namespace), exist_ok=True)
+    tmp_entry = tempfile.mkdtemp(
+        prefix=f".{key}.", dir=os.path.join(cache_dir, namespace)
+    )
+
+    try:
+        create(tmp_entry)
+        # Pinned under the cache lock, so that it is not evicted once renamed
+        with locked(cache_dir):
+            if os.path.isdir(entry):
+                shutil.rmtree(tmp_entry)
+            else:
+                os.rename(tmp_entry, entry)
+            pin(cache_dir, namespace, key)
+    except BaseException:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        raise
+
+    if max_size:
+        evict(cache_dir, max_size, keep=[entry])
+
+    return entry
+
+
+def directory_size(path):
+    """Return the total size in bytes of the files under a directory."""
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except FileNotFoundError:
+                continue
+    return size
+
+
+def evict(cache_dir, max_size, keep=()):
+    """Remove least recently used cache entries until the cache fits max_size bytes.
+
+        Entries pinned by a job, including this one, are in use and not removed.
+
+    Args:
+        cache_dir (str): The absolute path to the cache directory.
+        max_size (int): The maximum cache size in bytes.
+        keep (list): The absolute paths to cache entries never to remove.
+
+    Returns:
+        None
+
+    """
+    with locked(cache_dir):
+        entries = []
+        for namespace in os.listdir(cache_dir):
+            namespace_dir = os.path.join(cache_dir, namespace)
+            if namespace.startswith(".") or not os.path.isdir(namespace_dir):
+                continue
+            for key in os.listdir(namespace_dir):
+                entry = os.path.join(namespace_dir, key)
+                if key.startswith("."):
+                    if time.time() - os.stat(entry).st_mtime > STALE_CREATE_SECONDS:
+                        shutil.rmtree(entry, ignore_errors=True)
+                    continue
+                entries.append(
+                    (os.stat(entry).st_mtime, namespace, key, directory_size(entry))
+                )
+
+        total_size = sum(size for _, _, _, size in entries)
+        for _, namespace, key, size in sorted(entries):
+            entry = os.path.join(cache_dir, namespace, key)
+            if total_size <= max_size:
+                break
+            if entry in keep:
+                continue
+            with open(pin_file(cache_dir, namespace, key), "a") as pin_obj:
+                try:
+                    fcntl.flock(pin_obj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    log.info(f"Cache entry {entry} is in use. Not evicted.")
+                    continue
+                log.info(f"Evicting cache entry {entry} ({size} bytes).")
+                shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+
+        log.debug(f"Cache size after eviction: {total_size} bytes.")
@@ -0,0 +1,258 @@
+"""Functions to journal the completed stages of a job and resume them after a restart."""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from dcm2niix_gear.utils import cache
+
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = ".checkpoint"
+JOURNAL_FILENAME = "journal.json"
+
+# The journal of the current job, from the last call to load
+_journal = {}
+
+
+def job_key(prepare_args, config):
+    """Return the key of a job, the hash of its input files and gear config."""
+    inputs = []
+    for infile in [prepare_args["infile"], prepare_args.get("rec_infile")]:
+        if infile:
+            inputs.append([os.path.basename(infile), cache.file_hash(str(infile))])
+
+    key_info = {"inputs": inputs, "config": config}
+
+    return hashlib.sha256(
+        json.dumps(key_info, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def load(work_dir, key, keep=()):
+    """Load the journal of the work directory, keeping the stages that verify.
+
+        A stage is kept if the files it recorded still have the hashes recorded by
+        the last stage that changed them, and the directories it recorded the same
+        number and size of files, and so do the stages before it. Files and
+        directories the gear created in the work directory and not recorded by a
+        kept stage, e.g., the partial outputs of a stage interrupted by preemption,
+        are removed; those in the work directory before the journal was started are
+        not. The journal of another input or gear config, or that cannot be read,
+        is discarded without removing any file.
+
+    Args:
+        work_dir (str): The absolute path to the persisted work directory.
+        key (str): The key of the job, from job_key.
+        keep (list): The absolute paths never removed, e.g., the cache directory.
+
+    Returns:
+        None
+
+    """
+    journal_file = os.path.join(work_dir, CHECKPOINT_DIR, JOURNAL_FILENAME)
+    journal = None
+    if os.path.exists(journal_file):
+        try:
+            with open(journal_file) as journal_obj:
+                journal = json.load(journal_obj)
+            if journal["key"] != key:
+                log.info("Checkpoint journal is of another input or config. Discarded.")
+                journal = None
+        except (json.JSONDecodeError, KeyError):
+            log.warning("Unable to read the checkpoint journal. Discarded.")
+            journal = None
+
+    stages = journal["stages"] if journal else []
+    kept = verified_stages(stages)
+    if len(kept) < len(stages):
+        log.info(
+            f"Checkpoint: {len(stages) - len(kept)} stages not verified. Repeating."
+        )
+    for stage in kept:
+        log.info(f"Checkpoint: stage {stage['stage']} completed before the restart.")
+
+    # The entries of the work directory before the first run of the job are not
+    # created by the gear, so are never removed
+    if journal:
+        existing = journal.get("existing", [])
+    else:
+        existing = sorted(
+            name for name in os.listdir(work_dir) if name != CHECKPOINT_DIR
+        )
+
+    _journal.clear()
+    _journal.update(
+        {"key": key, "work_dir": work_dir, "stages": kept, "existing": existing}
+    )
+
+    if journal:
+        kept_paths = [os.path.join(work_dir, name) for name in existing]
+        remove_stale_files(work_dir, kept, keep=kept_paths + list(keep))
+    write()
+
+
+def enabled():
+    """Return true if the stages of the current job are journaled."""
+    return bool(_journal)
+
+
+def completed(stage):
+    """Return the result recorded by a completed stage, or None if not completed."""
+    for entry in _journal.get("stages", []):
+        if entry["stage"] == stage:
+            return entry["result"]
+
+    return None
+
+
+def record(stage, files=(), directories=(), removed=(), result=None):
+    """Record a completed stage, with the hashes of the files it produced or changed.
+
+    Args:
+        stage (str): The name of the stage.
+        files (list): The absolute paths to the files the stage produced or changed.
+        directories (list): The absolute paths to the directories the stage produced;
+            recorded by the number and size of their files, rather than hashed.
+        removed (list): The absolute paths to the files or directories the stage
+            removed, e.g., a staged input no longer needed.
+        result (dict): The JSON serializable result of the stage, returned by
+            completed when the job is restarted.
+
+    Returns:
+        None
+
+    """
+    if not _journal:
+        return
+
+    entry = {
+        "stage": stage,
+        "files": {
+            **{os.path.abspath(file): cache.file_hash(file) for file in files},
+            # A removed path is expected to stay absent
+            **{os.path.abspath(path): None for path in removed},
+        },
+        "directories": {
+            os.path.abspath(directory): directory_signature(directory)
+            for directory in directories
+        },
+        # Copied, as the lists of outputs are extended by later stages
+        "result": json.loads(json.dumps(result if result is not None else {})),
+    }
+    _journal["stages"] = [
+        recorded for recorded in _journal["stages"] if recorded["stage"] != stage
+    ]
+    _journal["stages"].append(entry)
+    write()
+
+
+def reset():
+    """Clear the journal, e.g., between inputs converted by the batch runner."""
+    _journal.clear()
+
+
+def write():
+    """Write the journal atomically, so that preemption leaves a complete journal."""
+    checkpoint_dir = os.path.join(_journal["work_dir"], CHECKPOINT_DIR)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    journal_file = os.path.join(checkpoint_dir, JOURNAL_FILENAME)
+
+    with open(f"{journal_file}.tmp", "w") as journal_obj:
+        json.dump(
+            {
+                "key": _journal["key"],
+                "existing": _journal["existing"],
+                "stages": _journal["stages"],
+            },
+            journal_obj,
+            indent=4,
+        )
+        journal_obj.flush()
+        os.fsync(journal_obj.fileno())
+    os.replace(f"{journal_file}.tmp", journal_file)
+
+
+def verified_stages(stages):
+    """Return the leading stages whose recorded files and directories verify."""
+    while True:
+        # The expected state of each path is that recorded by the last stage
+        expected = {}
+        first_stage = {}
+        for index, stage in enumerate(stages):
+            for path, state in {**stage["files"], **stage["directories"]}.items():
+                expected[path] = state
+                first_stage.setdefault(path, index)
+
+        end = len(stages)
+        for path, state in expected.items():
+            if first_stage[path] < end and current_state(path, state) != state:
+                end = first_stage[path]
+
+        if end == len(stages):
+            return stages
+        stages = stages[:end]
+
+
+def current_state(path, recorded_state):
+    """Return the hash of a file, or signature of a directory, as recorded."""
+    try:
+        if isinstance(recorded_state, list):
+            return directory_signature(path)
+        return cache.file_hash(path)
+    except OSError:
+        return None
+
+
+def directory_signature(directory):
+    """Return the number and total size of the files in a directory."""
+    if not os.path.isdir(directory):
+        raise FileNotFoundError(directory)
+
+    files = 0
+    size = 0
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, filename))
+
+    return [files, size]
+
+
+def remove_stale_files(work_dir, stages, keep=()):
+    """Remove the files and directories in work_dir not recorded by the stages.
+
+    Args:
+        work_dir (str): The absolute path to the persisted work directory.
+        stages (list): The stages kept, whose recorded paths are not removed.
+        keep (list): The absolute paths not removed, nor the directories holding
+            them.
+
+    Returns:
+        None
+
+    """
+    recorded = set()
+    for stage in stages:
+        recorded.update(stage["files"])
+        recorded.update(stage["directories"])
+    recorded.update(os.path.abspath(path) for path in keep if path)
+
+    removed = 0
+    for name in os.listdir(work_dir):
+        path = os.path.abspath(os.path.join(work_dir, name))
+        if name == CHECKPOINT_DIR or path in recorded:
+            continue
+        if any(file.startswith(path + os.sep) for file in recorded):
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        removed += 1
+
+    if removed:
+        log.info(f"Checkpoint: removed {removed} files of stages not completed.")
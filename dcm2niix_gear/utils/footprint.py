@@ -0,0 +1,122 @@
+"""Functions to track the disk footprint of the work directory and release inputs."""
+
+import logging
+import os
+import shutil
+
+from dcm2niix_gear.utils import metadata
+from dcm2niix_gear.utils import profiling
+
+
+log = logging.getLogger(__name__)
+
+# The footprint of the current job, from the last call to start
+_footprint = {}
+
+
+def start(work_dir):
+    """Start tracking the disk footprint of the work directory."""
+    _footprint.clear()
+    _footprint.update(
+        {"work_dir": work_dir, "peak_bytes": 0, "peak_stage": None, "samples": []}
+    )
+    sample("start")
+
+
+def sample(stage):
+    """Record the disk use of the work directory after a stage, and the peak.
+
+    Args:
+        stage (str): The name of the stage just completed.
+
+    Returns:
+        used_bytes (int): The bytes allocated to the files of the work directory;
+            None if the footprint is not tracked.
+
+    """
+    if not _footprint:
+        return None
+
+    used_bytes = disk_usage(_footprint["work_dir"])
+    _footprint["samples"].append({"stage": stage, "bytes": used_bytes})
+    if used_bytes > _footprint["peak_bytes"]:
+        _footprint["peak_bytes"] = used_bytes
+        _footprint["peak_stage"] = stage
+    log.debug(f"Work directory uses {used_bytes / 1024 ** 2:.1f} MB after {stage}.")
+
+    return used_bytes
+
+
+def report():
+    """Log the peak disk use of the work directory and add it to the run profile."""
+    if not _footprint:
+        return
+
+    log.info(
+        f"Peak disk use of the work directory: "
+        f"{_footprint['peak_bytes'] / 1024 ** 2:.1f} MB, after "
+        f"{_footprint['peak_stage']}."
+    )
+    profiling.annotate(
+        "disk_usage",
+        {
+            "peak_bytes": _footprint["peak_bytes"],
+            "peak_stage": _footprint["peak_stage"],
+            "samples": list(_footprint["samples"]),
+        },
+    )
+
+
+def reset():
+    """Stop tracking, e.g., between inputs converted by the batch runner."""
+    _footprint.clear()
+
+
+def release_input(dcm2niix_input_dir, dicom_index=None):
+    """Capture the DICOM header index of the staged input, then delete the input.
+
+        The DICOM header index is all metadata capture reads from the DICOMs, so the
+        staged input is not needed once converted. Deleting it before coil
+        combination, PyDeface and resolve lowers the peak disk use from input,
+        outputs and intermediates together.
+
+    Args:
+        dcm2niix_input_dir (str): The absolute path to the staged input.
+        dicom_index (dict): The DICOM header index of the input, if already built.
+
+    Returns:
+        dicom_index (dict): The DICOM header index of the input, from
+            metadata.build_dicom_index.
+
+    """
+    if dicom_index is None:
+        with profiling.span("metadata"):
+            dicom_index = metadata.build_dicom_index(dcm2niix_input_dir)
+
+    released_bytes = disk_usage(dcm2niix_input_dir)
+    shutil.rmtree(dcm2niix_input_dir)
+    log.info(
+        f"Released the staged input of {released_bytes / 1024 ** 2:.1f} MB, "
+        f"keeping the DICOM header index of {len(dicom_index)} series."
+    )
+    sample("release_input")
+
+    return dicom_index
+
+
+def disk_usage(directory):
+    """Return the bytes allocated to the files in a directory, hardlinks once."""
+    used_bytes = 0
+    inodes = set()
+    for root, directories, files in os.walk(directory):
+        for name in directories + files:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) in inodes:
+                continue
+            inodes.add((stat.st_dev, stat.st_ino))
+            used_bytes += stat.st_blocks * 512
+
+    return used_bytes
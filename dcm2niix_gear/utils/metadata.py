@@ -9,6 +9,9 @@ from pathlib import Path
 
 import pydicom
 from pydicom.filereader import InvalidDicomError
+from pydicom.multival import MultiValue
+
+from dcm2niix_gear.utils import profiling
 
 
 log = logging.getLogger(__name__)
@@ -25,6 +28,8 @@ def generate(
     pydeface_intermediaries=False,
     classification=None,
     modality=None,
+    pydeface_skipped=None,
+    dicom_index=None,
 ):
     """Generate file metadata from dcm2niix output.
 
@@ -45,29 +50,37 @@ def generate(
             to dcm2niix.
         retain_sidecar (bool): If true, sidecar is retained in final output.
         retain_nifti (bool): If true, nifti is retained in final output.
-        output_nrrd (bool): If true, export as NRRD instead of NIfTI.
+        output_nrrd (bool): If true, NRRD is retained in final output; as well as
+            NIfTI, if retain_nifti is also true.
         pydeface_intermediaries (bool): If True, pydeface intermediary files are
             retained. The files created when --nocleanup flag is applied to the
             pydeface command.
         classification (dict): File classification, typically from gear config.
         modality (str): File modality, typically from gear config.
+        pydeface_skipped (dict): The absolute paths to NIfTI files not defaced by
+            PyDeface, with the reason; recorded as PyDefaceSkipped in the metadata.
+        dicom_index (dict): The DICOM header metadata of each series, from
+            build_dicom_index; used instead of scanning dcm2niix_input_dir, if set.
 
     Returns:
         metadata_file (str): The absolute path to the metadata file generated.
 
     """
-    metadata = capture(
-        output_image_files,
-        output_sidecar_files,
-        work_dir,
-        dcm2niix_input_dir=dcm2niix_input_dir,
-        retain_sidecar=retain_sidecar,
-        retain_nifti=retain_nifti,
-        output_nrrd=output_nrrd,
-        pydeface_intermediaries=pydeface_intermediaries,
-        classification=classification,
-        modality=modality,
-    )
+    with profiling.span("header_scan", files=len(output_sidecar_files or [])):
+        metadata = capture(
+            output_image_files,
+            output_sidecar_files,
+            work_dir,
+            dcm2niix_input_dir=dcm2niix_input_dir,
+            retain_sidecar=retain_sidecar,
+            retain_nifti=retain_nifti,
+            output_nrrd=output_nrrd,
+            pydeface_intermediaries=pydeface_intermediaries,
+            classification=classification,
+            modality=modality,
+            pydeface_skipped=pydeface_skipped,
+            dicom_index=dicom_index,
+        )
 
     metadata_file = create_file(metadata, work_dir)
 
@@ -89,6 +102,8 @@ def capture(
     pydeface_intermediaries=False,
     classification=None,
     modality=None,
+    pydeface_skipped=None,
+    dicom_index=None,
 ):
     """Capture file metadata for each dcm2niix output.
 
@@ -109,12 +124,17 @@ def capture(
             to dcm2niix.
         retain_sidecar (bool): If true, sidecar is retained in final output.
         retain_nifti (bool): If true, nifti is retained in final output.
-        output_nrrd (bool): If true, export as NRRD instead of NIfTI.
+        output_nrrd (bool): If true, NRRD is retained in final output; as well as
+            NIfTI, if retain_nifti is also true.
         pydeface_intermediaries (bool): If True, pydeface intermediary files are
             retained. The files created when --nocleanup flag is applied to the
             pydeface command.
         classification (dict): File classification, typically from gear config.
         modality (str): File modality, typically from gear config.
+        pydeface_skipped (dict): The absolute paths to NIfTI files not defaced by
+            PyDeface, with the reason; recorded as PyDefaceSkipped in the metadata.
+        dicom_index (dict): The DICOM header metadata of each series, from
+            build_dicom_index; used instead of scanning dcm2niix_input_dir, if set.
 
     Returns:
         metadata (dict): Structured metadata information for a given file set.
@@ -122,12 +142,11 @@ def capture(
     """
     log.info("Capturing metadata.")
 
-    if (retain_nifti and output_nrrd) or (
-        not retain_nifti and not output_nrrd and not retain_sidecar
-    ):
+    # NIfTI and NRRD are both retained with output_nifti_and_nrrd
+    if not retain_nifti and not output_nrrd and not retain_sidecar:
         log.critical(
-            "Function arguments retain_nifti and output_nrrd are exclusive. "
-            "Gear config logic is broken. Exiting."
+            "Function arguments retain_nifti, output_nrrd and retain_sidecar retain "
+            "no outputs. Gear config logic is broken. Exiting."
         )
         os.sys.exit(1)
 
@@ -161,7 +180,11 @@ def capture(
         # Using the unique set of SeriesDescription and SeriesNumber from the DICOM
         # header, capture additional metadata.
         dicom_data = {}
-        if dcm2niix_input_dir:
+        if dicom_index is not None:
+            log.info("Capturing additional metadata from the DICOM index.")
+            dicom_data = dicom_index.get(f"{series_number}/{series_description}", {})
+
+        elif dcm2niix_input_dir:
             log.info("Capturing additional metadata from DICOMs.")
 
             dicoms = [
@@ -239,8 +262,14 @@ def capture(
 
                 # NIfTI
                 if left in [".nii.gz", ".nii"]:
+                    file_metadata = metadata
+                    if pydeface_skipped and file in pydeface_skipped:
+                        file_metadata = {
+                            **metadata,
+                            "PyDefaceSkipped": pydeface_skipped[file],
+                        }
                     filedata = create_file_metadata(
-                        file, "nifti", classification, metadata, modality
+                        file, "nifti", classification, file_metadata, modality
                     )
                     capture_metadata.append(filedata)
 
@@ -419,6 +448,76 @@ def dicom_metadata_extraction(dicom_header):
     return dicom_data
 
 
+def build_dicom_index(dcm2niix_input_dir, files=None):
+    """Index the DICOM header metadata of each series in one pass over the DICOMs.
+
+        The index maps "SeriesNumber/SeriesDescription", with spaces replaced by
+        underscores as in the dcm2niix sidecar, to the metadata extracted from the
+        first DICOM of the series with any, as JSON serializable values. It allows
+        metadata capture without the DICOMs, e.g., when the dcm2niix outputs are
+        restored from the conversion cache.
+
+    Args:
+        dcm2niix_input_dir (str): The absolute path to a set of dicoms as input
+            to dcm2niix.
+        files (list): If set, the absolute paths to the files to index instead of
+            every file in dcm2niix_input_dir, e.g., the DICOMs of one series.
+
+    Returns:
+        dicom_index (dict): The DICOM header metadata of each series.
+
+    """
+    dicom_index = {}
+
+    if files is None:
+        files = Path(dcm2niix_input_dir).rglob("*")
+
+    for dicom in sorted(Path(file) for file in files):
+        if dicom.is_dir():
+            continue
+
+        try:
+            dicom_header = pydicom.dcmread(str(dicom), stop_before_pixels=True)
+            series_key, dicom_data = dicom_index_entry(dicom_header)
+        except (InvalidDicomError, AttributeError):
+            continue
+
+        if dicom_index.get(series_key):
+            continue
+
+        dicom_index[series_key] = dicom_data
+
+    return dicom_index
+
+
+def dicom_index_entry(dicom_header):
+    """Return the key and JSON serializable metadata of a DICOM for the DICOM index."""
+    series_key = (
+        f"{dicom_header.SeriesNumber}/"
+        f"{str(dicom_header.get('SeriesDescription', '')).replace(' ', '_')}"
+    )
+    dicom_data = {
+        k: json_safe(v)
+        for k, v in dicom_metadata_extraction(dicom_header).items()
+        if v is not None
+    }
+
+    return series_key, dicom_data
+
+
+def json_safe(value):
+    """Return a DICOM element value as a JSON serializable value."""
+    if isinstance(value, (list, MultiValue)):
+        return [json_safe(item) for item in value]
+    if isinstance(value, bytes):
+        return serialize_bytes(value)
+    # pydicom value representations (e.g., DSfloat, IS) subclass the builtin types
+    for builtin in [int, float, str]:
+        if isinstance(value, builtin):
+            return builtin(value)
+    return str(value)
+
+
 def create_file_metadata(filename, filetype, classification, bids_info, modality):
     """Create a dictionary storing the file metadata."""
     filedata = {}
@@ -61,6 +61,7 @@ def generate_gear_args(gear_context, FLAG):
                 "remove_incomplete_volumes"
             ],
             "decompress_dicoms": gear_context.config["decompress_dicoms"],
+            "remove_duplicate_dicoms": gear_context.config["remove_duplicate_dicoms"],
             "rec_infile": None,
         }
 
@@ -79,6 +80,7 @@ def generate_gear_args(gear_context, FLAG):
 
         # Notice the explicit 'y' for bids_sidecar, in order to capture metadata; the
         # user-defined config option setting wil be considered during the gear resolve stage.
+        # If only the sidecar is retained, the images are not converted at all.
         filename = gear_context.config["filename"]
         filename = filename.replace(" ", "_")
 
@@ -109,6 +111,18 @@ def generate_gear_args(gear_context, FLAG):
             "verbose": gear_context.config["dcm2niix_verbose"],
         }
 
+        if (
+            gear_context.config["bids_sidecar"] == "o"
+            and not gear_context.config["output_nrrd"]
+            and not gear_context.config["output_nifti_and_nrrd"]
+            and not gear_context.config["ignore_errors"]
+        ):
+            gear_args["bids_sidecar"] = "o"
+
+        # Both formats are written from the NIfTIs, converted once
+        if gear_context.config["output_nifti_and_nrrd"]:
+            gear_args["output_nrrd"] = False
+
         # Anonymization cascade
         if gear_context.config["pydeface"]:
             gear_args["anonymize_bids"] = True
@@ -122,6 +136,18 @@ def generate_gear_args(gear_context, FLAG):
             "facemask": None,
             "pydeface_nocleanup": gear_context.config["pydeface_nocleanup"],
             "pydeface_verbose": gear_context.config["pydeface_verbose"],
+            "pydeface_reuse_registration": gear_context.config[
+                "pydeface_reuse_registration"
+            ],
+            "pydeface_downsample": gear_context.config["pydeface_downsample"],
+            "pydeface_select": gear_context.config["pydeface_select"],
+            "pydeface_skip_series_pattern": gear_context.config[
+                "pydeface_skip_series_pattern"
+            ],
+            "pydeface_min_fov": gear_context.config["pydeface_min_fov"],
+            "pydeface_engine": gear_context.config["pydeface_engine"],
+            "cache_dir": gear_context.config["cache_dir"] or None,
+            "cache_max_size": int(gear_context.config["cache_max_size"] * 1024 ** 2),
         }
 
         if gear_context.get_input_path("pydeface_template"):
@@ -150,6 +176,66 @@ def generate_gear_args(gear_context, FLAG):
         else:
             log.info("No input facemask provided for pydeface. Defaults assumed.")
 
+    elif FLAG == "conversion_cache":
+
+        gear_args = {
+            "conversion_cache": gear_context.config["conversion_cache"],
+            "incremental_conversion": gear_context.config["incremental_conversion"],
+            "cache_dir": gear_context.config["cache_dir"] or None,
+            "cache_max_size": int(gear_context.config["cache_max_size"] * 1024 ** 2),
+            "copy_files": bool(
+                gear_context.config["coil_combine"] or gear_context.config["pydeface"]
+            ),
+        }
+
+        if gear_args["conversion_cache"] or gear_args["incremental_conversion"]:
+            if not gear_args["cache_dir"]:
+                log.warning(
+                    "The conversion cache and incremental conversion require "
+                    "cache_dir. Not applied."
+                )
+                gear_args["conversion_cache"] = False
+                gear_args["incremental_conversion"] = False
+            elif gear_context.config["ignore_errors"]:
+                log.warning(
+                    "The conversion cache and incremental conversion are not applied "
+                    "with ignore_errors."
+                )
+                gear_args["conversion_cache"] = False
+                gear_args["incremental_conversion"] = False
+
+    elif FLAG == "preflight":
+
+        input_files = [
+            gear_context.get_input_path(name)
+            for name in ["dcm2niix_input", "rec_file_input"]
+        ]
+
+        gear_args = {
+            "input_files": [file for file in input_files if file],
+            "compress_images": gear_context.config["compress_images"],
+            "output_formats": 2 if gear_context.config["output_nifti_and_nrrd"] else 1,
+            "decompress_dicoms": gear_context.config["decompress_dicoms"],
+        }
+
+    elif FLAG == "staging":
+
+        input_files = [
+            gear_context.get_input_path(name)
+            for name in ["dcm2niix_input", "rec_file_input"]
+        ]
+
+        gear_args = {
+            "input_files": [file for file in input_files if file],
+            "staging_dir": gear_context.config["staging_dir"] or None,
+            "max_size": int(gear_context.config["staging_max_size"] * 1024 ** 2),
+        }
+
+        # Checkpoints are only resumed from a persisted work directory
+        if gear_args["staging_dir"] and gear_context.config["resume_from_checkpoint"]:
+            log.warning("Staging is not applied with resume_from_checkpoint.")
+            gear_args["staging_dir"] = None
+
     elif FLAG == "resolve":
 
         gear_args = {
@@ -174,6 +260,10 @@ def generate_gear_args(gear_context, FLAG):
         if gear_context.config["output_nrrd"]:
             gear_args["retain_nifti"] = False
 
+        if gear_context.config["output_nifti_and_nrrd"]:
+            gear_args["output_nrrd"] = True
+            gear_args["retain_nifti"] = gear_context.config["bids_sidecar"] != "o"
+
         try:
             classification = (
                 gear_context.config_json.get("inputs", {})
@@ -0,0 +1,88 @@
+"""Function to run items through a sequence of stages with overlapped execution."""
+
+import logging
+import queue
+import threading
+
+from dcm2niix_gear.utils import profiling
+
+
+log = logging.getLogger(__name__)
+
+# Marks the end of the items passed between stages
+_DONE = object()
+
+
+def run(items, stages, queue_size=1):
+    """Run each item through the stages in order, overlapping the stages.
+
+        Each stage runs in its own thread and passes its results to the next stage
+        through a bounded queue, so that a stage processes item k + 1 while the next
+        stage processes item k. Items pass through every stage in order. If a stage
+        raises, including SystemExit from a gear step that exits, the remaining items
+        are dropped and the exception is raised once every stage has stopped.
+
+    Args:
+        items (iterable): The items to process, e.g., a list or a generator.
+        stages (list): The stage functions, each called with the result of the
+            previous stage, or with the item for the first stage.
+        queue_size (int): The maximum number of results waiting between two stages;
+            0 for no maximum.
+
+    Returns:
+        results (list): The result of the last stage for each item, in item order.
+
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    results = queue.Queue()
+    errors = []
+    span_names = profiling.open_spans()
+
+    def work(stage, inbox, outbox):
+        profiling.attach(span_names)
+        while True:
+            value = inbox.get()
+            if value is _DONE:
+                break
+            # After an error, keep draining the queue so upstream stages stop
+            if errors:
+                continue
+            try:
+                outbox.put(stage(value))
+            except BaseException as exception:
+                log.debug(f"Pipeline stage {stage.__name__} failed.")
+                errors.append(exception)
+        outbox.put(_DONE)
+
+    threads = [
+        threading.Thread(
+            target=work,
+            args=(stage, inbox, outbox),
+            name=f"pipeline-{stage.__name__}",
+            daemon=True,
+        )
+        for stage, inbox, outbox in zip(stages, queues, queues[1:] + [results])
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Items may be generated as they become available, e.g., as files are extracted
+    try:
+        for item in items:
+            if errors:
+                break
+            queues[0].put(item)
+    finally:
+        queues[0].put(_DONE)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+    output = []
+    while True:
+        value = results.get()
+        if value is _DONE:
+            return output
+        output.append(value)
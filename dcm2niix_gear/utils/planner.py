@@ -0,0 +1,310 @@
+"""Functions to plan the workers of parallel stages from the resources of the job."""
+
+import logging
+import math
+import os
+import tarfile
+import zipfile
+from pathlib import Path
+
+import pydicom
+from pydicom.filereader import InvalidDicomError
+
+from dcm2niix_gear.dcm2niix import arrange
+
+
+log = logging.getLogger(__name__)
+
+CGROUP_DIR = "/sys/fs/cgroup"
+
+# Fraction of the memory limit the parallel workers of a stage may use
+MEMORY_FRACTION = 0.75
+
+# Memory of a dcm2niix run, as a multiple of the decoded bytes of the series; the
+# slices, the reoriented volume and the compression buffer
+DCM2NIIX_MEMORY_FACTOR = 3
+
+# Memory of a gdcmconv run, as a multiple of the bytes of the largest DICOM
+DECOMPRESSION_MEMORY_FACTOR = 4
+
+# Memory of coil combining a NIfTI, as a multiple of the decoded bytes of the series;
+# only its last volume is read
+COIL_COMBINE_MEMORY_FACTOR = 1
+
+# Memory of a PyDeface run, as a multiple of the decoded bytes of the series; the
+# image as float64, the warped facemask and FSL-FLIRT
+PYDEFACE_MEMORY_FACTOR = 6
+
+# DICOM attributes read to estimate the decoded bytes of each series
+SIZE_ATTRIBUTES = [
+    "SeriesInstanceUID",
+    "Rows",
+    "Columns",
+    "NumberOfFrames",
+    "BitsAllocated",
+    "SamplesPerPixel",
+]
+
+# The plan of the current job, from the last call to plan
+_plan = {}
+
+
+def plan(input_path, cgroup_dir=CGROUP_DIR):
+    """Plan the workers of each parallel stage from the input and the job resources.
+
+        The CPU quota is the number of CPUs in the affinity mask, limited by the
+        cgroup v1 or v2 CPU quota; the memory limit is the physical memory, limited
+        by the cgroup v1 or v2 memory limit. The memory of each stage is estimated
+        from the file sizes and the decoded size of the largest series, from the
+        DICOM header dimensions once the input is extracted, or from the archive
+        before extraction. Stages take their number of workers from the plan with
+        workers; the series pipeline and the streaming conversion overlap two stages
+        only if both fit at a time.
+
+    Args:
+        input_path (str): The absolute path to the input directory to dcm2niix, or
+            to the input archive if not yet extracted.
+        cgroup_dir (str): The absolute path to the cgroup filesystem.
+
+    Returns:
+        resource_plan (dict): The resources, the input estimate and the number of
+            workers of each stage, as '<stage>_workers'.
+
+    """
+    cpus = cpu_quota(cgroup_dir)
+    memory = memory_limit(cgroup_dir)
+    if os.path.isdir(input_path):
+        estimate = estimate_input(input_path)
+    else:
+        estimate = estimate_archive(input_path)
+    budget = int(memory * MEMORY_FRACTION)
+    series_bytes = estimate["largest_series_bytes"]
+
+    def fit(memory_per_worker):
+        if memory_per_worker <= 0:
+            return cpus
+        return max(1, min(cpus, budget // memory_per_worker))
+
+    def overlap(*memory_per_stage):
+        if cpus >= len(memory_per_stage) and sum(memory_per_stage) <= budget:
+            return len(memory_per_stage)
+        return 1
+
+    resource_plan = {
+        "cpus": cpus,
+        "memory_limit": memory,
+        **estimate,
+        "decompression_workers": fit(
+            DECOMPRESSION_MEMORY_FACTOR * estimate["largest_file_bytes"]
+        ),
+        "dcm2niix_workers": fit(DCM2NIIX_MEMORY_FACTOR * series_bytes),
+        "coil_combine_workers": fit(COIL_COMBINE_MEMORY_FACTOR * series_bytes),
+        "pydeface_workers": fit(PYDEFACE_MEMORY_FACTOR * series_bytes),
+        # A dcm2niix run overlaps the post-processing of the previous series
+        "pipeline_workers": overlap(
+            DCM2NIIX_MEMORY_FACTOR * series_bytes,
+            max(COIL_COMBINE_MEMORY_FACTOR, PYDEFACE_MEMORY_FACTOR) * series_bytes,
+        ),
+        # A dcm2niix run overlaps the extraction, whose memory is negligible
+        "streaming_workers": overlap(DCM2NIIX_MEMORY_FACTOR * series_bytes, 0),
+    }
+
+    _plan.clear()
+    _plan.update(resource_plan)
+
+    log.info(
+        f"Resource plan: {cpus} CPUs and {memory / 1024 ** 2:.0f} MB for "
+        f"{estimate['files']} files of {estimate['bytes'] / 1024 ** 2:.0f} MB, the "
+        f"largest series decoding to {estimate['largest_series_bytes'] / 1024 ** 2:.0f}"
+        f" MB."
+    )
+    for name, value in resource_plan.items():
+        if name.endswith("_workers"):
+            log.info(f"Resource plan: {value} {name.replace('_', ' ')}.")
+
+    return resource_plan
+
+
+def workers(stage, default=1):
+    """Return the number of workers of a stage in the current plan, or the default."""
+    return _plan.get(f"{stage}_workers", default)
+
+
+def temporal_chunks(chunks):
+    """Return the number of temporal chunks of long series, and of chunks at a time.
+
+        A dcm2niix run of a chunk is estimated at its share of the memory of the
+        largest series in the current plan, so more chunks are converted at a time
+        than whole series fit. A series is split into more chunks than asked if a
+        chunk would not fit the memory of the job.
+
+    Args:
+        chunks (int): The number of chunks asked for, e.g., temporal_chunks.
+
+    Returns:
+        chunks (int): The number of chunks to split long series into.
+        workers (int): The number of chunks to convert at a time.
+
+    """
+    if not _plan:
+        return chunks, chunks
+
+    budget = int(_plan["memory_limit"] * MEMORY_FRACTION)
+    series_memory = DCM2NIIX_MEMORY_FACTOR * _plan["largest_series_bytes"]
+    if budget > 0:
+        chunks = max(chunks, math.ceil(series_memory / budget))
+
+    chunk_memory = math.ceil(series_memory / chunks)
+    workers = min(_plan["cpus"], chunks)
+    if chunk_memory > 0:
+        workers = min(workers, budget // chunk_memory)
+
+    return chunks, max(1, workers)
+
+
+def reset():
+    """Clear the plan, e.g., between inputs converted by the batch runner."""
+    _plan.clear()
+
+
+def cpu_quota(cgroup_dir=CGROUP_DIR):
+    """Return the number of CPUs the job may use, from affinity and cgroup quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    # cgroup v2: "<quota> <period>", or "max <period>" without a quota
+    values = read_cgroup_file(os.path.join(cgroup_dir, "cpu.max"))
+    if values and values[0] != "max":
+        cpus = min(cpus, int(values[0]) // int(values[1]))
+
+    # cgroup v1: a quota of -1 is no quota
+    for cpu_dir in ["cpu", "cpu,cpuacct"]:
+        quota = read_cgroup_file(os.path.join(cgroup_dir, cpu_dir, "cpu.cfs_quota_us"))
+        period = read_cgroup_file(
+            os.path.join(cgroup_dir, cpu_dir, "cpu.cfs_period_us")
+        )
+        if quota and period and int(quota[0]) > 0:
+            cpus = min(cpus, int(quota[0]) // int(period[0]))
+            break
+
+    return max(1, cpus)
+
+
+def memory_limit(cgroup_dir=CGROUP_DIR):
+    """Return the bytes of memory the job may use, from physical memory and cgroup."""
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError):
+        memory = math.inf
+
+    # cgroup v2: "max" without a limit; cgroup v1: a very large number without one
+    for limit_file in ["memory.max", os.path.join("memory", "memory.limit_in_bytes")]:
+        values = read_cgroup_file(os.path.join(cgroup_dir, limit_file))
+        if values and values[0].isdigit():
+            memory = min(memory, int(values[0]))
+
+    return int(memory) if memory != math.inf else 0
+
+
+def read_cgroup_file(cgroup_file):
+    """Return the whitespace separated values of a cgroup file, or None if absent."""
+    try:
+        with open(cgroup_file) as values_file:
+            return values_file.read().split() or None
+    except OSError:
+        return None
+
+
+def estimate_input(dcm2niix_input_dir):
+    """Estimate the size of the input from file sizes and DICOM header dimensions.
+
+    Args:
+        dcm2niix_input_dir (str): The absolute path to the input directory to dcm2niix.
+
+    Returns:
+        estimate (dict): The number of 'files', their total 'bytes', the
+            'largest_file_bytes' and the 'largest_series_bytes' decoded; the largest
+            series is the whole input if its files are not DICOMs (e.g., PAR/REC).
+
+    """
+    files = 0
+    total_bytes = 0
+    largest_file_bytes = 0
+    series_bytes = {}
+
+    for path in Path(dcm2niix_input_dir).rglob("*"):
+        if path.is_dir():
+            continue
+        size = path.stat().st_size
+        files += 1
+        total_bytes += size
+        largest_file_bytes = max(largest_file_bytes, size)
+
+        try:
+            dicom_header = pydicom.dcmread(
+                str(path), stop_before_pixels=True, specific_tags=SIZE_ATTRIBUTES
+            )
+            decoded_bytes = (
+                int(dicom_header.Rows)
+                * int(dicom_header.Columns)
+                * int(dicom_header.get("NumberOfFrames", 1) or 1)
+                * int(dicom_header.get("SamplesPerPixel", 1) or 1)
+                * (int(dicom_header.BitsAllocated) // 8)
+            )
+            series_uid = str(dicom_header.SeriesInstanceUID)
+        except (InvalidDicomError, AttributeError, TypeError, ValueError):
+            continue
+
+        series_bytes[series_uid] = series_bytes.get(series_uid, 0) + decoded_bytes
+
+    return {
+        "files": files,
+        "bytes": total_bytes,
+        "largest_file_bytes": largest_file_bytes,
+        "largest_series_bytes": max(series_bytes.values(), default=total_bytes),
+    }
+
+
+def estimate_archive(infile):
+    """Estimate the size of the input from an archive, before it is extracted.
+
+        Archives exported by series hold the files of each series in one directory,
+        so the largest series of a zip archive is estimated as its largest
+        directory, from its member list. A tar archive is not listed before
+        extraction, so its estimated size is taken as one series.
+
+    Args:
+        infile (str): The absolute path to the input archive.
+
+    Returns:
+        estimate (dict): The estimate, as estimate_input.
+
+    """
+    try:
+        listing = arrange.list_archive(infile)
+        size = arrange.archive_size(infile)
+    except (OSError, zipfile.BadZipFile, tarfile.TarError):
+        listing, size = None, None
+
+    if listing is None:
+        size = size or os.path.getsize(infile)
+        return {
+            "files": 0,
+            "bytes": size,
+            "largest_file_bytes": size,
+            "largest_series_bytes": size,
+        }
+
+    directory_bytes = {}
+    for name, file_size in listing["files"].items():
+        directory = os.path.dirname(name)
+        directory_bytes[directory] = directory_bytes.get(directory, 0) + file_size
+
+    return {
+        "files": len(listing["files"]),
+        "bytes": listing["size"],
+        "largest_file_bytes": max(listing["files"].values(), default=0),
+        "largest_series_bytes": max(directory_bytes.values(), default=0),
+    }
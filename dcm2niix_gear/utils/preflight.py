@@ -0,0 +1,197 @@
+"""Functions to estimate the disk space of a job and check it before extraction."""
+
+import io
+import logging
+import os
+import shutil
+import tarfile
+import zipfile
+
+import pydicom
+from pydicom.filereader import InvalidDicomError
+
+from dcm2niix_gear.dcm2niix import arrange
+from dcm2niix_gear.utils import footprint
+
+
+log = logging.getLogger(__name__)
+
+# Size of gzip compressed images, as a fraction of the voxel data
+GZIP_RATIO = 0.6
+
+# Number of DICOMs of a zip archive whose headers are read for the image dimensions
+SAMPLE_FILES = 32
+
+# Bytes read from the start of a sampled DICOM, for its header
+HEADER_SIZE = 1024**2
+
+# Headroom over the estimate, for sidecars, logs and the error of the estimate
+MARGIN = 1.1
+
+
+def estimate(
+    input_files, compress_images="y", output_formats=1, decompress_dicoms=False
+):
+    """Estimate the bytes of the extracted input and the conversion outputs.
+
+        The extracted size is read from the member list of a zip archive, estimated
+        for a tar archive without decompressing it, as it is decompressed once by the
+        extraction, or else is the size of the input files. The voxel data of the outputs is
+        estimated from the image dimensions in the headers of a sample of the DICOMs
+        of a zip archive, relative to their file size, as compressed transfer
+        syntaxes expand on conversion; for other inputs, it is the extracted size.
+
+    Args:
+        input_files (list): The absolute paths to the input files.
+        compress_images (str): The compress_images option of dcm2niix.
+        output_formats (int): The number of image formats written, e.g., 2 for both
+            NIfTI and NRRD.
+        decompress_dicoms (bool): If true, the DICOMs are decompressed in the work
+            directory before conversion.
+
+    Returns:
+        estimate (dict): The 'input_bytes' extracted and the 'output_bytes' of the
+            conversion outputs; None if the size of the input cannot be read.
+
+    """
+    input_bytes = 0
+    voxel_bytes = 0
+    for file in input_files:
+        try:
+            size = arrange.archive_size(file)
+        except (OSError, zipfile.BadZipFile, tarfile.TarError):
+            log.info(f"Unable to read {file}. Disk space not estimated.")
+            return None
+
+        if size is None:
+            input_bytes += os.path.getsize(file)
+            voxel_bytes += os.path.getsize(file)
+            continue
+
+        if size == 0:
+            log.error("Incorrect gear input. Input archive is empty. Exiting.")
+            os.sys.exit(1)
+
+        # Tar archives are listed as they are extracted, so are not sampled
+        listing = arrange.list_archive(file)
+        input_bytes += size
+        ratio = voxel_ratio(file, listing) if listing is not None else 1.0
+        voxel_bytes += int(size * ratio)
+
+    output_bytes = voxel_bytes * output_formats
+    if compress_images in ["y", "i"]:
+        output_bytes = int(output_bytes * GZIP_RATIO)
+
+    # Decompressed DICOMs replace the input in the work directory
+    if decompress_dicoms:
+        input_bytes = max(input_bytes, voxel_bytes)
+
+    log.info(
+        f"Preflight: {input_bytes / 1024 ** 2:.0f} MB extracted and "
+        f"{output_bytes / 1024 ** 2:.0f} MB of outputs estimated."
+    )
+
+    return {"input_bytes": input_bytes, "output_bytes": output_bytes}
+
+
+def voxel_ratio(zip_file, listing):
+    """Return the bytes of voxel data per byte of file, of a sample of the DICOMs."""
+    names = sorted(name for name, size in listing["files"].items() if size)
+    step = max(1, len(names) // SAMPLE_FILES)
+
+    file_bytes = 0
+    voxel_bytes = 0
+    with zipfile.ZipFile(zip_file, "r") as zip_obj:
+        for name in names[::step][:SAMPLE_FILES]:
+            try:
+                with zip_obj.open(name) as dicom_obj:
+                    header_bytes = io.BytesIO(dicom_obj.read(HEADER_SIZE))
+                header = pydicom.dcmread(header_bytes, stop_before_pixels=True)
+                voxel_bytes += (
+                    header.Rows
+                    * header.Columns
+                    * header.get("SamplesPerPixel", 1)
+                    * int(header.get("NumberOfFrames", 1) or 1)
+                    * header.BitsAllocated
+                    // 8
+                )
+            except (InvalidDicomError, AttributeError, EOFError, RuntimeError):
+                continue
+            file_bytes += listing["files"][name]
+
+    if not file_bytes:
+        return 1.0
+
+    return voxel_bytes / file_bytes
+
+
+def fits(estimate, work_dir):
+    """Return true if the extracted input and outputs fit the work directory."""
+    if estimate is None:
+        return True
+
+    required = MARGIN * (estimate["input_bytes"] + estimate["output_bytes"])
+    free_bytes = available_bytes(work_dir, reused=True)
+
+    return free_bytes is None or required <= free_bytes
+
+
+def check(estimate, work_dir=None, output_dir=None):
+    """Exit if the work or output directory is short of the space the job needs.
+
+        The work directory holds the extracted input and the conversion outputs,
+        which are then moved to the output directory; on the same filesystem, the
+        outputs are not copied.
+
+    Args:
+        estimate (dict): The estimate from estimate; None to not check.
+        work_dir (str): The absolute path to the work directory; None if staged,
+            as the staging filesystem is checked when staged.
+        output_dir (str): The absolute path to the output directory.
+
+    Returns:
+        None
+
+    """
+    if estimate is None:
+        return
+
+    required = {}
+    if work_dir:
+        required[work_dir] = estimate["input_bytes"] + estimate["output_bytes"]
+    if output_dir and not (work_dir and same_filesystem(work_dir, output_dir)):
+        required[output_dir] = estimate["output_bytes"]
+
+    for directory, required_bytes in required.items():
+        required_bytes = int(MARGIN * required_bytes)
+        free_bytes = available_bytes(directory, reused=directory == work_dir)
+        if free_bytes is not None and required_bytes > free_bytes:
+            log.error(
+                f"Insufficient disk space in {directory}: the job needs an estimated "
+                f"{required_bytes / 1024 ** 2:.0f} MB, with "
+                f"{free_bytes / 1024 ** 2:.0f} MB free. Exiting."
+            )
+            os.sys.exit(1)
+
+
+def available_bytes(directory, reused=False):
+    """Return the free bytes of the filesystem of a directory, or None if unknown."""
+    try:
+        free_bytes = shutil.disk_usage(directory).free
+    except OSError:
+        return None
+
+    # A job restarted from a checkpoint reuses or removes the files of its work
+    # directory, so they count as available
+    if reused:
+        free_bytes += footprint.disk_usage(directory)
+
+    return free_bytes
+
+
+def same_filesystem(directory, other_directory):
+    """Return true if both directories are on the same filesystem."""
+    try:
+        return os.stat(directory).st_dev == os.stat(other_directory).st_dev
+    except OSError:
+        return False
@@ -0,0 +1,252 @@
+"""Functions to run external tools and account for the resources of their processes."""
+
+import contextlib
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from dcm2niix_gear.utils import profiling
+
+
+log = logging.getLogger(__name__)
+
+# Seconds between samples of the resident set size of a running tool
+SAMPLE_INTERVAL = 0.2
+
+
+def run(command, tool=None, stream=False, env=None):
+    """Run an external tool, recording its resource usage in the run profile.
+
+        The output of the tool is merged into stdout. While the tool runs, the total
+        resident set size of the tool and its descendants is sampled. Once the tool
+        exits, its resource usage (CPU time, maximum RSS, I/O blocks and context
+        switches) is collected with its exit status.
+
+    Args:
+        command (list): The command to execute.
+        tool (str): The name of the tool the usage is accounted to; the executable
+            name if not set.
+        stream (bool): If true, log the output of the tool line by line as it is
+            produced; otherwise, return it.
+        env (dict): The environment of the tool; that of the gear if not set.
+
+    Returns:
+        process (subprocess.CompletedProcess): The exit status and, if not streamed,
+            the output of the tool.
+
+    Raises:
+        FileNotFoundError: If the executable cannot be found.
+
+    """
+    output = []
+    with popen(
+        command,
+        tool=tool,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        env=env,
+    ) as process:
+        with process.stdout:
+            for line in process.stdout:
+                if stream:
+                    log.info(line.rstrip())
+                else:
+                    output.append(line)
+
+    return subprocess.CompletedProcess(
+        command, process.returncode, stdout="".join(output)
+    )
+
+
+@contextlib.contextmanager
+def popen(command, tool=None, **kwargs):
+    """Start an external tool whose output is read within the context.
+
+        The usage is accounted to the tool by its process ID: once the context
+        exits, the tool is waited for with wait4, which returns the resource usage
+        of the tool and of the processes it waited for, and of no other child of
+        the gear. Tools run at the same time are thus accounted apart. The caller
+        must not wait for the process itself.
+
+    Args:
+        command (list): The command to execute.
+        tool (str): The name of the tool the usage is accounted to; the executable
+            name if not set.
+        **kwargs: Additional arguments to subprocess.Popen, e.g., stderr.
+
+    Yields:
+        process (subprocess.Popen): The tool, with its output as a pipe in stdout;
+            its returncode is set once the context exits.
+
+    Raises:
+        FileNotFoundError: If the executable cannot be found.
+
+    """
+    tool = tool or os.path.basename(command[0])
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, **kwargs)
+
+    try:
+        with sample_rss(process.pid) as sampled:
+            try:
+                yield process
+            finally:
+                _, status, usage = os.wait4(process.pid, 0)
+                process.returncode = exit_code(status)
+
+    finally:
+        if process.returncode is not None:
+            record_usage(
+                tool,
+                usage,
+                wall_time=time.perf_counter() - start,
+                sampled_peak_rss=sampled["peak_rss"],
+                returncode=process.returncode,
+            )
+
+
+def run_interface(interface, tool, success_codes=(0,)):
+    """Run the command line of a nipype interface, recording its resource usage.
+
+        The command line is run in a shell with the environment of the interface,
+        as nipype runs it, but through run, so that the usage is accounted to the
+        process of the tool. The outputs of the interface are not aggregated.
+
+    Args:
+        interface (nipype.interfaces.base.CommandLine): The interface, with its
+            inputs set.
+        tool (str): The name of the tool the usage is accounted to.
+        success_codes (tuple): The exit statuses of a successful run.
+
+    Returns:
+        process (subprocess.CompletedProcess): The exit status and the output of
+            the tool.
+
+    Raises:
+        RuntimeError: If the tool exits with another status.
+
+    """
+    env = {**os.environ, **interface.inputs.environ}
+    process = run(["/bin/sh", "-c", interface.cmdline], tool=tool, env=env)
+
+    if process.returncode not in success_codes:
+        raise RuntimeError(
+            f"{tool} exited with status {process.returncode}:\n{process.stdout}"
+        )
+
+    return process
+
+
+def exit_code(status):
+    """Return the exit status from a wait status, negative if killed by a signal."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def record_usage(tool, usage, wall_time, sampled_peak_rss=0, returncode=None):
+    """Record the resource usage of a tool in the log and the run profile.
+
+    Args:
+        tool (str): The name of the tool.
+        usage (resource.struct_rusage or dict): The resource usage of the tool.
+        wall_time (float): The elapsed time in seconds.
+        sampled_peak_rss (int): The peak RSS in bytes sampled while the tool ran.
+        returncode (int): The exit status of the tool, if known.
+
+    Returns:
+        record (dict): The resource usage record.
+
+    """
+    if not isinstance(usage, dict):
+        usage = {
+            field: getattr(usage, field) for field in dir(usage) if field[:3] == "ru_"
+        }
+
+    record = {
+        "tool": tool,
+        "returncode": returncode,
+        "wall_time": wall_time,
+        "user_time": usage["ru_utime"],
+        "sys_time": usage["ru_stime"],
+        # ru_maxrss is in kilobytes on Linux
+        "max_rss": max(usage["ru_maxrss"] * 1024, sampled_peak_rss),
+        "sampled_peak_rss": sampled_peak_rss,
+        # Block I/O is counted in 512-byte units
+        "read_bytes": usage["ru_inblock"] * 512,
+        "write_bytes": usage["ru_oublock"] * 512,
+        "voluntary_context_switches": usage["ru_nvcsw"],
+        "involuntary_context_switches": usage["ru_nivcsw"],
+    }
+    profiling.add_process(record)
+
+    log.debug(
+        f"{tool} exited with status {returncode} in {wall_time:.2f} s: "
+        f"user {record['user_time']:.2f} s, sys {record['sys_time']:.2f} s, "
+        f"max RSS {record['max_rss'] / 1024 ** 2:.1f} MB."
+    )
+
+    return record
+
+
+@contextlib.contextmanager
+def sample_rss(pid, include_root=True):
+    """Sample the peak total RSS of a process and its descendants in a thread.
+
+    Args:
+        pid (int): The process ID at the root of the process tree.
+        include_root (bool): If true, include the RSS of the root process itself.
+
+    Yields:
+        sampled (dict): The peak RSS in bytes sampled, as 'peak_rss'.
+
+    """
+    sampled = {"peak_rss": 0}
+    stop = threading.Event()
+
+    def sample():
+        while not stop.is_set():
+            pids = descendants(pid)
+            if include_root:
+                pids.append(pid)
+            sampled["peak_rss"] = max(sampled["peak_rss"], sum(map(rss, pids)))
+            stop.wait(SAMPLE_INTERVAL)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+
+    try:
+        yield sampled
+    finally:
+        stop.set()
+        sampler.join()
+
+
+def descendants(pid):
+    """Return the process IDs of all descendants of a process."""
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as children_file:
+                children.extend(int(child) for child in children_file.read().split())
+    except OSError:
+        return []
+
+    return children + [
+        descendant for child in children for descendant in descendants(child)
+    ]
+
+
+def rss(pid):
+    """Return the resident set size in bytes of a process, or 0 if it has exited."""
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    return 0
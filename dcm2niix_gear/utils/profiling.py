@@ -0,0 +1,216 @@
+"""Functions to record timing and resource spans for gear stages and write a run profile."""
+
+import contextlib
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+PROFILE_FILENAME = ".profile.json"
+
+# Completed spans, in order of completion, and the names of the open spans of
+# each thread
+_spans = []
+_local = threading.local()
+
+# Resource usage records of external tools
+_processes = []
+
+# Other measurements of the run, by name, e.g., the peak disk use
+_annotations = {}
+
+
+def _open_spans():
+    """Return the names of the open spans of the current thread."""
+    if not hasattr(_local, "open_spans"):
+        _local.open_spans = []
+    return _local.open_spans
+
+
+def open_spans():
+    """Return a copy of the names of the open spans of the current thread."""
+    return list(_open_spans())
+
+
+def attach(names):
+    """Nest the spans of the current thread within the open spans of another thread."""
+    _local.open_spans = list(names)
+
+
+def snapshot():
+    """Capture the current wall time, CPU time, lifetime peak RSS and I/O counters."""
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    counters = {
+        "wall_time": time.perf_counter(),
+        "cpu_time": usage_self.ru_utime + usage_self.ru_stime,
+        "children_cpu_time": usage_children.ru_utime + usage_children.ru_stime,
+        # ru_maxrss is in kilobytes on Linux, and is the peak over the lifetime of the
+        # process and of its largest waited-for child, not of a span
+        "process_peak_rss_at_end": usage_self.ru_maxrss * 1024,
+        "children_peak_rss_at_end": usage_children.ru_maxrss * 1024,
+        # Block I/O is counted in 512-byte units
+        "read_bytes": (usage_self.ru_inblock + usage_children.ru_inblock) * 512,
+        "write_bytes": (usage_self.ru_oublock + usage_children.ru_oublock) * 512,
+    }
+
+    # Bytes passed through read and write calls of this process, cached or not
+    try:
+        with open("/proc/self/io") as io_file:
+            io = dict(line.split(": ") for line in io_file.read().splitlines())
+        counters["read_chars"] = int(io["rchar"])
+        counters["write_chars"] = int(io["wchar"])
+    except (OSError, KeyError, ValueError):
+        counters["read_chars"] = 0
+        counters["write_chars"] = 0
+
+    return counters
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Record a span for a gear stage or sub-step.
+
+        Spans nest; the path of a span is the names of the enclosing spans joined
+        with '/'. The span record is yielded, so the caller can add attributes, such
+        as file counts, while the span is open.
+
+    Args:
+        name (str): The stage or sub-step name.
+        **attributes: Additional attributes to record, such as 'files' or 'file'.
+
+    Yields:
+        record (dict): The span record, completed when the span closes.
+
+    """
+    _open_spans().append(name)
+    record = {"name": name, "path": "/".join(_open_spans()), **attributes}
+    start = snapshot()
+
+    try:
+        yield record
+
+    finally:
+        end = snapshot()
+        _open_spans().pop()
+
+        record["wall_time"] = end["wall_time"] - start["wall_time"]
+        record["cpu_time"] = end["cpu_time"] - start["cpu_time"]
+        record["children_cpu_time"] = (
+            end["children_cpu_time"] - start["children_cpu_time"]
+        )
+        record["process_peak_rss_at_end"] = end["process_peak_rss_at_end"]
+        record["children_peak_rss_at_end"] = end["children_peak_rss_at_end"]
+        for counter in ["read_bytes", "write_bytes", "read_chars", "write_chars"]:
+            record[counter] = end[counter] - start[counter]
+
+        _spans.append(record)
+        log.debug(f"Span {record['path']} took {record['wall_time']:.3f} s.")
+
+
+def spans():
+    """Return the completed span records."""
+    return list(_spans)
+
+
+def add_process(record):
+    """Add the resource usage record of an external tool run within the open span."""
+    _processes.append({**record, "span": "/".join(_open_spans()) or None})
+
+
+def process_totals():
+    """Return the resource usage of external tools, totalled per tool."""
+    totals = {}
+    for record in _processes:
+        total = totals.setdefault(
+            record["tool"],
+            {
+                "calls": 0,
+                "failures": 0,
+                "wall_time": 0.0,
+                "user_time": 0.0,
+                "sys_time": 0.0,
+                "max_rss": 0,
+                "read_bytes": 0,
+                "write_bytes": 0,
+                "voluntary_context_switches": 0,
+                "involuntary_context_switches": 0,
+            },
+        )
+        total["calls"] += 1
+        total["failures"] += int(record["returncode"] not in [0, None])
+        total["max_rss"] = max(total["max_rss"], record["max_rss"])
+        for counter in [
+            "wall_time",
+            "user_time",
+            "sys_time",
+            "read_bytes",
+            "write_bytes",
+            "voluntary_context_switches",
+            "involuntary_context_switches",
+        ]:
+            total[counter] += record[counter]
+
+    return totals
+
+
+def annotate(name, value):
+    """Add a JSON serializable measurement of the run to the profile."""
+    _annotations[name] = value
+
+
+def reset():
+    """Discard all recorded spans and resource usage records."""
+    _spans.clear()
+    _open_spans().clear()
+    _processes.clear()
+    _annotations.clear()
+
+
+def summarize():
+    """Log the wall and CPU time of each top-level span and the totals per tool."""
+    lines = [
+        f"{record['name']:<20} wall {record['wall_time']:9.2f} s  "
+        f"cpu {record['cpu_time'] + record['children_cpu_time']:9.2f} s"
+        for record in _spans
+        if "/" not in record["path"]
+    ]
+    lines += [
+        f"{tool:<20} wall {total['wall_time']:9.2f} s  "
+        f"cpu {total['user_time'] + total['sys_time']:9.2f} s  "
+        f"max RSS {total['max_rss'] / 1024 ** 2:9.1f} MB  "
+        f"calls {total['calls']}"
+        for tool, total in process_totals().items()
+    ]
+    log.info("Run profile:\n\n" + "\n".join(lines) + "\n")
+
+
+def write(output_dir):
+    """Write the recorded spans and resource usage as JSON and return the file path.
+
+    Args:
+        output_dir (str): The absolute path to the directory to write the profile to.
+
+    Returns:
+        profile_file (str): The absolute path to the profile file.
+
+    """
+    profile_file = os.path.join(output_dir, PROFILE_FILENAME)
+    profile = {
+        "spans": spans(),
+        "processes": list(_processes),
+        "process_totals": process_totals(),
+        **_annotations,
+    }
+
+    with open(profile_file, "w") as file_obj:
+        json.dump(profile, file_obj, indent=2)
+
+    log.info(f"Run profile written to {profile_file}.")
+    return profile_file
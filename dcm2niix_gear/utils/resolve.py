@@ -24,6 +24,8 @@ def setup(
     pydeface_intermediaries=False,
     classification=None,
     modality=None,
+    pydeface_skipped=None,
+    dicom_index=None,
 ):
     """Orchestrate resolution of gear, including metadata capture and file retention.
 
@@ -39,17 +41,30 @@ def setup(
         dcm2niix_input_dir (str): The absolute path to the input directory to dcm2niix.
         retain_sidecar (bool): If true, sidecar is retained in final output.
         retain_nifti (bool): If true, NIfTI is retained in final output.
-        output_nrrd (bool): If true, export as NRRD instead of NIfTI.
+        output_nrrd (bool): If true, NRRD is retained in final output; as well as
+            NIfTI, if retain_nifti is also true.
         pydeface_intermediaries (bool): If true, PyDeface intermediary files are
             retained. The files created when --nocleanup flag is applied to the
             PyDeface command.
         classification (dict): File classification, typically from gear config.
         modality (str): File modality, typically from gear config.
+        pydeface_skipped (dict): The absolute paths to NIfTI files not defaced by
+            PyDeface, with the reason.
+        dicom_index (dict): The DICOM header metadata of each series, used for metadata
+            capture instead of dcm2niix_input_dir, if set.
 
     Returns:
         None
 
     """
+    # NIfTIs skipped by PyDeface are output as converted, with facial features
+    for file in output_image_files or []:
+        if pydeface_skipped and file in pydeface_skipped:
+            log.warning(
+                f"Outputting {Path(file).name} without defacing: "
+                f"{pydeface_skipped[file]}"
+            )
+
     # Ignoring errors configuration option; move all files from work_dir to output_dir
     if ignore_errors is True:
         log.warning("Applying Expert Option (ignore_errors).")
@@ -68,6 +83,8 @@ def setup(
                 pydeface_intermediaries=pydeface_intermediaries,
                 classification=classification,
                 modality=modality,
+                pydeface_skipped=pydeface_skipped,
+                dicom_index=dicom_index,
             )
 
         work_dir_contents = os.listdir(work_dir)
@@ -91,6 +108,8 @@ def setup(
             pydeface_intermediaries=pydeface_intermediaries,
             classification=classification,
             modality=modality,
+            pydeface_skipped=pydeface_skipped,
+            dicom_index=dicom_index,
         )
 
         # Retain gear outputs
@@ -133,7 +152,8 @@ def retain_gear_outputs(
         output_dir (str): The absolute path to the gear output directory.
         retain_sidecar (bool): If true, sidecar is retained in final output.
         retain_nifti (bool): If true, NIfTI is retained in final output.
-        output_nrrd (bool): If true, export as NRRD instead of NIfTI.
+        output_nrrd (bool): If true, NRRD is retained in final output; as well as
+            NIfTI, if retain_nifti is also true.
         pydeface_intermediaries (bool): If true, pydeface intermediary files are
             retained. The files created when --nocleanup flag is applied to the
             pydeface command.
@@ -144,12 +164,11 @@ def retain_gear_outputs(
     """
     log.info("Resolving gear outputs.")
 
-    if (retain_nifti and output_nrrd) or (
-        not retain_nifti and not output_nrrd and not retain_sidecar
-    ):
+    # NIfTI and NRRD are both retained with output_nifti_and_nrrd
+    if not retain_nifti and not output_nrrd and not retain_sidecar:
         log.critical(
-            "Function arguments retain_nifti and output_nrrd are exclusive. "
-            "Gear config logic is broken. Exiting."
+            "Function arguments retain_nifti, output_nrrd and retain_sidecar retain "
+            "no outputs. Gear config logic is broken. Exiting."
         )
         os.sys.exit(1)
 
@@ -0,0 +1,133 @@
+"""Functions to stage the work directory of a job on a RAM-backed filesystem."""
+
+import errno
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from dcm2niix_gear.dcm2niix import arrange
+from dcm2niix_gear.utils import planner
+
+
+log = logging.getLogger(__name__)
+
+# Space needed on the staging filesystem, as a multiple of the uncompressed input;
+# the extracted input, the dcm2niix outputs and intermediates (e.g., chunks)
+SPACE_FACTOR = 3
+
+# Fraction of the job memory limit staged files may use, as tmpfs pages are charged
+# to the memory of the job
+MEMORY_FRACTION = 0.5
+
+# A staging filesystem with less free space than this, after an error, ran out
+LOW_SPACE_SIZE = 16 * 1024**2
+
+
+def stage_work_dir(input_files, staging_dir=None, max_size=1024**3):
+    """Create a work directory on the staging filesystem, if the input fits.
+
+        The uncompressed size of the input is read from the member list of a zip
+        archive, estimated for a tar archive by arrange.estimate_tar_size, or else is
+        the size of the input files. The input is staged if
+        it is no larger than max_size and SPACE_FACTOR times its size fits both the
+        free space of staging_dir and a fraction of the job memory limit.
+
+    Args:
+        input_files (list): The absolute paths to the input files.
+        staging_dir (str): The absolute path to the staging filesystem (e.g.,
+            /dev/shm); None to not stage.
+        max_size (int): The largest uncompressed input to stage, in bytes; None for
+            no limit other than the free space.
+
+    Returns:
+        staged_dir (str): The absolute path to the staged work directory; None if the
+            input is not staged.
+
+    """
+    if not staging_dir:
+        return None
+
+    size = input_size(input_files)
+    if size is None:
+        log.info("Unable to establish the size of the input. Not staging.")
+        return None
+
+    required = SPACE_FACTOR * size
+    try:
+        free = shutil.disk_usage(staging_dir).free
+    except OSError:
+        log.warning(f"Staging directory {staging_dir} is not available. Not staging.")
+        return None
+    memory = planner.memory_limit()
+    if memory:
+        free = min(free, int(memory * MEMORY_FRACTION))
+
+    if (max_size is not None and size > max_size) or required > free:
+        log.info(
+            f"Input of {size / 1024 ** 2:.0f} MB needs {required / 1024 ** 2:.0f} MB, "
+            f"with {free / 1024 ** 2:.0f} MB free in {staging_dir}. Not staging."
+        )
+        return None
+
+    staged_dir = tempfile.mkdtemp(prefix="dcm2niix_gear_", dir=staging_dir)
+    log.info(
+        f"Staging the work directory of {size / 1024 ** 2:.0f} MB in {staged_dir}."
+    )
+
+    return staged_dir
+
+
+def input_size(input_files):
+    """Return the uncompressed bytes of the input files, or None if unknown."""
+    size = 0
+    for file in input_files:
+        try:
+            contents_size = arrange.archive_size(file)
+            if contents_size is not None:
+                size += contents_size
+            else:
+                size += os.path.getsize(file)
+        except (OSError, zipfile.BadZipFile, tarfile.TarError):
+            return None
+
+    return size
+
+
+def out_of_space(staged_dir, exception):
+    """Return true if the staging filesystem ran out of space, causing exception."""
+    if isinstance(exception, OSError) and exception.errno == errno.ENOSPC:
+        return True
+
+    # Tools report a full filesystem as an error, which exits the gear
+    try:
+        usage = shutil.disk_usage(staged_dir)
+    except OSError:
+        return False
+
+    return usage.free < max(LOW_SPACE_SIZE, usage.total // 100)
+
+
+def release(staged_dir):
+    """Remove the staged work directory."""
+    if staged_dir:
+        shutil.rmtree(staged_dir, ignore_errors=True)
+
+
+def remove_new_files(directory, existing):
+    """Remove the files and directories of directory not in existing.
+
+    Args:
+        directory (str): The absolute path to the directory, e.g., the output directory.
+        existing (set): The names in directory to keep, listed before the files to
+            remove were written.
+
+    """
+    for name in set(os.listdir(directory)) - set(existing):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
@@ -2,28 +2,278 @@
 # -*- coding: utf-8 -*-
 """Main script for dcm2niix gear."""
 
+import os
+from types import SimpleNamespace
+
 import flywheel_gear_toolkit
 
+from dcm2niix_gear.dcm2niix import arrange
+from dcm2niix_gear.dcm2niix import chunking
+from dcm2niix_gear.dcm2niix import conversion_cache
+from dcm2niix_gear.dcm2niix import incremental
+from dcm2niix_gear.dcm2niix import native
+from dcm2niix_gear.dcm2niix import nrrd_export
 from dcm2niix_gear.dcm2niix import prepare
+from dcm2niix_gear.dcm2niix import series_pipeline
+from dcm2niix_gear.dcm2niix import streaming
 from dcm2niix_gear.dcm2niix import dcm2niix_utils
 from dcm2niix_gear.dcm2niix import dcm2niix_run
 from dcm2niix_gear.pydeface import pydeface_run
+from dcm2niix_gear.utils import cache
+from dcm2niix_gear.utils import checkpoint
+from dcm2niix_gear.utils import footprint
+from dcm2niix_gear.utils import metadata
 from dcm2niix_gear.utils import parse_config
+from dcm2niix_gear.utils import planner
+from dcm2niix_gear.utils import preflight
+from dcm2niix_gear.utils import profiling
 from dcm2niix_gear.utils import resolve
+from dcm2niix_gear.utils import staging
 
 
 def main(gear_context):
     """Orchestrate dcm2niix gear."""
 
-    # Prepare dcm2niix input, which is a directory of dicom or parrec images
-    gear_args = parse_config.generate_gear_args(gear_context, "prepare")
-    dcm2niix_input_dir = prepare.setup(**gear_args)
+    # Estimate the disk space of the extracted input and the outputs, before extraction
+    estimate = None
+    if gear_context.config["preflight_check"]:
+        gear_args = parse_config.generate_gear_args(gear_context, "preflight")
+        with profiling.span("preflight"):
+            estimate = preflight.estimate(**gear_args)
+
+    # Stage the work directory on a RAM-backed filesystem, if the input fits; or
+    # regardless of staging_max_size, if the work directory is short of space
+    gear_args = parse_config.generate_gear_args(gear_context, "staging")
+    with profiling.span("staging"):
+        staged_dir = staging.stage_work_dir(**gear_args)
+        if staged_dir is None and not preflight.fits(
+            estimate, str(gear_context.work_dir)
+        ):
+            staged_dir = staging.stage_work_dir(**{**gear_args, "max_size": None})
 
-    # Run dcm2niix
-    gear_args = parse_config.generate_gear_args(gear_context, "dcm2niix")
-    output = dcm2niix_run.convert_directory(
-        dcm2niix_input_dir, gear_context.work_dir, **gear_args
+    # Fail before extraction, rather than when the disk fills
+    preflight.check(
+        estimate,
+        work_dir=None if staged_dir else str(gear_context.work_dir),
+        output_dir=str(gear_context.output_dir),
     )
+    if staged_dir is None:
+        return convert(gear_context, str(gear_context.work_dir))
+
+    existing = set(os.listdir(str(gear_context.output_dir)))
+    try:
+        return convert(gear_context, staged_dir)
+
+    except (OSError, SystemExit) as exception:
+        if not staging.out_of_space(staged_dir, exception):
+            raise
+        gear_context.log.warning(
+            "Staging directory ran out of space. Converting in the work directory."
+        )
+        staging.release(staged_dir)
+
+        # Start over, as batch.convert_input does between inputs, without the
+        # outputs of the failed conversion
+        profiling.reset()
+        planner.reset()
+        arrange.reset()
+        cache.release_pins()
+        checkpoint.reset()
+        footprint.reset()
+        staging.remove_new_files(str(gear_context.output_dir), existing)
+        return convert(gear_context, str(gear_context.work_dir))
+
+    finally:
+        staging.release(staged_dir)
+
+
+def convert(gear_context, work_dir):
+    """Convert the input and resolve the gear outputs, in the work directory."""
+
+    prepare_args = parse_config.generate_gear_args(gear_context, "prepare")
+    prepare_args["work_dir"] = work_dir
+    dcm2niix_args = parse_config.generate_gear_args(gear_context, "dcm2niix")
+
+    # Resume the stages completed before the job was restarted, e.g., on preemption
+    if gear_context.config["resume_from_checkpoint"]:
+        checkpoint.load(
+            work_dir,
+            checkpoint.job_key(prepare_args, gear_context.config),
+            keep=[gear_context.config["cache_dir"]],
+        )
+
+    # Track the disk use of the work directory after each stage
+    footprint.start(work_dir)
+
+    # Restore the dcm2niix outputs of the same input and options, if cached
+    gear_args = parse_config.generate_gear_args(gear_context, "conversion_cache")
+    output, dicom_index, dcm2niix_input_dir = None, None, None
+    post_processed, pydeface_skipped = False, {}
+    converted = checkpoint.completed("convert")
+    if converted is not None:
+        output = SimpleNamespace(outputs=SimpleNamespace(**converted["outputs"]))
+        dcm2niix_input_dir = converted["dcm2niix_input_dir"]
+        dicom_index = converted["dicom_index"]
+        post_processed = converted["post_processed"]
+        pydeface_skipped = converted["pydeface_skipped"]
+
+    elif gear_args["conversion_cache"]:
+        cache_key = conversion_cache.cache_key(
+            prepare_args, dcm2niix_args, conversion_cache.dcm2niix_version()
+        )
+        with profiling.span("conversion_cache"):
+            output, dicom_index = conversion_cache.restore(
+                cache_key,
+                work_dir,
+                cache_dir=gear_args["cache_dir"],
+                copy_files=gear_args["copy_files"],
+            )
+
+    if output is None:
+        # Convert a simple series in-process, reading the DICOMs from the archive
+        if (
+            gear_context.config["conversion_engine"] == "native"
+            and not gear_args["conversion_cache"]
+            and not gear_args["incremental_conversion"]
+        ):
+            output, dicom_index = native.convert_archive(
+                prepare_args, work_dir, dcm2niix_args
+            )
+
+        # Convert the series of each archive directory while extraction continues
+        if (
+            output is None
+            and gear_context.config["streaming_extraction"]
+            and not gear_args["incremental_conversion"]
+        ):
+            dcm2niix_input_dir, output = streaming.extract_and_convert(
+                prepare_args, work_dir, dcm2niix_args
+            )
+
+        # Prepare dcm2niix input, which is a directory of dicom or parrec images
+        if output is None and dcm2niix_input_dir is None:
+            prepared = checkpoint.completed("prepare")
+            if prepared is not None:
+                dcm2niix_input_dir = prepared["dcm2niix_input_dir"]
+                planner.plan(dcm2niix_input_dir)
+            else:
+                with profiling.span("prepare"):
+                    dcm2niix_input_dir = prepare.setup(**prepare_args)
+                checkpoint.record(
+                    "prepare",
+                    directories=[dcm2niix_input_dir],
+                    result={"dcm2niix_input_dir": dcm2niix_input_dir},
+                )
+                footprint.sample("prepare")
+
+        # Convert only new or changed series, reusing the outputs of the others
+        if gear_args["incremental_conversion"]:
+            with profiling.span("dcm2niix", incremental=True):
+                output = incremental.convert(
+                    dcm2niix_input_dir,
+                    work_dir,
+                    prepare_args,
+                    dcm2niix_args,
+                    gear_args["cache_dir"],
+                    cache_max_size=gear_args["cache_max_size"],
+                    copy_files=gear_args["copy_files"],
+                )
+
+        # Convert and post-process each series as a pipeline; the outputs are
+        # post-processed, so are not stored in the conversion cache
+        post_process = (
+            not dcm2niix_args["output_nrrd"]
+            and dcm2niix_args["bids_sidecar"] != "o"
+            and (gear_context.config["coil_combine"] or gear_context.config["pydeface"])
+        )
+        if (
+            output is None
+            and gear_context.config["pipeline_series"]
+            and post_process
+            and not gear_args["conversion_cache"]
+            and not dcm2niix_args["ignore_errors"]
+        ):
+            pydeface_args = None
+            if gear_context.config["pydeface"]:
+                pydeface_args = parse_config.generate_gear_args(
+                    gear_context, "pydeface"
+                )
+            with profiling.span("pipeline"):
+                pipelined = series_pipeline.convert_and_process(
+                    dcm2niix_input_dir,
+                    work_dir,
+                    dcm2niix_args,
+                    coil_combine=gear_context.config["coil_combine"],
+                    pydeface_args=pydeface_args,
+                )
+            if pipelined[0] is not None:
+                output, pydeface_skipped, dicom_index = pipelined
+                post_processed = True
+
+        # Convert long series in temporal chunks in parallel
+        if output is None and gear_context.config["temporal_chunks"] > 1:
+            with profiling.span(
+                "dcm2niix", chunks=gear_context.config["temporal_chunks"]
+            ):
+                output = chunking.convert(
+                    dcm2niix_input_dir,
+                    work_dir,
+                    dcm2niix_args,
+                    chunks=gear_context.config["temporal_chunks"],
+                )
+
+        # Run dcm2niix
+        if output is None:
+            with profiling.span("dcm2niix"):
+                output = dcm2niix_run.convert_directory(
+                    dcm2niix_input_dir, work_dir, **dcm2niix_args
+                )
+
+        # Cache the outputs, before coil combination and PyDeface modify them
+        if gear_args["conversion_cache"]:
+            dicom_index = metadata.build_dicom_index(dcm2niix_input_dir)
+            conversion_cache.store(
+                cache_key,
+                output,
+                dicom_index,
+                cache_dir=gear_args["cache_dir"],
+                cache_max_size=gear_args["cache_max_size"],
+                copy_files=gear_args["copy_files"],
+            )
+
+        footprint.sample("convert")
+
+        # Release the staged input before post-processing, keeping the DICOM header
+        # index for metadata capture; PyDeface reads the frame of reference of each
+        # series from the DICOMs to reuse registrations
+        released_dir = None
+        if (
+            gear_context.config["release_input"]
+            and dcm2niix_input_dir
+            and not (
+                gear_context.config["pydeface"]
+                and gear_context.config["pydeface_reuse_registration"]
+            )
+        ):
+            dicom_index = footprint.release_input(dcm2niix_input_dir, dicom_index)
+            released_dir, dcm2niix_input_dir = dcm2niix_input_dir, None
+
+        # Journal the conversion, so that it is not repeated after a restart
+        outputs = conversion_cache.output_files(output)
+        if outputs is not None:
+            checkpoint.record(
+                "convert",
+                files=[file for files in outputs.values() for file in files],
+                directories=[dcm2niix_input_dir] if dcm2niix_input_dir else [],
+                removed=[released_dir] if released_dir else [],
+                result={
+                    "outputs": outputs,
+                    "dcm2niix_input_dir": dcm2niix_input_dir,
+                    "dicom_index": dicom_index,
+                    "post_processed": post_processed,
+                    "pydeface_skipped": pydeface_skipped,
+                },
+            )
 
     # Nipype interface output from dcm2niix can be a string or list (desired)
     try:
@@ -40,17 +290,47 @@ def main(gear_context):
         log.info("No outputs were produced from dcm2niix tool.")
         output_image_files = None
 
-    # NIfTI files are assumed to be expected for coil combined and pydeface
-    if not gear_context.config["output_nrrd"] and output_image_files is not None:
+    # NIfTI files are assumed to be expected for coil combined and pydeface; none are
+    # converted if only the sidecar is retained
+    if (
+        not dcm2niix_args["output_nrrd"]
+        and dcm2niix_args["bids_sidecar"] != "o"
+        and output_image_files is not None
+        and not post_processed
+    ):
 
         # Apply coil combined method
-        if gear_context.config["coil_combine"]:
-            dcm2niix_utils.coil_combine(output_image_files)
+        if (
+            gear_context.config["coil_combine"]
+            and checkpoint.completed("coil_combine") is None
+        ):
+            with profiling.span("coil_combine", files=len(output_image_files)):
+                dcm2niix_utils.coil_combine(output_image_files)
+            checkpoint.record("coil_combine", files=output_image_files)
 
         # Run pydeface
         if gear_context.config["pydeface"]:
             gear_args = parse_config.generate_gear_args(gear_context, "pydeface")
-            pydeface_run.deface_multiple_niftis(output_image_files, **gear_args)
+            with profiling.span("pydeface", files=len(output_image_files)):
+                pydeface_skipped = pydeface_run.deface_multiple_niftis(
+                    output_image_files,
+                    dcm2niix_input_dir=dcm2niix_input_dir,
+                    **gear_args,
+                )
+
+        footprint.sample("post-processing")
+
+    # Write NRRDs from the voxel data of the NIfTIs, after coil combined and pydeface
+    gear_args = parse_config.generate_gear_args(gear_context, "resolve")
+    if gear_context.config["output_nifti_and_nrrd"] and output_image_files is not None:
+        output_image_files.extend(
+            nrrd_export.write_nrrds(
+                output_image_files,
+                compression_level=dcm2niix_args["compression_level"],
+                reference_nifti=gear_args["retain_nifti"],
+            )
+        )
+        footprint.sample("nrrd")
 
     # If bvals or bvecs defined, then add to the list of output image files
     if isinstance(output.outputs.bvals, str):
@@ -65,16 +345,33 @@ def main(gear_context):
     if isinstance(output.outputs.bvecs, list):
         output_image_files.extend(output.outputs.bvecs)
 
+    # Index the DICOM headers for metadata capture once, if resumed after a restart
+    if checkpoint.enabled() and dicom_index is None and dcm2niix_input_dir:
+        indexed = checkpoint.completed("metadata")
+        if indexed is None:
+            with profiling.span("metadata"):
+                dicom_index = metadata.build_dicom_index(dcm2niix_input_dir)
+            checkpoint.record("metadata", result={"dicom_index": dicom_index})
+        else:
+            dicom_index = indexed["dicom_index"]
+
     # Resolve gear outputs, including metadata capture
-    gear_args = parse_config.generate_gear_args(gear_context, "resolve")
-    resolve.setup(
-        output_image_files,
-        output_sidecar_files,
-        str(gear_context.work_dir),
-        dcm2niix_input_dir,
-        gear_context.output_dir,
-        **gear_args,
-    )
+    with profiling.span("resolve"):
+        resolve.setup(
+            output_image_files,
+            output_sidecar_files,
+            work_dir,
+            dcm2niix_input_dir,
+            gear_context.output_dir,
+            pydeface_skipped=pydeface_skipped,
+            dicom_index=dicom_index,
+            **gear_args,
+        )
+
+    # Write the run profile next to the metadata file
+    footprint.report()
+    profiling.summarize()
+    profiling.write(str(gear_context.output_dir))
 
     exit_status = 0
 
@@ -0,0 +1,420 @@
+"""Generate synthetic DICOM and PAR/REC sessions for benchmarking the dcm2niix Gear.
+
+A session has a configurable shape: N series x M slices x T timepoints of MR images,
+written in a nested (one directory per series) or flat layout, and packaged as a zip
+or compressed tar archive. The pixel data can be written uncompressed (explicit or
+implicit VR little endian) or compressed (RLE lossless), so that decompression with
+gdcmconv can be benchmarked.
+
+Example:
+    python tests/benchmark/generate_session.py /tmp/session --series 4 --slices 32
+"""
+
+import argparse
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import (
+    ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian,
+    RLELossless,
+    generate_uid,
+)
+
+ASSETS_DIR = Path(__file__).parents[1] / "assets"
+
+MR_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.4"
+
+TRANSFER_SYNTAXES = {
+    "explicit": ExplicitVRLittleEndian,
+    "implicit": ImplicitVRLittleEndian,
+    "rle": RLELossless,
+}
+
+
+def generate_session(
+    output_dir,
+    n_series=1,
+    n_slices=16,
+    n_timepoints=1,
+    rows=64,
+    columns=64,
+    layout="nested",
+    archive="zip",
+    transfer_syntax="explicit",
+    missing_slices=0,
+    name="session",
+):
+    """Generate a synthetic DICOM session and return the path to it.
+
+    Args:
+        output_dir (str): The absolute path to the directory to write the session to.
+        n_series (int): The number of series.
+        n_slices (int): The number of slices per timepoint.
+        n_timepoints (int): The number of timepoints per series.
+        rows (int): The number of rows per slice.
+        columns (int): The number of columns per slice.
+        layout (str): 'nested' for one directory per series within a session
+            directory; 'flat' for all files at the top level.
+        archive (str): 'zip', 'tgz', or None for a directory.
+        transfer_syntax (str): 'explicit', 'implicit' or 'rle'.
+        missing_slices (int): The number of slices dropped from the last timepoint of
+            each series, to create incomplete volumes.
+        name (str): The name of the session archive or directory.
+
+    Returns:
+        session (str): The absolute path to the session archive or directory.
+
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(dir=output_dir)
+    session_dir = os.path.join(staging_dir, name)
+
+    study_uid = generate_uid(entropy_srcs=[name, "study"])
+    for series_number in range(1, n_series + 1):
+        if layout == "nested":
+            series_dir = os.path.join(session_dir, f"series_{series_number:03d}")
+        else:
+            series_dir = session_dir
+        os.makedirs(series_dir, exist_ok=True)
+
+        write_series(
+            series_dir,
+            study_uid,
+            series_number,
+            n_slices=n_slices,
+            n_timepoints=n_timepoints,
+            rows=rows,
+            columns=columns,
+            transfer_syntax=transfer_syntax,
+            missing_slices=missing_slices,
+        )
+
+    session = package(session_dir, output_dir, archive, nested=layout == "nested")
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    return session
+
+
+def write_series(
+    series_dir,
+    study_uid,
+    series_number,
+    n_slices=16,
+    n_timepoints=1,
+    rows=64,
+    columns=64,
+    transfer_syntax="explicit",
+    missing_slices=0,
+):
+    """Write the DICOM files of one series and return their paths."""
+    series_uid = generate_uid(entropy_srcs=[study_uid, str(series_number)])
+    frame_of_reference_uid = generate_uid(entropy_srcs=[study_uid, "frame"])
+    rng = np.random.default_rng(series_number)
+    files = []
+
+    for timepoint in range(1, n_timepoints + 1):
+        n_timepoint_slices = n_slices
+        if timepoint == n_timepoints and n_timepoints > 1:
+            n_timepoint_slices = n_slices - missing_slices
+
+        for slice_index in range(n_timepoint_slices):
+            instance_number = (timepoint - 1) * n_slices + slice_index + 1
+            pixel_array = rng.integers(0, 4096, (rows, columns), dtype=np.uint16)
+
+            ds = mr_dataset(
+                study_uid,
+                series_uid,
+                frame_of_reference_uid,
+                series_number,
+                instance_number,
+                slice_index,
+                timepoint,
+                n_timepoints,
+                pixel_array,
+                transfer_syntax,
+            )
+
+            # Filenames are unique across series, so that a flat layout does not
+            # collide, and end with .dcm, as expected by fix_dcm_vols.py
+            file = os.path.join(
+                series_dir, f"{series_number:03d}_{instance_number:06d}.dcm"
+            )
+            ds.save_as(file, write_like_original=False)
+            files.append(file)
+
+    return files
+
+
+def mr_dataset(
+    study_uid,
+    series_uid,
+    frame_of_reference_uid,
+    series_number,
+    instance_number,
+    slice_index,
+    timepoint,
+    n_timepoints,
+    pixel_array,
+    transfer_syntax="explicit",
+):
+    """Return an MR image dataset for one slice of one timepoint."""
+    sop_instance_uid = generate_uid(entropy_srcs=[series_uid, str(instance_number)])
+
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = MR_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = TRANSFER_SYNTAXES[transfer_syntax]
+    file_meta.ImplementationClassUID = pydicom.uid.PYDICOM_IMPLEMENTATION_UID
+
+    ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = transfer_syntax == "implicit"
+
+    ds.SOPClassUID = MR_IMAGE_STORAGE
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.FrameOfReferenceUID = frame_of_reference_uid
+    ds.ImageType = ["ORIGINAL", "PRIMARY", "M", "ND"]
+    ds.Modality = "MR"
+    ds.Manufacturer = "SIEMENS"
+    ds.PatientName = "Synthetic^Session"
+    ds.PatientID = "synthetic"
+    ds.StudyDate = "20200101"
+    ds.SeriesDate = "20200101"
+    ds.StudyTime = "120000"
+    ds.SeriesTime = "120000"
+    ds.AcquisitionTime = f"{120000 + timepoint:06d}.000000"
+    ds.SeriesNumber = series_number
+    ds.SeriesDescription = f"synthetic series {series_number}"
+    ds.ProtocolName = f"synthetic_{series_number}"
+    ds.InstanceNumber = instance_number
+    ds.AcquisitionNumber = timepoint
+    ds.TemporalPositionIdentifier = timepoint
+    ds.NumberOfTemporalPositions = n_timepoints
+    ds.MagneticFieldStrength = 3
+    ds.RepetitionTime = 2000
+    ds.EchoTime = 30
+    ds.FlipAngle = 90
+    ds.SliceThickness = 3
+    ds.SpacingBetweenSlices = 3
+    ds.PixelSpacing = [3, 3]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.ImagePositionPatient = [-96, -96, -48 + 3 * slice_index]
+    ds.SliceLocation = -48 + 3 * slice_index
+
+    ds.Rows, ds.Columns = pixel_array.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+
+    if transfer_syntax == "rle":
+        ds.PixelData = encapsulate([rle_encode(pixel_array)])
+        ds["PixelData"].VR = "OB"
+        ds["PixelData"].is_undefined_length = True
+    else:
+        ds.PixelData = pixel_array.tobytes()
+
+    return ds
+
+
+def rle_encode(pixel_array):
+    """Return a 16-bit frame RLE lossless encoded, as literal PackBits runs."""
+    segments = []
+
+    # Each byte of the 16-bit samples is a segment, most significant byte first
+    for shift in [8, 0]:
+        plane = ((pixel_array >> shift) & 0xFF).astype(np.uint8)
+        segment = bytearray()
+        for row in plane:
+            row = row.tobytes()
+            for start in range(0, len(row), 128):
+                literal = row[start : start + 128]
+                segment.append(len(literal) - 1)
+                segment.extend(literal)
+        if len(segment) % 2:
+            segment.append(0)
+        segments.append(bytes(segment))
+
+    offsets = [64, 64 + len(segments[0])]
+    header = struct.pack("<16L", len(segments), *offsets, *[0] * 13)
+
+    return header + b"".join(segments)
+
+
+def generate_parrec(
+    output_dir,
+    n_slices=9,
+    n_timepoints=3,
+    rows=64,
+    columns=64,
+    archive=None,
+    name="parrec",
+):
+    """Generate a synthetic PAR/REC file pair and return the path to it.
+
+        The PAR header is the header of the PAR test asset, with one image line per
+        slice and timepoint of the requested shape.
+
+    Args:
+        output_dir (str): The absolute path to the directory to write the pair to.
+        n_slices (int): The number of slices per dynamic.
+        n_timepoints (int): The number of dynamics.
+        rows (int): The number of rows per slice.
+        columns (int): The number of columns per slice.
+        archive (str): 'zip', 'tgz', or None for the PAR file of the pair.
+        name (str): The stem of the PAR/REC filenames.
+
+    Returns:
+        parrec (str): The absolute path to the archive or to the PAR file.
+
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(dir=output_dir)
+
+    with open(ASSETS_DIR / "parrec_solo.PAR", newline="") as par_file:
+        template = par_file.read().split("\r\n")
+
+    header_end = [
+        index
+        for index, line in enumerate(template)
+        if line.startswith("# === IMAGE INFORMATION ==")
+    ][0] + 3
+    image_line = template[header_end].split()
+
+    lines = []
+    for line in template[:header_end]:
+        if "Max. number of slices/locations" in line:
+            line = f"{line.split(':')[0]}:   {n_slices}"
+        elif "Max. number of dynamics" in line:
+            line = f"{line.split(':')[0]}:   {n_timepoints}"
+        lines.append(line)
+
+    index = 0
+    for timepoint in range(1, n_timepoints + 1):
+        for slice_number in range(1, n_slices + 1):
+            fields = list(image_line)
+            fields[0], fields[2], fields[6] = (
+                str(slice_number),
+                str(timepoint),
+                str(index),
+            )
+            fields[9], fields[10] = str(columns), str(rows)
+            lines.append("  " + " ".join(fields))
+            index += 1
+    lines += ["", "# === END OF DATA DESCRIPTION FILE " + "=" * 45, ""]
+
+    par = os.path.join(staging_dir, f"{name}.PAR")
+    with open(par, "w", newline="") as par_file:
+        par_file.write("\r\n".join(lines))
+
+    rng = np.random.default_rng(0)
+    with open(os.path.join(staging_dir, f"{name}.REC"), "wb") as rec_file:
+        for _ in range(index):
+            rec_file.write(rng.integers(0, 4096, (rows, columns), np.int16).tobytes())
+
+    if archive is None:
+        for file in os.listdir(staging_dir):
+            shutil.move(os.path.join(staging_dir, file), output_dir)
+        shutil.rmtree(staging_dir)
+        return os.path.join(output_dir, f"{name}.PAR")
+
+    parrec = package(staging_dir, output_dir, archive, name=name)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    return parrec
+
+
+def package(source_dir, output_dir, archive, nested=False, name=None):
+    """Package a directory as an archive in output_dir and return its path.
+
+    A nested directory is archived with its name as the top-level directory;
+    otherwise, its files are archived at the top level.
+
+    """
+    name = name or os.path.basename(source_dir)
+    files = sorted(path for path in Path(source_dir).rglob("*") if path.is_file())
+    root = Path(source_dir).parent if nested else Path(source_dir)
+
+    if archive is None:
+        target = os.path.join(output_dir, name)
+        shutil.move(source_dir, target)
+        return target
+
+    if archive == "zip":
+        target = os.path.join(output_dir, f"{name}.zip")
+        with zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED) as zip_obj:
+            for file in files:
+                zip_obj.write(file, str(file.relative_to(root)))
+
+    elif archive == "tgz":
+        target = os.path.join(output_dir, f"{name}.tgz")
+        with tarfile.open(target, "w:gz") as tar_obj:
+            for file in files:
+                tar_obj.add(file, str(file.relative_to(root)))
+
+    else:
+        raise ValueError(f"Unsupported archive type: {archive}")
+
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("output_dir")
+    parser.add_argument("--series", type=int, default=1)
+    parser.add_argument("--slices", type=int, default=16)
+    parser.add_argument("--timepoints", type=int, default=1)
+    parser.add_argument("--rows", type=int, default=64)
+    parser.add_argument("--columns", type=int, default=64)
+    parser.add_argument("--layout", choices=["nested", "flat"], default="nested")
+    parser.add_argument("--archive", choices=["zip", "tgz", "none"], default="zip")
+    parser.add_argument(
+        "--transfer-syntax", choices=list(TRANSFER_SYNTAXES), default="explicit"
+    )
+    parser.add_argument("--missing-slices", type=int, default=0)
+    parser.add_argument("--parrec", action="store_true")
+    args = parser.parse_args()
+
+    archive = None if args.archive == "none" else args.archive
+    if args.parrec:
+        session = generate_parrec(
+            args.output_dir,
+            n_slices=args.slices,
+            n_timepoints=args.timepoints,
+            rows=args.rows,
+            columns=args.columns,
+            archive=archive,
+        )
+    else:
+        session = generate_session(
+            args.output_dir,
+            n_series=args.series,
+            n_slices=args.slices,
+            n_timepoints=args.timepoints,
+            rows=args.rows,
+            columns=args.columns,
+            layout=args.layout,
+            archive=archive,
+            transfer_syntax=args.transfer_syntax,
+            missing_slices=args.missing_slices,
+        )
+
+    print(session)
+
+
+if __name__ == "__main__":
+    main()
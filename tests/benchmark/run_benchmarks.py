@@ -0,0 +1,347 @@
+"""Benchmark the stages of the dcm2niix Gear on synthetic sessions of increasing size.
+
+For each session size, a synthetic session is generated with generate_session.py and
+each stage is timed over a number of repeats, with a fresh copy of its input. The
+median time, the throughput and the scaling exponent (the slope of log time against
+log file count; 1 is linear) of each stage are reported, and can be saved as JSON to
+compare before and after a change. Stages that need an external tool are skipped if
+the tool is not found or if --skip-external is set.
+
+Example:
+    python tests/benchmark/run_benchmarks.py --series 1 2 4 8 --output before.json
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parents[2]))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from dcm2niix_gear.dcm2niix import arrange  # noqa: E402
+from dcm2niix_gear.dcm2niix import dcm2niix_utils  # noqa: E402
+from dcm2niix_gear.utils import metadata  # noqa: E402
+from dcm2niix_gear.utils import resolve  # noqa: E402
+
+import generate_session  # noqa: E402
+
+# External tools needed by each stage, if any
+STAGES = {
+    "prepare_dcm2niix_input": None,
+    "prepare_parrec": None,
+    "tally_files": None,
+    "flatten_directory": None,
+    "remove_incomplete_volumes": None,
+    "decompress_dicoms": "gdcmconv",
+    "metadata_capture": None,
+    "retain_gear_outputs": None,
+}
+
+
+def benchmark_prepare_dcm2niix_input(case, scratch_dir):
+    """Time extraction and flattening of the session archive."""
+    start = time.perf_counter()
+    arrange.prepare_dcm2niix_input(case["archive"], None, scratch_dir)
+    return time.perf_counter() - start
+
+
+def benchmark_prepare_parrec(case, scratch_dir):
+    """Time arrangement of a PAR/REC archive of the same number of slices."""
+    start = time.perf_counter()
+    arrange.prepare_dcm2niix_input(case["parrec"], None, scratch_dir)
+    return time.perf_counter() - start
+
+
+def benchmark_tally_files(case, scratch_dir):
+    """Time the tally of the nested session directory."""
+    start = time.perf_counter()
+    arrange.tally_files(case["nested_dir"])
+    return time.perf_counter() - start
+
+
+def benchmark_flatten_directory(case, scratch_dir):
+    """Time flattening a copy of the nested session directory."""
+    nested_dir = os.path.join(scratch_dir, "nested")
+    shutil.copytree(case["nested_dir"], nested_dir)
+
+    start = time.perf_counter()
+    arrange.flatten_directory(nested_dir, os.path.join(scratch_dir, "flat"))
+    return time.perf_counter() - start
+
+
+def benchmark_remove_incomplete_volumes(case, scratch_dir):
+    """Time the incomplete volume correction of a copy of the flat session."""
+    flat_dir = os.path.join(scratch_dir, "flat")
+    shutil.copytree(case["flat_dir"], flat_dir)
+
+    start = time.perf_counter()
+    dcm2niix_utils.remove_incomplete_volumes(flat_dir)
+    return time.perf_counter() - start
+
+
+def benchmark_decompress_dicoms(case, scratch_dir):
+    """Time decompression of a copy of the RLE compressed flat session."""
+    flat_dir = os.path.join(scratch_dir, "flat")
+    shutil.copytree(case["compressed_dir"], flat_dir)
+
+    start = time.perf_counter()
+    dcm2niix_utils.decompress_dicoms(flat_dir)
+    return time.perf_counter() - start
+
+
+def benchmark_metadata_capture(case, scratch_dir):
+    """Time metadata capture, including the DICOM header scan, for every series."""
+    image_files, sidecar_files = fake_outputs(case, scratch_dir)
+
+    start = time.perf_counter()
+    metadata.capture(
+        image_files, sidecar_files, scratch_dir, dcm2niix_input_dir=case["flat_dir"]
+    )
+    return time.perf_counter() - start
+
+
+def benchmark_retain_gear_outputs(case, scratch_dir):
+    """Time moving the converted images, sidecars and metadata file to the output."""
+    image_files, sidecar_files = fake_outputs(case, scratch_dir)
+    metadata_file = os.path.join(scratch_dir, ".metadata.json")
+    with open(metadata_file, "w") as file_obj:
+        json.dump({}, file_obj)
+    output_dir = os.path.join(scratch_dir, "output")
+    os.mkdir(output_dir)
+
+    start = time.perf_counter()
+    resolve.retain_gear_outputs(
+        image_files,
+        sidecar_files,
+        metadata_file,
+        scratch_dir,
+        output_dir,
+        retain_sidecar=True,
+    )
+    return time.perf_counter() - start
+
+
+def fake_outputs(case, scratch_dir):
+    """Write a sidecar and an image file of the converted size for each series."""
+    image_files = []
+    sidecar_files = []
+    image_size = (
+        2 * case["rows"] * case["columns"] * case["slices"] * case["timepoints"]
+    )
+
+    for series_number in range(1, case["series"] + 1):
+        stem = os.path.join(scratch_dir, f"session_synthetic_{series_number}")
+        with open(f"{stem}.json", "w") as sidecar_file:
+            json.dump(
+                {
+                    "SeriesDescription": f"synthetic_series_{series_number}",
+                    "SeriesNumber": series_number,
+                    "Modality": "MR",
+                },
+                sidecar_file,
+            )
+        with open(f"{stem}.nii.gz", "wb") as image_file:
+            image_file.truncate(image_size)
+        sidecar_files.append(f"{stem}.json")
+        image_files.append(f"{stem}.nii.gz")
+
+    return image_files, sidecar_files
+
+
+def prepare_case(data_dir, args, n_series, stages):
+    """Generate the session inputs for one size, as needed by the stages."""
+    case = {
+        "series": n_series,
+        "slices": args.slices,
+        "timepoints": args.timepoints,
+        "rows": args.rows,
+        "columns": args.columns,
+    }
+    case_dir = os.path.join(data_dir, f"series_{n_series}")
+    os.makedirs(case_dir, exist_ok=True)
+
+    shape = {
+        "n_series": n_series,
+        "n_slices": args.slices,
+        "n_timepoints": args.timepoints,
+        "rows": args.rows,
+        "columns": args.columns,
+        "missing_slices": args.missing_slices,
+    }
+
+    case["archive"] = generate_session.generate_session(
+        case_dir,
+        layout=args.layout,
+        archive=args.archive,
+        transfer_syntax=args.transfer_syntax,
+        **shape,
+    )
+    case["nested_dir"] = generate_session.generate_session(
+        case_dir, layout="nested", archive=None, name="nested", **shape
+    )
+    case["flat_dir"] = generate_session.generate_session(
+        case_dir, layout="flat", archive=None, name="flat", **shape
+    )
+
+    if "decompress_dicoms" in stages:
+        case["compressed_dir"] = generate_session.generate_session(
+            case_dir,
+            layout="flat",
+            archive=None,
+            transfer_syntax="rle",
+            name="compressed",
+            **shape,
+        )
+
+    if "prepare_parrec" in stages:
+        case["parrec"] = generate_session.generate_parrec(
+            case_dir,
+            n_slices=args.slices,
+            n_timepoints=args.timepoints * n_series,
+            rows=args.rows,
+            columns=args.columns,
+            archive=args.archive,
+        )
+
+    case["files"] = len(glob.glob(os.path.join(case["flat_dir"], "*")))
+    case["bytes"] = sum(
+        os.path.getsize(file) for file in glob.glob(os.path.join(case["flat_dir"], "*"))
+    )
+
+    return case
+
+
+def run_stage(stage, case, repeat):
+    """Return the times of a stage over repeats, each with a fresh scratch directory."""
+    benchmark = globals()[f"benchmark_{stage}"]
+    times = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            times.append(benchmark(case, scratch_dir))
+    return times
+
+
+def scaling_exponent(files, times):
+    """Return the slope of log time against log file count."""
+    if len(files) < 2 or min(times) <= 0:
+        return None
+    return float(np.polyfit(np.log(files), np.log(times), 1)[0])
+
+
+def report(results):
+    """Print the scaling curve of each stage."""
+    for stage, rows in results["stages"].items():
+        print(f"\n{stage}")
+        print(
+            f"  {'series':>6} {'files':>7} {'MB':>8} {'median s':>10} {'files/s':>10}"
+        )
+        for row in rows:
+            print(
+                f"  {row['series']:>6} {row['files']:>7} "
+                f"{row['bytes'] / 1024 ** 2:>8.1f} {row['median']:>10.4f} "
+                f"{row['files'] / row['median'] if row['median'] else 0:>10.1f}"
+            )
+        exponent = results["scaling"].get(stage)
+        if exponent is not None:
+            print(f"  scaling exponent: {exponent:.2f}")
+
+    for stage, reason in results["skipped"].items():
+        print(f"\n{stage} skipped: {reason}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--series",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help="Session sizes, as numbers of series.",
+    )
+    parser.add_argument("--slices", type=int, default=32)
+    parser.add_argument("--timepoints", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=64)
+    parser.add_argument("--columns", type=int, default=64)
+    parser.add_argument("--missing-slices", type=int, default=1)
+    parser.add_argument("--layout", choices=["nested", "flat"], default="nested")
+    parser.add_argument("--archive", choices=["zip", "tgz"], default="zip")
+    parser.add_argument(
+        "--transfer-syntax",
+        choices=list(generate_session.TRANSFER_SYNTAXES),
+        default="explicit",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=None)
+    parser.add_argument(
+        "--skip-external",
+        action="store_true",
+        help="Skip stages that need an external tool (e.g., gdcmconv).",
+    )
+    parser.add_argument(
+        "--data-dir", help="Directory to keep the generated sessions in."
+    )
+    parser.add_argument("--output", help="Path to save the results as JSON.")
+    args = parser.parse_args()
+
+    # The gear logs every file it moves; only report warnings and errors
+    logging.basicConfig(level=logging.WARNING)
+
+    # fix_dcm_vols.py is found in the gear directory, or in tests/local outside it
+    if not os.getenv("FLYWHEEL"):
+        os.environ["FLYWHEEL"] = str(Path(__file__).parents[1] / "local")
+
+    results = {"arguments": vars(args), "stages": {}, "scaling": {}, "skipped": {}}
+    stages = []
+    for stage in args.stages or STAGES:
+        tool = STAGES[stage]
+        if tool and args.skip_external:
+            results["skipped"][stage] = f"{tool} is an external tool"
+        elif tool and not shutil.which(tool):
+            results["skipped"][stage] = f"{tool} not found"
+        else:
+            stages.append(stage)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="dcm2niix_benchmark_")
+    try:
+        for n_series in args.series:
+            case = prepare_case(data_dir, args, n_series, stages)
+            for stage in stages:
+                times = run_stage(stage, case, args.repeat)
+                results["stages"].setdefault(stage, []).append(
+                    {
+                        "series": n_series,
+                        "files": case["files"],
+                        "bytes": case["bytes"],
+                        "times": times,
+                        "median": statistics.median(times),
+                    }
+                )
+
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    for stage, rows in results["stages"].items():
+        results["scaling"][stage] = scaling_exponent(
+            [row["files"] for row in rows], [row["median"] for row in rows]
+        )
+
+    report(results)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
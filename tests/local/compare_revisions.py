@@ -0,0 +1,449 @@
+"""Run two revisions of the dcm2niix Gear offline on a corpus and compare the results.
+
+Each revision is checked out in a git worktree (or, for the head revision, the
+working tree is used as is), and run.main is run on each input in the corpus
+directory with a stand-in for the GearToolkitContext, in a separate process per
+run. The config is the manifest defaults of each revision, updated with the
+"config" of an optional config JSON in the format of the defaults_*.json files in
+this directory, whose "inputs" also set the modality and classification.
+
+Outputs are compared file by file: NIfTI image data and affines, parsed JSON (BIDS
+sidecars and .metadata.json) and the bytes of all other files. Per-stage timings are
+taken from the run profile, where the revision writes one, and the total time of
+each run is always measured. A stage is flagged as a slowdown if its median time
+increased by more than the tolerance and by more than a minimum number of seconds.
+The script exits with status 1 if any output differs or any stage slowed down.
+
+Example:
+    python tests/local/compare_revisions.py ~/corpus --base master --repeat 3
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import nibabel as nb
+import numpy as np
+
+REPO_DIR = Path(__file__).parents[2]
+
+PROFILE_FILENAME = ".profile.json"
+
+NIFTI_EXTENSIONS = (".nii", ".nii.gz")
+
+
+class GearContext:
+    """Stand-in for the GearToolkitContext used by run.main."""
+
+    def __init__(self, manifest_file, config_json, input_file, work_dir, output_dir):
+        with open(manifest_file) as manifest_obj:
+            manifest = json.load(manifest_obj)
+
+        self.config = {
+            name: option["default"]
+            for name, option in manifest.get("config", {}).items()
+            if "default" in option
+        }
+        self.config.update(config_json.get("config", {}))
+
+        dcm2niix_input = config_json.get("inputs", {}).get("dcm2niix_input", {})
+        dcm2niix_input["location"] = {
+            "name": os.path.basename(input_file),
+            "path": str(input_file),
+        }
+        self.config_json = {
+            "config": self.config,
+            "inputs": {
+                **config_json.get("inputs", {}),
+                "dcm2niix_input": dcm2niix_input,
+            },
+        }
+
+        self.work_dir = Path(work_dir)
+        self.output_dir = Path(output_dir)
+        self.log = logging.getLogger("run")
+
+    def get_input_path(self, name):
+        return self.config_json["inputs"].get(name, {}).get("location", {}).get("path")
+
+
+def run_one(checkout, input_file, config_file, run_dir):
+    """Run run.main of a checkout on one input, in this process.
+
+    Writes result.json to run_dir, with the exit status and the total time.
+
+    """
+    sys.path.insert(0, str(checkout))
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s"
+    )
+
+    config_json = {}
+    if config_file:
+        with open(config_file) as config_obj:
+            config_json = json.load(config_obj)
+
+    work_dir = os.path.join(run_dir, "work")
+    output_dir = os.path.join(run_dir, "output")
+    os.makedirs(work_dir)
+    os.makedirs(output_dir)
+
+    gear_context = GearContext(
+        os.path.join(checkout, "manifest.json"),
+        config_json,
+        input_file,
+        work_dir,
+        output_dir,
+    )
+
+    import run
+
+    # run.log is only defined when run.py is executed as a script
+    run.log = gear_context.log
+
+    start = time.perf_counter()
+    try:
+        exit_status = run.main(gear_context)
+    except SystemExit as exception:
+        exit_status = exception.code
+    except Exception:
+        logging.exception("Gear raised an exception.")
+        exit_status = "exception"
+    wall_time = time.perf_counter() - start
+
+    with open(os.path.join(run_dir, "result.json"), "w") as result_obj:
+        json.dump({"exit_status": exit_status, "wall_time": wall_time}, result_obj)
+
+
+def run_revision(checkout, input_file, config_file, run_dir):
+    """Run a checkout on one input in a separate process and return its result."""
+    os.makedirs(run_dir)
+    environment = dict(os.environ)
+
+    # fix_dcm_vols.py is found in the gear directory, or in tests/local outside it
+    if not os.path.isfile(
+        os.path.join(environment.get("FLYWHEEL", ""), "fix_dcm_vols.py")
+    ):
+        environment["FLYWHEEL"] = str(Path(checkout) / "tests" / "local")
+
+    command = [sys.executable, __file__, "run-one", str(checkout), str(input_file)]
+    command.append(str(config_file) if config_file else "")
+    command.append(str(run_dir))
+
+    with open(os.path.join(run_dir, "gear.log"), "w") as log_obj:
+        subprocess.run(
+            command,
+            cwd=run_dir,
+            env=environment,
+            stdout=log_obj,
+            stderr=subprocess.STDOUT,
+        )
+
+    try:
+        with open(os.path.join(run_dir, "result.json")) as result_obj:
+            result = json.load(result_obj)
+    except FileNotFoundError:
+        result = {"exit_status": "crashed", "wall_time": None}
+
+    result["timings"] = {"total": result["wall_time"]}
+    profile_file = os.path.join(run_dir, "output", PROFILE_FILENAME)
+    if os.path.isfile(profile_file):
+        with open(profile_file) as profile_obj:
+            for span in json.load(profile_obj)["spans"]:
+                result["timings"][span["path"]] = span["wall_time"]
+
+    return result
+
+
+def compare_outputs(base_dir, head_dir):
+    """Return the differences between the output files of two runs."""
+    base_files = output_files(base_dir)
+    head_files = output_files(head_dir)
+    differences = []
+
+    for file in sorted(base_files - head_files):
+        differences.append(f"{file}: only in base")
+    for file in sorted(head_files - base_files):
+        differences.append(f"{file}: only in head")
+
+    for file in sorted(base_files & head_files):
+        difference = compare_file(
+            os.path.join(base_dir, file), os.path.join(head_dir, file)
+        )
+        if difference:
+            differences.append(f"{file}: {difference}")
+
+    return differences
+
+
+def output_files(output_dir):
+    """Return the output files relative to the output directory, without the profile."""
+    if not os.path.isdir(output_dir):
+        return set()
+    return {
+        str(path.relative_to(output_dir))
+        for path in Path(output_dir).rglob("*")
+        if path.is_file() and path.name != PROFILE_FILENAME
+    }
+
+
+def compare_file(base_file, head_file):
+    """Return a description of the difference between two files, or None."""
+    if base_file.endswith(NIFTI_EXTENSIONS):
+        base_img, head_img = nb.load(base_file), nb.load(head_file)
+        if base_img.shape != head_img.shape:
+            return f"shape {base_img.shape} != {head_img.shape}"
+        if not np.allclose(base_img.affine, head_img.affine, atol=1e-5):
+            return "affine differs"
+        if not np.array_equal(
+            np.asanyarray(base_img.dataobj), np.asanyarray(head_img.dataobj)
+        ):
+            return "image data differs"
+        return None
+
+    if base_file.endswith(".json"):
+        with open(base_file) as base_obj, open(head_file) as head_obj:
+            base_json, head_json = json.load(base_obj), json.load(head_obj)
+        if os.path.basename(base_file) == ".metadata.json":
+            base_json, head_json = sort_metadata(base_json), sort_metadata(head_json)
+        if base_json == head_json:
+            return None
+        return "JSON differs" + json_difference(base_json, head_json)
+
+    if file_hash(base_file) != file_hash(head_file):
+        return "content differs"
+    return None
+
+
+def sort_metadata(metadata):
+    """Sort the files of a metadata file by name, so the order is not compared."""
+    files = metadata.get("acquisition", {}).get("files", [])
+    metadata.get("acquisition", {})["files"] = sorted(
+        files, key=lambda file: file["name"]
+    )
+    return metadata
+
+
+def json_difference(base_json, head_json, path=""):
+    """Return the first differing key path between two JSON values."""
+    if isinstance(base_json, dict) and isinstance(head_json, dict):
+        for key in sorted(set(base_json) | set(head_json)):
+            if base_json.get(key) != head_json.get(key):
+                return json_difference(
+                    base_json.get(key), head_json.get(key), f"{path}/{key}"
+                )
+    if isinstance(base_json, list) and isinstance(head_json, list):
+        for index, (base_value, head_value) in enumerate(zip(base_json, head_json)):
+            if base_value != head_value:
+                return json_difference(base_value, head_value, f"{path}/{index}")
+    return f" at {path or '/'}: {base_json!r} != {head_json!r}"
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file_obj:
+        for chunk in iter(lambda: file_obj.read(2**22), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compare_timings(base_runs, head_runs, tolerance, min_seconds):
+    """Return the median timings of both revisions per stage, flagging slowdowns."""
+    stages = []
+    for run in base_runs + head_runs:
+        stages.extend(stage for stage in run["timings"] if stage not in stages)
+
+    timings = {}
+    for stage in stages:
+        base_times = [
+            run["timings"][stage]
+            for run in base_runs
+            if run["timings"].get(stage) is not None
+        ]
+        head_times = [
+            run["timings"][stage]
+            for run in head_runs
+            if run["timings"].get(stage) is not None
+        ]
+        if not base_times or not head_times:
+            continue
+        base_median = statistics.median(base_times)
+        head_median = statistics.median(head_times)
+        timings[stage] = {
+            "base": base_median,
+            "head": head_median,
+            "slowdown": (
+                head_median > base_median * (1 + tolerance)
+                and head_median - base_median > min_seconds
+            ),
+        }
+
+    return timings
+
+
+def checkout_revision(revision, checkouts_dir):
+    """Return the directory of a revision; the working tree for 'WORKTREE'."""
+    if revision == "WORKTREE":
+        return REPO_DIR
+
+    checkout = os.path.join(checkouts_dir, revision.replace("/", "_"))
+    subprocess.run(
+        ["git", "-C", str(REPO_DIR), "worktree", "add", "--detach", checkout, revision],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return Path(checkout)
+
+
+def remove_checkout(checkout):
+    if Path(checkout) != REPO_DIR:
+        subprocess.run(
+            [
+                "git",
+                "-C",
+                str(REPO_DIR),
+                "worktree",
+                "remove",
+                "--force",
+                str(checkout),
+            ],
+            check=False,
+        )
+
+
+def compare(args):
+    """Run both revisions over the corpus and return the report."""
+    inputs = sorted(
+        path
+        for path in Path(args.corpus_dir).iterdir()
+        if path.is_file() and not path.name.startswith(".")
+    )
+    runs_dir = args.runs_dir or tempfile.mkdtemp(prefix="dcm2niix_compare_")
+    checkouts = {}
+    report = {"base": args.base, "head": args.head, "inputs": {}}
+
+    try:
+        for name, revision in [("base", args.base), ("head", args.head)]:
+            checkouts[name] = checkout_revision(
+                revision, os.path.join(runs_dir, "checkouts")
+            )
+
+        for input_file in inputs:
+            print(f"Running {input_file.name}", flush=True)
+            runs = {"base": [], "head": []}
+            for repeat in range(args.repeat):
+                for name in ["base", "head"]:
+                    run_dir = os.path.join(
+                        runs_dir, input_file.name, f"{name}_{repeat}"
+                    )
+                    runs[name].append(
+                        run_revision(checkouts[name], input_file, args.config, run_dir)
+                    )
+
+            differences = compare_outputs(
+                os.path.join(runs_dir, input_file.name, "base_0", "output"),
+                os.path.join(runs_dir, input_file.name, "head_0", "output"),
+            )
+            base_status = runs["base"][0]["exit_status"]
+            head_status = runs["head"][0]["exit_status"]
+            if base_status != head_status:
+                differences.insert(0, f"exit status {base_status} != {head_status}")
+            for name, status in [("base", base_status), ("head", head_status)]:
+                if status in ["crashed", "exception"]:
+                    differences.insert(0, f"{name} run did not complete ({status})")
+
+            report["inputs"][input_file.name] = {
+                "differences": differences,
+                "timings": compare_timings(
+                    runs["base"], runs["head"], args.tolerance, args.min_seconds
+                ),
+            }
+
+    finally:
+        for checkout in checkouts.values():
+            remove_checkout(checkout)
+        if not args.runs_dir:
+            shutil.rmtree(runs_dir, ignore_errors=True)
+
+    return report
+
+
+def print_report(report):
+    """Print the differences and timings of each input; return True if all pass."""
+    passed = True
+    for input_name, result in report["inputs"].items():
+        print(f"\n{input_name}")
+        for difference in result["differences"]:
+            print(f"  DIFFERENT  {difference}")
+            passed = False
+        if not result["differences"]:
+            print("  outputs identical")
+
+        print(f"  {'stage':<40} {'base s':>9} {'head s':>9} {'change':>8}")
+        for stage, timing in result["timings"].items():
+            change = timing["head"] / timing["base"] - 1 if timing["base"] else 0
+            flag = "  SLOWER" if timing["slowdown"] else ""
+            print(
+                f"  {stage:<40} {timing['base']:>9.2f} {timing['head']:>9.2f} "
+                f"{change:>+8.1%}{flag}"
+            )
+            passed = passed and not timing["slowdown"]
+
+    return passed
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "run-one":
+        checkout, input_file, config_file, run_dir = sys.argv[2:6]
+        run_one(checkout, input_file, config_file or None, run_dir)
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("corpus_dir", help="Directory of gear inputs to run.")
+    parser.add_argument("--base", required=True, help="Git revision to compare to.")
+    parser.add_argument(
+        "--head",
+        default="WORKTREE",
+        help="Git revision to compare; the working tree by default.",
+    )
+    parser.add_argument(
+        "--config", help="Config JSON, e.g. defaults_with_modality_set.json."
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fractional increase in a stage time flagged as a slowdown.",
+    )
+    parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=0.5,
+        help="Minimum increase in seconds of a stage time flagged as a slowdown.",
+    )
+    parser.add_argument("--runs-dir", help="Directory to keep the runs in.")
+    parser.add_argument("--output", help="Path to save the report as JSON.")
+    args = parser.parse_args()
+
+    report = compare(args)
+    passed = print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as output_obj:
+            json.dump(report, output_obj, indent=2)
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
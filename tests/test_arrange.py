@@ -1,14 +1,23 @@
 """Testing for functions within arrange.py script."""
 
 import filecmp
+import gzip
+import lzma
 import pytest
 import os
 import shutil
+import subprocess
 import tarfile
 import zipfile
 from pathlib import Path
 
+import nibabel as nb
+import numpy as np
+import pydicom
+
 from dcm2niix_gear.dcm2niix import arrange
+from dcm2niix_gear.dcm2niix import native
+from dcm2niix_gear.dcm2niix import streaming
 
 ASSETS_DIR = Path(__file__).parent / "assets"
 
@@ -41,6 +50,8 @@ def test_CleanInfilepath_Extensions_Match():
     assert arrange.clean_filename("parrec.parrec.zip") == "parrec"
     assert arrange.clean_filename("parrec.PAR") == "parrec"
     assert arrange.clean_filename("parrec") == "parrec"
+    assert arrange.clean_filename("dicom.dcm.tar.zst") == "dicom"
+    assert arrange.clean_filename("dicom.tar.xz") == "dicom"
 
 
 def test_CleanInfilepath_Alphanumerics_Match():
@@ -138,6 +149,119 @@ def test_PrepareDcm2niixInput_Archive_CatchCollisionError(version, ext, tmpdir):
     assert exception.type == SystemExit
 
 
+@pytest.mark.parametrize("version", [
+    "dicom_nested_one_level_collision",
+    "dicom_nested_two_levels_collision",
+    "dicom_nested_uneven_collision",
+])
+def test_PrepareDcm2niixInput_DuplicateInstances_RemoveDuplicates(version, tmpdir):
+    """Tests that duplicate instances of the same name in different subdirectories
+    are removed before flattening, rather than stopping on the collision."""
+    infile = f"{ASSETS_DIR}/{version}.zip"
+
+    dcm2niix_input_dir = arrange.prepare_dcm2niix_input(
+        infile, False, str(tmpdir), remove_duplicates=True
+    )
+
+    dicom_files = [
+        file for file in os.listdir(dcm2niix_input_dir) if file.endswith(".dcm")
+    ]
+    with zipfile.ZipFile(infile) as zip_obj:
+        names = set(
+            Path(name).name for name in zip_obj.namelist() if name.endswith(".dcm")
+        )
+    assert sorted(dicom_files) == sorted(names)
+
+
+def test_RemoveDuplicateInstances_RenamedCopy_KeepFirstCopy(tmpdir):
+
+    with zipfile.ZipFile(f"{ASSETS_DIR}/dicom_single.zip") as zip_obj:
+        zip_obj.extractall(str(tmpdir))
+    dicom_file = sorted(Path(tmpdir).rglob("*.dcm"))[0]
+    copy = tmpdir.mkdir("resent").join("copy.dcm")
+    shutil.copy2(str(dicom_file), str(copy))
+    tmpdir.join("notes.txt").write("notes")
+    tmpdir.join("resent").join("notes.txt").write("notes")
+
+    duplicates = arrange.remove_duplicate_instances(str(tmpdir))
+
+    assert duplicates == {
+        str(copy): str(dicom_file),
+        str(tmpdir.join("resent").join("notes.txt")): str(tmpdir.join("notes.txt")),
+    }
+    assert not copy.exists()
+    assert dicom_file.exists()
+
+
+@pytest.mark.parametrize(
+    "compression",
+    [
+        "xz",
+        pytest.param(
+            "zstd",
+            marks=pytest.mark.skipif(
+                not shutil.which("zstd"), reason="zstd is not installed"
+            ),
+        ),
+    ],
+)
+@pytest.mark.parametrize("version", ["dicom_nested", "dicom_single", "parrec_single"])
+def test_PrepareDcm2niixInput_CompressedTarStream_MatchTgzArrangement(
+    tmpdir, version, compression
+):
+    """Recompresses a tgz asset and compares the arranged input with the tgz input."""
+    tar_file = tmpdir.join(f"{version}.tar")
+    with gzip.open(f"{ASSETS_DIR}/{version}.tgz") as gzip_obj:
+        tar_file.write_binary(gzip_obj.read())
+    if compression == "xz":
+        infile = tmpdir.join(f"{version}.tar.xz")
+        infile.write_binary(lzma.compress(tar_file.read_binary()))
+    else:
+        infile = tmpdir.join(f"{version}.tar.zst")
+        subprocess.run(["zstd", "--quiet", str(tar_file), "-o", str(infile)], check=True)
+
+    tgz_dir = arrange.prepare_dcm2niix_input(
+        f"{ASSETS_DIR}/{version}.tgz", None, str(tmpdir.mkdir("tgz"))
+    )
+    dcm2niix_input_dir = arrange.prepare_dcm2niix_input(
+        str(infile), None, str(tmpdir.mkdir("stream"))
+    )
+
+    assert arrange.compressed_tar_format(str(infile)) == compression
+    assert os.path.basename(dcm2niix_input_dir) == os.path.basename(tgz_dir)
+    assert sorted(os.listdir(dcm2niix_input_dir)) == sorted(os.listdir(tgz_dir))
+    assert os.listdir(tmpdir.join("stream")) == [os.path.basename(tgz_dir)]
+
+
+@pytest.mark.parametrize("arcname", ["dicoms", "."])
+def test_PrepareDcm2niixInput_LinkInCompressedTar_MatchTgzArrangement(
+    tmpdir, arcname
+):
+    """Links of a streamed tar archive are kept or dropped as for a tgz archive."""
+    source = tmpdir.mkdir("source")
+    source.join("one.dcm").write_binary(b"dicom")
+    os.symlink("one.dcm", str(source.join("link.dcm")))
+    for suffix, mode in (("tgz", "w:gz"), ("tar.xz", "w:xz")):
+        with tarfile.open(str(tmpdir.join(f"dicoms.{suffix}")), mode) as tar_obj:
+            if arcname == ".":
+                for name in ("one.dcm", "link.dcm"):
+                    tar_obj.add(str(source.join(name)), arcname=name)
+            else:
+                tar_obj.add(str(source), arcname=arcname)
+
+    tgz_dir = arrange.prepare_dcm2niix_input(
+        str(tmpdir.join("dicoms.tgz")), None, str(tmpdir.mkdir("tgz"))
+    )
+    dcm2niix_input_dir = arrange.prepare_dcm2niix_input(
+        str(tmpdir.join("dicoms.tar.xz")), None, str(tmpdir.mkdir("stream"))
+    )
+
+    def listing(directory):
+        return {path.name: path.is_symlink() for path in Path(directory).iterdir()}
+
+    assert listing(dcm2niix_input_dir) == listing(tgz_dir)
+
+
 def test_PrepareDcm2niixInput_ParRecSolo_MatchValidDataset(tmpdir):
     """Compares output of prepare_dcm2niix_input on parrec_solo input
     with known answer, valid output.
@@ -158,3 +282,162 @@ def test_PrepareDcm2niixInput_ParRecSolo_MatchValidDataset(tmpdir):
 
     assert out.left_only == []
     assert out.right_only == []
+
+
+@pytest.mark.parametrize(
+    "archive", ["dicom_nested.zip", "dicom_nested.tgz", "dicom_single.zip"]
+)
+def test_StreamingExtraction_Archive_MatchSerialArrangement(tmpdir, archive):
+
+    serial_dir = tmpdir.mkdir("serial")
+    streaming_dir = tmpdir.mkdir("streaming")
+    extract_dir = streaming_dir.mkdir(".streaming").join("extract")
+    extract_dir.mkdir()
+
+    dcm2niix_input_dir = arrange.prepare_dcm2niix_input(
+        f"{ASSETS_DIR}/{archive}", None, str(serial_dir)
+    )
+
+    extraction = {}
+    groups = list(
+        streaming.extract_directories(
+            f"{ASSETS_DIR}/{archive}", str(extract_dir), extraction
+        )
+    )
+    streaming_input_dir = streaming.arrange_extracted(
+        f"{ASSETS_DIR}/{archive}", str(extract_dir), str(streaming_dir), extraction
+    )
+
+    assert os.path.basename(streaming_input_dir) == os.path.basename(
+        dcm2niix_input_dir
+    )
+    assert sorted(os.listdir(streaming_input_dir)) == sorted(
+        os.listdir(dcm2niix_input_dir)
+    )
+    assert groups
+    assert all(
+        group["folder"] == os.path.basename(dcm2niix_input_dir) for group in groups
+    )
+
+
+NATIVE_DCM2NIIX_ARGS = {
+    "bids_sidecar": "y",
+    "comment": "",
+    "compress_images": "y",
+    "compression_level": 6,
+    "convert_only_series": "all",
+    "crop": False,
+    "filename": "%f_%s",
+    "ignore_derived": False,
+    "ignore_errors": False,
+    "lossless_scaling": "n",
+    "output_nrrd": False,
+    "single_file_mode": False,
+}
+
+
+def native_prepare_args(infile):
+    return {
+        "infile": infile,
+        "rec_infile": None,
+        "remove_incomplete_volumes": False,
+        "decompress_dicoms": False,
+    }
+
+
+def native_archive(tmpdir, compression, orientation=(1, 0, 0, 0, 1, 0)):
+    """Make a CT series, in reverse order along the normal, from the test DICOMs."""
+    archive = os.path.join(str(tmpdir), "axial_ct.zip")
+    normal = np.cross(orientation[:3], orientation[3:])
+    slices = []
+    with zipfile.ZipFile(f"{ASSETS_DIR}/dicom_single.zip") as source, zipfile.ZipFile(
+        archive, "w", compression
+    ) as target:
+        names = [name for name in source.namelist() if not name.endswith("/")]
+        for index, name in enumerate(names):
+            dicom_file = str(tmpdir.join(os.path.basename(name)))
+            with open(dicom_file, "wb") as dicom:
+                dicom.write(source.read(name))
+            dicom_header = pydicom.dcmread(dicom_file)
+            dicom_header.Manufacturer = "GE MEDICAL SYSTEMS"
+            dicom_header.Modality = "CT"
+            dicom_header.ImageOrientationPatient = list(orientation)
+            dicom_header.ImagePositionPatient = list(
+                np.array([-100, -120, 0]) + 2.5 * (len(names) - index) * normal
+            )
+            dicom_header.save_as(dicom_file)
+            target.write(dicom_file, name)
+            slices.insert(0, dicom_header.pixel_array)
+
+    return archive, slices, float(dicom_header.PixelSpacing[0])
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_NativeConvertArchive_AxialSeries_MatchPixelData(tmpdir, compression):
+
+    archive, slices, row_spacing = native_archive(tmpdir, compression)
+
+    work_dir = tmpdir.mkdir("work")
+    output, dicom_index = native.convert_archive(
+        native_prepare_args(archive), str(work_dir), NATIVE_DCM2NIIX_ARGS
+    )
+
+    assert [os.path.basename(file) for file in output.outputs.converted_files] == [
+        "axial_ct_201.nii.gz"
+    ]
+    image = nb.load(output.outputs.converted_files[0])
+    data = np.asanyarray(image.dataobj)
+    assert data.shape == (slices[0].shape[1], slices[0].shape[0], len(slices))
+    for index, pixel_array in enumerate(slices):
+        assert np.array_equal(data[:, :, index], pixel_array[::-1].T)
+    assert np.allclose(image.affine[:3, 1], [0, row_spacing, 0])
+    assert np.allclose(image.affine[:3, 2], [0, 0, 2.5])
+    assert np.allclose(
+        image.affine[:3, 3],
+        [100, 120 - row_spacing * (slices[0].shape[0] - 1), 2.5],
+    )
+    assert list(dicom_index) == ["201/sT1W_3D_TFE_SAG"]
+
+
+def test_NativeConvertArchive_CoronalSeries_ConvertWithDcm2niix(tmpdir):
+
+    archive, _, _ = native_archive(tmpdir, zipfile.ZIP_STORED, (1, 0, 0, 0, 0, -1))
+    work_dir = tmpdir.mkdir("work")
+
+    output, dicom_index = native.convert_archive(
+        native_prepare_args(archive), str(work_dir), NATIVE_DCM2NIIX_ARGS
+    )
+
+    assert output is None
+    assert dicom_index is None
+    assert os.listdir(str(work_dir)) == []
+
+
+def test_NativeConvertArchive_WriteError_RaiseWriteError(tmpdir, monkeypatch):
+
+    archive, _, _ = native_archive(tmpdir, zipfile.ZIP_STORED)
+
+    def write_nifti(nifti_file, slices, *args, **kwargs):
+        raise ValueError("Unable to write the NIfTI")
+
+    monkeypatch.setattr(native, "write_nifti", write_nifti)
+
+    work_dir = tmpdir.mkdir("work")
+
+    with pytest.raises(ValueError, match="Unable to write the NIfTI"):
+        native.convert_archive(
+            native_prepare_args(archive), str(work_dir), NATIVE_DCM2NIIX_ARGS
+        )
+
+
+def test_NativeConvertArchive_PhilipsSeries_ConvertWithDcm2niix(tmpdir):
+
+    output, dicom_index = native.convert_archive(
+        native_prepare_args(f"{ASSETS_DIR}/dicom_single.zip"),
+        str(tmpdir),
+        NATIVE_DCM2NIIX_ARGS,
+    )
+
+    assert output is None
+    assert dicom_index is None
+    assert os.listdir(str(tmpdir)) == []
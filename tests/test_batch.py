@@ -0,0 +1,100 @@
+"""Testing for functions within batch.py script."""
+
+import json
+import logging
+import os
+from pathlib import Path
+
+from dcm2niix_gear import batch
+
+ASSETS_DIR = Path(__file__).parent / "assets"
+
+
+def test_LoadConfig_ConfigFile_OverrideManifestDefaults(tmpdir):
+
+    config_file = os.path.join(tmpdir, "config.json")
+    with open(config_file, "w") as config_obj:
+        json.dump(
+            {
+                "config": {"pydeface": True},
+                "inputs": {"dcm2niix_input": {"object": {"modality": "MR"}}},
+            },
+            config_obj,
+        )
+
+    config, inputs = batch.load_config(config_file)
+
+    assert config["pydeface"] is True
+    assert config["compress_images"] == "y"
+    assert inputs["dcm2niix_input"]["object"]["modality"] == "MR"
+
+    context = batch.BatchContext(
+        config,
+        {"dcm2niix_input": {"location": {"path": "/input/dicoms.zip"}}},
+        tmpdir,
+        tmpdir,
+    )
+    assert context.get_input_path("dcm2niix_input") == "/input/dicoms.zip"
+    assert context.get_input_path("rec_file_input") is None
+
+
+def test_InputNames_DuplicateFilenames_Unique(tmpdir):
+
+    input_files = batch.find_inputs([ASSETS_DIR / "dicom_single.zip"]) + [
+        Path(tmpdir) / "dicom_single.zip",
+        Path(tmpdir) / "parrec_single.zip",
+    ]
+    names = batch.input_names(input_files)
+
+    assert len(set(names.values())) == 3
+    assert names[Path(tmpdir) / "parrec_single.zip"] == "parrec_single.zip"
+    assert names == batch.input_names(input_files)
+
+
+def test_WriteSummary_CompletedInputs_SkipOnResume(tmpdir):
+
+    output_root = str(tmpdir)
+    os.makedirs(os.path.join(output_root, batch.STATUS_DIR))
+    input_files = [Path(tmpdir) / "a.zip", Path(tmpdir) / "b.zip"]
+    names = batch.input_names(input_files)
+
+    batch.write_status(output_root, "a.zip", {"name": "a.zip", "status": "success"})
+    summary = batch.write_summary(output_root, input_files, names)
+
+    assert batch.completed(output_root, "a.zip")
+    assert not batch.completed(output_root, "b.zip")
+    assert summary["counts"] == {"success": 1, "pending": 1}
+
+
+def convert_or_crash(input_file, name, output_root, config, inputs, keep_work=False):
+    """Stand-in for batch.convert_input whose worker crashes on crash.zip."""
+    batch.write_status(output_root, name, {"name": name, "status": "running"})
+    if name == "crash.zip":
+        os._exit(1)
+    status = {"input": input_file, "name": name, "status": "success"}
+    batch.write_status(output_root, name, status)
+    return status
+
+
+def test_RunBatch_WorkerCrash_ResubmitNotStarted(tmpdir, monkeypatch):
+
+    monkeypatch.setattr(batch, "convert_input", convert_or_crash)
+    monkeypatch.setattr(batch, "_initialize_worker", lambda log_level: None)
+    input_files = [Path(tmpdir) / name for name in ["a.zip", "crash.zip", "b.zip"]]
+
+    summary = batch.run_batch(input_files, str(tmpdir), {}, {}, workers=1)
+
+    statuses = {status["name"]: status["status"] for status in summary["inputs"]}
+    assert statuses == {"a.zip": "success", "crash.zip": "crashed", "b.zip": "success"}
+
+
+def test_InitializeWorker_ForkedHandlers_SetLogLevel(monkeypatch):
+
+    root_logger = logging.getLogger()
+    monkeypatch.setattr(root_logger, "level", logging.INFO)
+    monkeypatch.setattr(root_logger, "handlers", [logging.StreamHandler()])
+    monkeypatch.setattr(batch.importlib, "import_module", lambda name: None)
+
+    batch._initialize_worker(logging.DEBUG)
+
+    assert root_logger.level == logging.DEBUG
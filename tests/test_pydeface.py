@@ -1,13 +1,21 @@
 """Testing for functions within pydeface_run.py script."""
 
+import json
+import logging
 import os
 import shutil
+import zipfile
 from pathlib import Path
 
 import nibabel as nb
 import numpy as np
+import pydicom
 
+from dcm2niix_gear.pydeface import engine
 from dcm2niix_gear.pydeface import pydeface_run
+from dcm2niix_gear.pydeface import registration
+from dcm2niix_gear.pydeface import selection
+from dcm2niix_gear.pydeface import template_cache
 
 ASSETS_DIR = Path(__file__).parent / "assets"
 
@@ -91,3 +99,348 @@ def test_RunPydeface_WithAllOptions_Match():
     os.remove(test_file)
     os.remove(f"{ASSETS_DIR}/pydeface_T1_test_pydeface_mask.nii.gz")
     os.remove(f"{ASSETS_DIR}/pydeface_T1_test_pydeface.mat")
+
+
+def test_RunPydeface_WithWorkerEngine_Match():
+
+    infile = f"{ASSETS_DIR}/pydeface_T1.nii.gz"
+    test_file = shutil.copyfile(infile, f"{ASSETS_DIR}/pydeface_T1_test.nii.gz")
+    valid_file = f"{ASSETS_DIR}/pydeface_T1_infile.nii.gz"
+
+    pydeface_run.deface_multiple_niftis([test_file], pydeface_engine="worker")
+
+    valid_image = nb.load(valid_file).get_fdata()
+    test_image = nb.load(test_file).get_fdata()
+    outcome = np.array_equal(valid_image, test_image)
+
+    assert outcome is True
+
+    os.remove(test_file)
+
+
+def test_PyDefaceEngine_WorkerUnavailable_ReturnFalse(tmpdir):
+
+    with engine.PyDefaceEngine(template=f"{tmpdir}/missing_template.nii.gz") as worker:
+        outcome = worker.deface(f"{tmpdir}/T1.nii.gz")
+
+    assert outcome is False
+
+
+def test_PyDefaceEngineDeface_WorkerPrints_LogInParent(tmpdir, monkeypatch, caplog):
+
+    image_file = f"{ASSETS_DIR}/pydeface_facemask.nii.gz"
+    monkeypatch.setattr(engine, "initial_checks", lambda *args: (image_file,) * 2)
+    monkeypatch.setattr(
+        engine, "_deface_image", lambda *args: print("Defacing mask...\nDone.")
+    )
+    caplog.set_level(logging.INFO)
+
+    with engine.PyDefaceEngine() as worker:
+        outcome = worker.deface(f"{tmpdir}/T1.nii.gz")
+
+    messages = [
+        record.getMessage()
+        for record in caplog.records
+        if record.name == engine.__name__
+    ]
+    assert outcome is True
+    assert "Defacing mask..." in messages
+    assert "Done." in messages
+
+
+def test_PyDefaceEngineDeface_InWorker_ReturnUsage(tmpdir, monkeypatch):
+
+    monkeypatch.setattr(engine, "_deface_image", lambda *args: sum(range(10**6)))
+
+    usage, wall_time, sampled_peak_rss = engine._deface(
+        f"{tmpdir}/T1.nii.gz", "mutualinfo", False, False
+    )
+
+    assert set(usage) == set(engine._USAGE_FIELDS) | {"ru_maxrss"}
+    assert usage["ru_utime"] + usage["ru_stime"] >= 0
+    assert wall_time > 0
+    assert sampled_peak_rss > 0
+
+
+def test_RunPydeface_WithDownsample_DiceAboveThreshold():
+
+    infile = f"{ASSETS_DIR}/pydeface_T1.nii.gz"
+    full_file = shutil.copyfile(infile, f"{ASSETS_DIR}/pydeface_T1_full.nii.gz")
+    test_file = shutil.copyfile(infile, f"{ASSETS_DIR}/pydeface_T1_test.nii.gz")
+
+    pydeface_run.deface_multiple_niftis([full_file])
+    pydeface_run.deface_multiple_niftis([test_file], pydeface_downsample=2)
+
+    full_removed = nb.load(full_file).get_fdata() == 0
+    test_removed = nb.load(test_file).get_fdata() == 0
+    dice = (
+        2
+        * np.count_nonzero(full_removed & test_removed)
+        / (np.count_nonzero(full_removed) + np.count_nonzero(test_removed))
+    )
+
+    assert dice > 0.95
+
+    os.remove(full_file)
+    os.remove(test_file)
+
+
+def test_Downsample_BlockAverage_Match():
+
+    data = np.arange(4 * 4 * 2, dtype=float).reshape(4, 4, 2)
+    img = nb.Nifti1Image(data, np.diag([0.5, 0.5, 1.0, 1.0]))
+
+    downsampled_img = registration.downsample(img, 1.0)
+
+    assert downsampled_img.shape == (2, 2, 2)
+    assert np.allclose(
+        downsampled_img.get_fdata()[0, 0, 0], data[:2, :2, 0].mean()
+    )
+    # Block centres map to the centre of the averaged voxels
+    assert np.allclose(
+        downsampled_img.affine @ [0, 0, 0, 1], img.affine @ [0.5, 0.5, 0, 1]
+    )
+
+
+def test_Downsample_CoarserThanResolution_ReturnNone():
+
+    img = nb.Nifti1Image(np.zeros((4, 4, 4)), np.diag([2.0, 2.0, 2.0, 1.0]))
+
+    assert registration.downsample(img, 2.0) is None
+
+
+def test_ConvertFlirtMatrix_SameImage_Match():
+
+    img = nb.Nifti1Image(np.zeros((10, 12, 14)), np.diag([2.0, 2.0, 3.0, 1.0]))
+    matrix = np.array(
+        [[1, 0, 0, 5], [0, 1, 0, -3], [0, 0, 1, 2], [0, 0, 0, 1]], dtype=float
+    )
+
+    outcome = registration.convert_flirt_matrix(matrix, img, img)
+
+    assert np.allclose(outcome, matrix)
+
+
+def test_ConvertFlirtMatrix_SharedFrameOfReference_MatchWorld():
+
+    source_img = nb.Nifti1Image(np.zeros((10, 12, 14)), np.diag([2.0, 2.0, 3.0, 1.0]))
+    target_affine = np.diag([1.0, 1.0, 1.5, 1.0])
+    target_affine[:3, 3] = [4.0, -2.0, 6.0]
+    target_img = nb.Nifti1Image(np.zeros((20, 24, 28)), target_affine)
+    matrix = np.eye(4)
+    matrix[:3, 3] = [5.0, -3.0, 2.0]
+
+    target_matrix = registration.convert_flirt_matrix(matrix, source_img, target_img)
+
+    # A template point must land on the same world coordinate in both images
+    template_point = np.array([10.0, 12.0, 9.0, 1.0])
+    source_world = (
+        source_img.affine
+        @ np.linalg.inv(registration.vox2fsl(source_img))
+        @ matrix
+        @ template_point
+    )
+    target_world = (
+        target_img.affine
+        @ np.linalg.inv(registration.vox2fsl(target_img))
+        @ target_matrix
+        @ template_point
+    )
+
+    assert np.allclose(source_world, target_world)
+
+
+def test_GroupByFrameOfReference_NoDicoms_SeparateGroups(tmpdir):
+
+    nifti_files = [f"{tmpdir}/T1.nii.gz", f"{tmpdir}/T2.nii.gz"]
+
+    groups = pydeface_run.group_by_frame_of_reference(nifti_files, None)
+
+    assert groups == [[nifti_files[0]], [nifti_files[1]]]
+
+
+def write_series(tmpdir, name, series_number, description, frame_of_reference_uid):
+    """Write a DICOM of a series, and a NIfTI with its sidecar as dcm2niix names it."""
+    with zipfile.ZipFile(f"{ASSETS_DIR}/dicom_single.zip") as archive:
+        dicom_header = pydicom.dcmread(archive.open("image_1.dcm"))
+    dicom_header.SeriesNumber = series_number
+    dicom_header.SeriesDescription = description
+    dicom_header.FrameOfReferenceUID = frame_of_reference_uid
+    dicom_dir = tmpdir.join("dicoms")
+    dicom_dir.ensure(dir=True)
+    dicom_header.save_as(str(dicom_dir.join(f"{name}.dcm")))
+
+    nifti_file = f"{tmpdir}/{name}.nii.gz"
+    nb.Nifti1Image(np.ones((8, 8, 8)), np.eye(4)).to_filename(nifti_file)
+    with open(f"{tmpdir}/{name}.json", "w") as sidecar_file:
+        json.dump(
+            {
+                "SeriesNumber": series_number,
+                "SeriesDescription": description.replace(" ", "_"),
+            },
+            sidecar_file,
+        )
+
+    return nifti_file
+
+
+def fake_pydeface(calls):
+    """Stand-in for deface_single_nifti, writing the files PyDeface keeps."""
+
+    def deface_single_nifti(infile, pydeface_nocleanup=False, **kwargs):
+        calls.append(infile)
+        if pydeface_nocleanup:
+            stem = str(infile).replace(".gz", "").replace(".nii", "")
+            np.savetxt(f"{stem}_pydeface.mat", np.eye(4))
+            nb.Nifti1Image(np.ones((8, 8, 8)), np.eye(4)).to_filename(
+                f"{stem}_pydeface_mask.nii.gz"
+            )
+
+    return deface_single_nifti
+
+
+def test_GroupByFrameOfReference_SharedFrameOfReference_GroupTogether(tmpdir):
+
+    t1_file = write_series(tmpdir, "T1", 2, "T1 MPRAGE", "1.2.3.1")
+    t2_file = write_series(tmpdir, "T2", 3, "T2 SPACE", "1.2.3.1")
+    flair_file = write_series(tmpdir, "FLAIR", 4, "FLAIR", "1.2.3.2")
+    os.remove(f"{tmpdir}/dicoms/FLAIR.dcm")
+    other_file = write_series(tmpdir, "other", 5, "other", "1.2.3.3")
+    os.remove(f"{tmpdir}/other.json")
+    pd_file = write_series(tmpdir, "PD", 6, "PD", "1.2.3.1")
+
+    groups = pydeface_run.group_by_frame_of_reference(
+        [t1_file, t2_file, flair_file, other_file, pd_file], f"{tmpdir}/dicoms"
+    )
+
+    # NIfTIs without a matching DICOM or sidecar are registered on their own
+    assert groups == [[t1_file, t2_file, pd_file], [flair_file], [other_file]]
+
+
+def test_DefaceFrameOfReference_SharedRegistration_ReuseRegistration(
+    tmpdir, monkeypatch
+):
+
+    calls, applied = [], []
+    monkeypatch.setattr(pydeface_run, "deface_single_nifti", fake_pydeface(calls))
+    monkeypatch.setattr(
+        registration,
+        "apply_registration",
+        lambda file, matrix, **kwargs: applied.append(file) or True,
+    )
+    t1_file = write_series(tmpdir, "T1", 2, "T1", "1.2.3.1")
+    t2_file = write_series(tmpdir, "T2", 3, "T2", "1.2.3.1")
+
+    pydeface_run.deface_frame_of_reference([t1_file, t2_file])
+
+    assert calls == [t1_file]
+    assert applied == [t2_file]
+    # The registration kept for reuse is removed once the group is defaced
+    assert not os.path.exists(f"{tmpdir}/T1_pydeface.mat")
+    assert not os.path.exists(f"{tmpdir}/T1_pydeface_mask.nii.gz")
+
+
+def test_DefaceFrameOfReference_MaskCheckFails_RegisterInFull(tmpdir, monkeypatch):
+
+    calls = []
+    monkeypatch.setattr(pydeface_run, "deface_single_nifti", fake_pydeface(calls))
+    monkeypatch.setattr(
+        registration, "apply_registration", lambda file, matrix, **kwargs: False
+    )
+    t1_file = write_series(tmpdir, "T1", 2, "T1", "1.2.3.1")
+    t2_file = write_series(tmpdir, "T2", 3, "T2", "1.2.3.1")
+
+    pydeface_run.deface_frame_of_reference([t1_file, t2_file])
+
+    assert calls == [t1_file, t2_file]
+
+
+def test_DefaceFrameOfReference_NoFovOverlap_RegisterInFull(tmpdir, monkeypatch):
+
+    calls, applied = [], []
+    monkeypatch.setattr(pydeface_run, "deface_single_nifti", fake_pydeface(calls))
+    monkeypatch.setattr(
+        registration,
+        "apply_registration",
+        lambda file, matrix, **kwargs: applied.append(file) or True,
+    )
+    t1_file = write_series(tmpdir, "T1", 2, "T1", "1.2.3.1")
+    t2_file = write_series(tmpdir, "T2", 3, "T2", "1.2.3.1")
+    shifted_affine = np.eye(4)
+    shifted_affine[:3, 3] = 100
+    nb.Nifti1Image(np.ones((8, 8, 8)), shifted_affine).to_filename(t2_file)
+
+    pydeface_run.deface_frame_of_reference([t1_file, t2_file])
+
+    assert calls == [t1_file, t2_file]
+    assert applied == []
+
+
+def test_SelectNiftis_Policy_SkipWithReason(tmpdir):
+
+    affine = np.diag([1.0, 1.0, 1.0, 1.0])
+    anat_file = f"{tmpdir}/anat.nii.gz"
+    nb.Nifti1Image(np.zeros((160, 160, 160)), affine).to_filename(anat_file)
+    func_file = f"{tmpdir}/func.nii.gz"
+    nb.Nifti1Image(np.zeros((160, 160, 160, 2)), affine).to_filename(func_file)
+    scout_file = f"{tmpdir}/scout.nii.gz"
+    nb.Nifti1Image(np.zeros((160, 160, 160)), affine).to_filename(scout_file)
+    with open(f"{tmpdir}/scout.json", "w") as sidecar_file:
+        sidecar_file.write('{"SeriesDescription": "AAHead_Scout"}')
+    slab_file = f"{tmpdir}/slab.nii.gz"
+    nb.Nifti1Image(np.zeros((160, 160, 20)), affine).to_filename(slab_file)
+
+    selected_files, skipped_files = selection.select_niftis(
+        [anat_file, func_file, scout_file, slab_file]
+    )
+
+    assert selected_files == [anat_file]
+    assert sorted(skipped_files) == sorted([func_file, scout_file, slab_file])
+    assert "4D" in skipped_files[func_file]
+    assert "SeriesDescription" in skipped_files[scout_file]
+    assert "field of view" in skipped_files[slab_file]
+
+
+def test_CachedRegistrationTemplate_Downsample_MatchTemplateMatrix(tmpdir, monkeypatch):
+
+    monkeypatch.setenv("FSLDIR", str(tmpdir))
+    template_file = f"{tmpdir}/template.nii.gz"
+    template_img = nb.Nifti1Image(
+        np.ones((8, 8, 8), dtype=np.float32), np.diag([1.0, 1.0, 1.0, 1.0])
+    )
+    template_img.to_filename(template_file)
+
+    downsampled_file, template_matrix = template_cache.cached_registration_template(
+        template_file, 2, f"{tmpdir}/cache"
+    )
+    downsampled_img = nb.load(downsampled_file)
+
+    assert downsampled_img.shape == (4, 4, 4)
+    # Template voxel centres map to the same world coordinate in both templates
+    template_point = registration.vox2fsl(template_img) @ [0.5, 0.5, 0.5, 1]
+    downsampled_point = registration.vox2fsl(downsampled_img) @ [0, 0, 0, 1]
+    assert np.allclose(template_matrix @ template_point, downsampled_point)
+
+
+def test_CachedRegistrationTemplate_WithoutCache_MatchCachedTemplate(
+    tmpdir, monkeypatch
+):
+
+    monkeypatch.setenv("FSLDIR", str(tmpdir))
+    template_file = f"{tmpdir}/template.nii.gz"
+    data = np.arange(8 ** 3, dtype=np.float32).reshape((8, 8, 8))
+    nb.Nifti1Image(data, np.diag([1.0, 1.0, 1.0, 1.0])).to_filename(template_file)
+
+    cached_file, cached_matrix = template_cache.cached_registration_template(
+        template_file, 2, f"{tmpdir}/cache"
+    )
+    work_dir = tmpdir.mkdir("work")
+    uncached_file, uncached_matrix = template_cache.cached_registration_template(
+        template_file, 2, work_dir=str(work_dir)
+    )
+
+    assert os.path.dirname(uncached_file) == str(work_dir)
+    assert np.allclose(cached_matrix, uncached_matrix)
+    assert np.array_equal(
+        nb.load(cached_file).get_fdata(), nb.load(uncached_file).get_fdata()
+    )
@@ -1,9 +1,42 @@
 """Testing for functions within dcm2niix_utils.py script."""
 
+import errno
+import gzip
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import time
+import zipfile
+from types import SimpleNamespace
+
+import nibabel as nb
+import numpy as np
+import pydicom
 import pytest
 from pathlib import Path
 
+from dcm2niix_gear.dcm2niix import arrange
+from dcm2niix_gear.dcm2niix import chunking
+from dcm2niix_gear.dcm2niix import conversion_cache
+from dcm2niix_gear.dcm2niix import dcm2niix_run
 from dcm2niix_gear.dcm2niix import dcm2niix_utils
+from dcm2niix_gear.dcm2niix import incremental
+from dcm2niix_gear.dcm2niix import nrrd_export
+from dcm2niix_gear.dcm2niix import series_pipeline
+from dcm2niix_gear.dcm2niix.interfaces import Dcm2niixEnhanced
+from dcm2niix_gear.utils import cache
+from dcm2niix_gear.utils import checkpoint
+from dcm2niix_gear.utils import footprint
+from dcm2niix_gear.utils import metadata
+from dcm2niix_gear.utils import pipeline
+from dcm2niix_gear.utils import planner
+from dcm2niix_gear.utils import preflight
+from dcm2niix_gear.utils import processes
+from dcm2niix_gear.utils import profiling
+from dcm2niix_gear.utils import staging
 
 ASSETS_DIR = Path(__file__).parent / "assets"
 
@@ -15,3 +48,995 @@ def test_CoilCombine_ListNiftis_CatchError():
         dcm2niix_utils.coil_combine(nifti_files)
 
     assert exception.type == SystemExit
+
+
+def test_CacheGetOrCreate_Repeat_CreateOnce(tmpdir):
+
+    created = []
+
+    def create(entry):
+        created.append(entry)
+        with open(os.path.join(entry, "data"), "w") as data_file:
+            data_file.write("cached")
+
+    entry_1 = cache.get_or_create(str(tmpdir), "test", "key", create)
+    entry_2 = cache.get_or_create(str(tmpdir), "test", "key", create)
+
+    assert entry_1 == entry_2
+    assert len(created) == 1
+    with open(os.path.join(entry_2, "data")) as data_file:
+        assert data_file.read() == "cached"
+
+
+def test_CacheEvict_MaxSize_RemoveLeastRecentlyUsed(tmpdir):
+
+    def create(entry):
+        with open(os.path.join(entry, "data"), "wb") as data_file:
+            data_file.write(b"0" * 100)
+
+    old_entry = cache.get_or_create(str(tmpdir), "test", "old", create)
+    os.utime(old_entry, (0, 0))
+    new_entry = cache.get_or_create(str(tmpdir), "test", "new", create)
+    cache.release_pins()
+
+    cache.evict(str(tmpdir), 150)
+
+    assert not os.path.exists(old_entry)
+    assert os.path.exists(new_entry)
+
+
+def pin_entry(cache_dir, pinned_event, release_event):
+    with cache.pinned(cache_dir, "test", "old") as entry:
+        assert entry is not None
+        pinned_event.set()
+        release_event.wait(30)
+
+
+def test_CacheEvict_EntryPinnedByOtherJob_KeepEntry(tmpdir):
+
+    def create(entry):
+        with open(os.path.join(entry, "data"), "wb") as data_file:
+            data_file.write(b"0" * 100)
+
+    old_entry = cache.get_or_create(str(tmpdir), "test", "old", create)
+    os.utime(old_entry, (0, 0))
+    cache.release_pins()
+
+    pinned_event = multiprocessing.Event()
+    release_event = multiprocessing.Event()
+    job = multiprocessing.Process(
+        target=pin_entry, args=(str(tmpdir), pinned_event, release_event)
+    )
+    job.start()
+    try:
+        assert pinned_event.wait(30)
+        cache.evict(str(tmpdir), 0)
+        assert os.path.exists(old_entry)
+    finally:
+        release_event.set()
+        job.join(30)
+
+    assert job.exitcode == 0
+    cache.evict(str(tmpdir), 0)
+    assert not os.path.exists(old_entry)
+
+
+def test_ProfilingSpan_Nested_WriteProfile(tmpdir):
+
+    profiling.reset()
+    with profiling.span("prepare"):
+        with profiling.span("extraction", files=2) as record:
+            record["archive"] = "dicoms.zip"
+
+    profile_file = profiling.write(str(tmpdir))
+    profiling.reset()
+
+    with open(profile_file) as file_obj:
+        spans = json.load(file_obj)["spans"]
+
+    assert [span["path"] for span in spans] == ["prepare/extraction", "prepare"]
+    assert spans[0]["files"] == 2
+    assert spans[0]["archive"] == "dicoms.zip"
+    assert spans[1]["wall_time"] >= spans[0]["wall_time"] >= 0
+    assert spans[1]["process_peak_rss_at_end"] > 0
+
+
+def test_ProcessesRun_Command_RecordUsage():
+
+    profiling.reset()
+    command = [sys.executable, "-c", "x = bytearray(50 * 1024 ** 2); print('done')"]
+    processes.run(command, tool="python")
+    process = processes.run([sys.executable, "-c", "exit(3)"], tool="python")
+    totals = profiling.process_totals()
+    profiling.reset()
+
+    assert process.returncode == 3
+    assert totals["python"]["calls"] == 2
+    assert totals["python"]["failures"] == 1
+    assert totals["python"]["max_rss"] > 50 * 1024 ** 2
+
+
+def test_ProcessesPopen_OverlappingTools_AccountApart():
+
+    profiling.reset()
+    busy = [
+        sys.executable,
+        "-c",
+        "import time\nend = time.process_time() + 0.5\n"
+        "while time.process_time() < end:\n    pass",
+    ]
+    idle = [sys.executable, "-c", "import time; time.sleep(1.5)"]
+    with processes.popen(idle, tool="idle") as idle_process:
+        processes.run(busy, tool="busy")
+        idle_process.stdout.close()
+    totals = profiling.process_totals()
+    profiling.reset()
+
+    assert idle_process.returncode == 0
+    assert totals["busy"]["user_time"] + totals["busy"]["sys_time"] >= 0.4
+    # The idle tool ran while the busy tool did, but is not accounted its CPU time
+    assert totals["idle"]["user_time"] + totals["idle"]["sys_time"] < 0.25
+
+
+def test_ProcessesRunInterface_FailedCommand_RaiseWithOutput():
+
+    interface = SimpleNamespace(
+        inputs=SimpleNamespace(environ={"GEAR_TEST": "set"}),
+        cmdline="echo $GEAR_TEST; exit 3",
+    )
+
+    with pytest.raises(RuntimeError, match="status 3:\nset"):
+        processes.run_interface(interface, tool="sh")
+    process = processes.run_interface(interface, tool="sh", success_codes=(3,))
+    profiling.reset()
+
+    assert process.stdout == "set\n"
+
+
+def test_ConversionCacheKey_ConfigChange_ChangeKey():
+
+    prepare_args = {
+        "infile": f"{ASSETS_DIR}/dicom_single.zip",
+        "rec_infile": None,
+        "remove_incomplete_volumes": False,
+        "decompress_dicoms": False,
+    }
+    dcm2niix_args = {"compress_images": "y", "filename": "%f", "merge2d": False}
+
+    key = conversion_cache.cache_key(prepare_args, dcm2niix_args, "v1.0.20201102")
+
+    assert key == conversion_cache.cache_key(
+        dict(prepare_args), dict(dcm2niix_args), "v1.0.20201102"
+    )
+    assert key != conversion_cache.cache_key(
+        prepare_args, {**dcm2niix_args, "merge2d": True}, "v1.0.20201102"
+    )
+    assert key != conversion_cache.cache_key(
+        {**prepare_args, "decompress_dicoms": True}, dcm2niix_args, "v1.0.20201102"
+    )
+    assert key != conversion_cache.cache_key(
+        prepare_args, dcm2niix_args, "v1.0.20210317"
+    )
+
+
+def test_ConversionCacheRestore_StoredOutputs_HardlinkOutputs(tmpdir):
+
+    cache_dir = tmpdir.mkdir("cache")
+    first_dir = tmpdir.mkdir("first")
+    second_dir = tmpdir.mkdir("second")
+
+    for name in ["image.nii.gz", "image.json", "image.bval", "image.bvec"]:
+        first_dir.join(name).write(name)
+
+    output = SimpleNamespace(
+        outputs=SimpleNamespace(
+            converted_files=str(first_dir.join("image.nii.gz")),
+            bids=[str(first_dir.join("image.json"))],
+            bvals=str(first_dir.join("image.bval")),
+            bvecs=str(first_dir.join("image.bvec")),
+        )
+    )
+    dicom_index = {"1/series": {"Rows": 64}}
+
+    assert conversion_cache.restore("key", str(second_dir), str(cache_dir)) == (
+        None,
+        None,
+    )
+
+    conversion_cache.store("key", output, dicom_index, str(cache_dir))
+    restored, restored_index = conversion_cache.restore(
+        "key", str(second_dir), str(cache_dir)
+    )
+
+    assert restored_index == dicom_index
+    assert restored.outputs.converted_files == [str(second_dir.join("image.nii.gz"))]
+    assert restored.outputs.bids == [str(second_dir.join("image.json"))]
+    assert second_dir.join("image.bval").read() == "image.bval"
+    assert os.path.samefile(
+        str(first_dir.join("image.nii.gz")), str(second_dir.join("image.nii.gz"))
+    )
+
+
+def test_BuildDicomIndex_DicomDirectory_IndexSeries(tmpdir):
+
+    with zipfile.ZipFile(f"{ASSETS_DIR}/dicom_single.zip") as archive:
+        archive.extractall(str(tmpdir))
+
+    dicom_index = metadata.build_dicom_index(str(tmpdir))
+
+    assert list(dicom_index) == ["201/sT1W_3D_TFE_SAG"]
+    assert json.loads(json.dumps(dicom_index)) == dicom_index
+    assert dicom_index["201/sT1W_3D_TFE_SAG"]["Rows"] > 0
+
+
+def test_FingerprintSeries_RemovedSlice_ChangeFingerprint(tmpdir):
+
+    with zipfile.ZipFile(f"{ASSETS_DIR}/dicom_single.zip") as archive:
+        archive.extractall(str(tmpdir))
+
+    series = incremental.fingerprint_series(str(tmpdir))
+    os.remove(series[list(series)[0]]["files"][0])
+    changed_series = incremental.fingerprint_series(str(tmpdir))
+
+    assert list(series) == list(changed_series)
+    info = series[list(series)[0]]
+    assert info["series_number"] == "201"
+    assert len(info["files"]) == 6
+    assert info["fingerprint"] != changed_series[list(series)[0]]["fingerprint"]
+
+
+def two_series_dir(tmpdir):
+    """Extract the test DICOMs, with the last three moved to a second series."""
+    # Without a resource plan, left by an earlier test, the series are pipelined
+    planner.reset()
+
+    input_dir = tmpdir.mkdir("dicoms")
+    with zipfile.ZipFile(f"{ASSETS_DIR}/dicom_single.zip") as archive:
+        archive.extractall(str(input_dir))
+
+    dicom_files = sorted(str(path) for path in Path(str(input_dir)).rglob("*.dcm"))
+    for dicom_file in dicom_files[3:]:
+        dicom_header = pydicom.dcmread(dicom_file)
+        dicom_header.SeriesInstanceUID = f"{dicom_header.SeriesInstanceUID}.2"
+        dicom_header.SeriesNumber = 301
+        dicom_header.SeriesDescription = "second series"
+        dicom_header.save_as(dicom_file)
+
+    return str(input_dir)
+
+
+SERIES_DCM2NIIX_ARGS = {
+    "bids_sidecar": "y",
+    "compress_images": "y",
+    "filename": "%f_%s",
+    "merge2d": False,
+}
+
+
+@pytest.mark.skipif(not shutil.which("dcm2niix"), reason="dcm2niix is not installed")
+def test_SeriesPipelineConvertAndProcess_TwoSeries_MatchSequential(tmpdir):
+
+    input_dir = two_series_dir(tmpdir)
+    sequential_dir = tmpdir.mkdir("sequential")
+    pipelined_dir = tmpdir.mkdir("pipelined")
+
+    output = dcm2niix_run.convert_directory(
+        input_dir, str(sequential_dir), **SERIES_DCM2NIIX_ARGS
+    )
+    pipelined, pydeface_skipped, dicom_index = series_pipeline.convert_and_process(
+        input_dir, str(pipelined_dir), SERIES_DCM2NIIX_ARGS
+    )
+
+    for field in ["converted_files", "bids"]:
+        sequential_files = sorted(getattr(output.outputs, field))
+        pipelined_files = sorted(getattr(pipelined.outputs, field))
+        assert [os.path.basename(file) for file in pipelined_files] == [
+            os.path.basename(file) for file in sequential_files
+        ]
+        for sequential_file, pipelined_file in zip(sequential_files, pipelined_files):
+            if field == "bids":
+                with open(sequential_file) as sidecar, open(pipelined_file) as other:
+                    assert json.load(sidecar) == json.load(other)
+            else:
+                sequential_image = nb.load(sequential_file)
+                pipelined_image = nb.load(pipelined_file)
+                assert np.array_equal(
+                    sequential_image.get_fdata(), pipelined_image.get_fdata()
+                )
+                assert np.allclose(sequential_image.affine, pipelined_image.affine)
+    assert pydeface_skipped == {}
+    assert dicom_index == metadata.build_dicom_index(input_dir)
+
+    metadata_files = [
+        metadata.generate(
+            sorted(converted.outputs.converted_files),
+            sorted(converted.outputs.bids),
+            str(work_dir),
+            dcm2niix_input_dir=input_dir,
+            dicom_index=index,
+        )
+        for converted, work_dir, index in [
+            (output, sequential_dir, None),
+            (pipelined, pipelined_dir, dicom_index),
+        ]
+    ]
+    with open(metadata_files[0]) as sequential, open(metadata_files[1]) as other:
+        assert json.load(sequential) == json.load(other)
+
+
+def test_SeriesPipelineConvertAndProcess_Restarted_SkipProcessedSeries(
+    tmpdir, monkeypatch
+):
+
+    input_dir = two_series_dir(tmpdir)
+    work_dir = tmpdir.mkdir("work")
+    converted = []
+
+    def convert_series(dcm2niix_input_dir, series, incremental_dir, dcm2niix_args):
+        (series_uid,) = series
+        converted.append(series_uid)
+        output_dir = os.path.join(incremental_dir, "output")
+        os.makedirs(output_dir)
+        stem = os.path.join(output_dir, f"dicoms_{series[series_uid]['series_number']}")
+        for extension in [".nii.gz", ".json"]:
+            with open(f"{stem}{extension}", "w") as output_file:
+                output_file.write(series_uid)
+        return {
+            series_uid: {
+                "converted_files": [f"{stem}.nii.gz"],
+                "bids": [f"{stem}.json"],
+                "bvals": [],
+                "bvecs": [],
+            }
+        }
+
+    monkeypatch.setattr(incremental, "convert_series", convert_series)
+    checkpoint.load(str(work_dir), "key")
+    output, _, dicom_index = series_pipeline.convert_and_process(
+        input_dir, str(work_dir), SERIES_DCM2NIIX_ARGS
+    )
+
+    # Restarted after the first series was processed
+    checkpoint.reset()
+    journal_file = work_dir.join(checkpoint.CHECKPOINT_DIR, checkpoint.JOURNAL_FILENAME)
+    journal = json.loads(journal_file.read())
+    journal["stages"] = journal["stages"][:1]
+    journal_file.write(json.dumps(journal))
+    converted.clear()
+    checkpoint.load(str(work_dir), "key")
+    resumed_output, _, resumed_index = series_pipeline.convert_and_process(
+        input_dir, str(work_dir), SERIES_DCM2NIIX_ARGS
+    )
+    checkpoint.reset()
+
+    assert [os.path.basename(file) for file in output.outputs.converted_files] == [
+        "dicoms_201.nii.gz",
+        "dicoms_301.nii.gz",
+    ]
+    assert len(converted) == 1
+    assert resumed_output.outputs.converted_files == output.outputs.converted_files
+    assert resumed_output.outputs.bids == output.outputs.bids
+    assert list(dicom_index) == ["201/sT1W_3D_TFE_SAG", "301/second_series"]
+    assert resumed_index == dicom_index
+
+
+def test_IncrementalApplicable_FilenameWithoutSeriesNumber_NotApplied():
+
+    dcm2niix_args = {"compress_images": "y", "filename": "%f", "merge2d": False}
+
+    assert not incremental.applicable(dcm2niix_args)
+    assert incremental.applicable({**dcm2niix_args, "filename": "%f_%s"})
+    assert incremental.applicable({**dcm2niix_args, "compress_images": "3"})
+    assert not incremental.applicable(
+        {**dcm2niix_args, "filename": "%f_%s", "merge2d": True}
+    )
+
+
+def test_IncrementalRestoreSeries_EvictedSeries_ConvertAsWhole(tmpdir):
+
+    cache_dir = str(tmpdir.mkdir("cache"))
+    series_dir = tmpdir.mkdir("series")
+    work_dir = tmpdir.mkdir("work")
+
+    for key in ["first", "second"]:
+        series_dir.join(f"{key}.nii.gz").write(key)
+        series_dir.join(f"{key}.json").write(key)
+        output = SimpleNamespace(
+            outputs=SimpleNamespace(
+                converted_files=[str(series_dir.join(f"{key}.nii.gz"))],
+                bids=[str(series_dir.join(f"{key}.json"))],
+                bvals=[],
+                bvecs=[],
+            )
+        )
+        conversion_cache.store(
+            key, output, None, cache_dir=cache_dir, namespace=incremental.NAMESPACE
+        )
+
+    output = incremental.restore_series(["first", "second"], str(work_dir), cache_dir)
+    assert sorted(os.listdir(str(work_dir))) == [
+        "first.json",
+        "first.nii.gz",
+        "second.json",
+        "second.nii.gz",
+    ]
+    assert output.outputs.converted_files == [
+        str(work_dir.join("first.nii.gz")),
+        str(work_dir.join("second.nii.gz")),
+    ]
+
+    # An evicted series removes the outputs already restored
+    for name in os.listdir(str(work_dir)):
+        os.remove(str(work_dir.join(name)))
+    shutil.rmtree(os.path.join(cache_dir, incremental.NAMESPACE, "second"))
+
+    assert (
+        incremental.restore_series(["first", "second"], str(work_dir), cache_dir)
+        is None
+    )
+    assert os.listdir(str(work_dir)) == []
+
+
+def test_PipelineRun_TwoStages_OverlapInOrder():
+
+    active = set()
+    overlapped = []
+
+    def first(item):
+        active.add(("first", item))
+        time.sleep(0.05)
+        overlapped.append(any(stage == "second" for stage, _ in set(active)))
+        active.discard(("first", item))
+        return item * 2
+
+    def second(item):
+        active.add(("second", item))
+        time.sleep(0.05)
+        active.discard(("second", item))
+        return item + 1
+
+    results = pipeline.run(range(5), [first, second])
+
+    assert results == [1, 3, 5, 7, 9]
+    assert any(overlapped)
+
+
+def test_PipelineRun_StageExits_RaiseSystemExit():
+
+    def convert(item):
+        if item == 2:
+            os.sys.exit(1)
+        return item
+
+    with pytest.raises(SystemExit):
+        pipeline.run(range(5), [convert, str])
+
+
+def test_ProfilingAttach_PipelineThread_NestSpans():
+
+    def stage(item):
+        with profiling.span("stage"):
+            return item
+
+    profiling.reset()
+    with profiling.span("pipeline"):
+        pipeline.run([1], [stage])
+    records = profiling.spans()
+    profiling.reset()
+
+    assert [record["path"] for record in records] == ["pipeline/stage", "pipeline"]
+
+
+@pytest.mark.parametrize("extension", [".nii", ".nii.gz"])
+def test_ConcatenateNiftis_TemporalChunks_MatchConcatenatedData(tmpdir, extension):
+
+    data = np.arange(4 * 3 * 2 * 5, dtype=np.int16).reshape((4, 3, 2, 5))
+    affine = np.diag([2.0, 2.0, 3.0, 1.0])
+    nifti_files = []
+    for index, chunk in enumerate([data[..., :2], data[..., 2:]]):
+        nifti_file = os.path.join(str(tmpdir), f"chunk{index}{extension}")
+        nb.save(nb.Nifti1Image(chunk, affine), nifti_file)
+        nifti_files.append(nifti_file)
+    target = os.path.join(str(tmpdir), f"series{extension}")
+
+    assert chunking.concatenate_niftis(nifti_files, target)
+    image = nb.load(target)
+    assert image.shape == data.shape
+    assert np.array_equal(np.asanyarray(image.dataobj), data)
+    assert np.allclose(image.affine, affine)
+
+
+def test_ConcatenateNiftis_DifferentScaling_NotConcatenated(tmpdir):
+
+    nifti_files = []
+    for index, slope in enumerate([1.0, 2.0]):
+        image = nb.Nifti1Image(np.zeros((2, 2, 2, 2), dtype=np.int16), np.eye(4))
+        nifti_file = os.path.join(str(tmpdir), f"chunk{index}.nii")
+        nb.save(image, nifti_file)
+        # Set the scaling as stored by dcm2niix, as nibabel resets it on save
+        with open(nifti_file, "r+b") as scaled_file:
+            header = nb.Nifti1Header.from_fileobj(scaled_file)
+            header["scl_slope"] = slope
+            scaled_file.seek(0)
+            scaled_file.write(header.binaryblock)
+        nifti_files.append(nifti_file)
+
+    target = os.path.join(str(tmpdir), "series.nii")
+    assert not chunking.concatenate_niftis(nifti_files, target)
+
+
+def test_ConcatenateColumns_BvalChunks_KeepSeparator(tmpdir):
+
+    files = []
+    for index, values in enumerate(["0\t1000", "1000\t2000\t0"]):
+        bval_file = os.path.join(str(tmpdir), f"chunk{index}.bval")
+        with open(bval_file, "w") as chunk_file:
+            chunk_file.write(values + "\n")
+        files.append(bval_file)
+    target = os.path.join(str(tmpdir), "series.bval")
+
+    chunking.concatenate_columns(files, target)
+
+    with open(target) as bval_file:
+        assert bval_file.read() == "0\t1000\t1000\t2000\t0\n"
+
+
+def test_MergeSidecars_PetFrames_ConcatenateVolumeFields(tmpdir):
+
+    sidecar_files, nifti_files = [], []
+    for index, frames in enumerate([[0, 60], [120, 180, 240]]):
+        sidecar_file = os.path.join(str(tmpdir), f"chunk{index}.json")
+        with open(sidecar_file, "w") as chunk_file:
+            json.dump(
+                {
+                    "AcquisitionTime": f"12:0{index}:00.000000",
+                    "FrameReferenceTime": frames,
+                    "ImageOrientationPatientDICOM": [1, 0, 0, 0, 1, 0],
+                },
+                chunk_file,
+            )
+        sidecar_files.append(sidecar_file)
+        nifti_file = os.path.join(str(tmpdir), f"chunk{index}.nii")
+        nb.save(nb.Nifti1Image(np.zeros((2, 2, 1, len(frames))), np.eye(4)), nifti_file)
+        nifti_files.append(nifti_file)
+    target = os.path.join(str(tmpdir), "series.json")
+
+    chunking.merge_sidecars(sidecar_files, nifti_files, target)
+
+    with open(target) as sidecar_file:
+        assert json.load(sidecar_file) == {
+            "AcquisitionTime": "12:00:00.000000",
+            "FrameReferenceTime": [0, 60, 120, 180, 240],
+            "ImageOrientationPatientDICOM": [1, 0, 0, 0, 1, 0],
+        }
+
+
+@pytest.mark.skipif(not shutil.which("dcm2niix"), reason="dcm2niix is not installed")
+def test_ChunkingConvert_PetFrames_MatchSingleConversion(tmpdir):
+
+    # A dynamic PET series of 20 frames of one slice, from a test DICOM
+    input_dir = tmpdir.mkdir("dicoms")
+    with zipfile.ZipFile(f"{ASSETS_DIR}/dicom_single.zip") as archive:
+        name = [name for name in archive.namelist() if name.endswith(".dcm")][0]
+        source_file = str(tmpdir.join("source.dcm"))
+        with open(source_file, "wb") as dicom_file:
+            dicom_file.write(archive.read(name))
+    for frame in range(20):
+        dicom_header = pydicom.dcmread(source_file)
+        dicom_header.Manufacturer = "GE MEDICAL SYSTEMS"
+        dicom_header.Modality = "PT"
+        dicom_header.SOPInstanceUID = pydicom.uid.generate_uid()
+        dicom_header.TemporalPositionIdentifier = frame + 1
+        dicom_header.InstanceNumber = frame + 1
+        dicom_header.AcquisitionTime = f"1200{frame:02d}.000000"
+        dicom_header.FrameReferenceTime = frame * 60000
+        dicom_header.ActualFrameDuration = 60000
+        dicom_header.save_as(str(input_dir.join(f"{frame:03d}.dcm")))
+    dcm2niix_args = {
+        "bids_sidecar": "y",
+        "compress_images": "y",
+        "compression_level": 6,
+        "filename": "%f_%s",
+        "ignore_errors": False,
+        "merge2d": False,
+        "output_nrrd": False,
+    }
+    planner.reset()
+
+    single = dcm2niix_run.convert_directory(
+        str(input_dir),
+        str(tmpdir.mkdir("single")),
+        **{
+            field: value
+            for field, value in dcm2niix_args.items()
+            if field not in ["ignore_errors", "output_nrrd"]
+        },
+    )
+    chunked = chunking.convert(
+        str(input_dir), str(tmpdir.mkdir("chunked")), dcm2niix_args, chunks=2
+    )
+
+    # The nipype outputs of a single file are strings
+    assert np.array_equal(
+        nb.load(single.outputs.converted_files).get_fdata(),
+        nb.load(chunked.outputs.converted_files[0]).get_fdata(),
+    )
+    with open(single.outputs.bids) as single_obj, open(chunked.outputs.bids[0]) as obj:
+        single_sidecar, chunked_sidecar = json.load(single_obj), json.load(obj)
+    assert len(chunked_sidecar["FrameReferenceTime"]) == 20
+    assert chunked_sidecar == single_sidecar
+
+
+def test_Dcm2niixEnhanced_BidsOnly_SidecarOnlyFlag(tmpdir):
+
+    converter = Dcm2niixEnhanced()
+    converter.inputs.source_dir = str(tmpdir)
+    converter.inputs.output_dir = str(tmpdir)
+    converter.inputs.bids_format = True
+
+    assert "-b y" in converter.cmdline
+    converter.inputs.bids_only = True
+    assert "-b o" in converter.cmdline
+    assert "-b y" not in converter.cmdline
+
+
+def read_nrrd(nrrd_files):
+    """Return the fields and image data of NRRD files written by nrrd_export."""
+    with open(nrrd_files[0], "rb") as nrrd_file:
+        header, _, data = nrrd_file.read().partition(b"\n\n")
+    fields = dict(
+        line.split(": ", 1) for line in header.decode().splitlines()[3:] if line
+    )
+    if "data file" in fields:
+        data_file = os.path.join(os.path.dirname(nrrd_files[0]), fields["data file"])
+        opener = gzip.open if fields["encoding"] == "gzip" else open
+        with opener(data_file, "rb") as nrrd_data:
+            data = nrrd_data.read()[int(fields.get("byte skip", 0)) :]
+    return fields, data
+
+
+@pytest.mark.parametrize(
+    "extension,reference_nifti,nrrd_extensions",
+    [
+        (".nii.gz", True, [".nhdr", ".raw.gz"]),
+        (".nii", True, [".nhdr"]),
+        (".nii", False, [".nrrd"]),
+    ],
+)
+def test_WriteNrrds_Nifti_MatchVoxelData(
+    tmpdir, extension, reference_nifti, nrrd_extensions
+):
+
+    data = np.arange(4 * 3 * 2 * 5, dtype=np.int16).reshape((4, 3, 2, 5))
+    affine = np.array(
+        [[2.0, 0, 0, -10], [0, 2.0, 0, 20], [0, 0, 3.0, -30], [0, 0, 0, 1]]
+    )
+    nifti_file = os.path.join(str(tmpdir), f"series{extension}")
+    nb.save(nb.Nifti1Image(data, affine), nifti_file)
+
+    nrrd_files = nrrd_export.write_nrrds(
+        [nifti_file, os.path.join(str(tmpdir), "series.bval")],
+        reference_nifti=reference_nifti,
+    )
+
+    assert nrrd_files == [
+        os.path.join(str(tmpdir), f"series{nrrd_extension}")
+        for nrrd_extension in nrrd_extensions
+    ]
+    fields, nrrd_data = read_nrrd(nrrd_files)
+    assert fields["type"] == "int16"
+    assert fields["sizes"] == "4 3 2 5"
+    assert fields["space directions"] == "(-2,0,0) (0,-2,0) (0,0,3) none"
+    assert fields["space origin"] == "(10,-20,-30)"
+    assert nrrd_data == data.tobytes(order="F")
+
+
+def test_WriteNrrds_ScaledNifti_WriteScaledFloats(tmpdir):
+
+    data = np.arange(2 * 2 * 2 * 3, dtype=np.int16).reshape((2, 2, 2, 3))
+    nifti_file = os.path.join(str(tmpdir), "series.nii.gz")
+    image = nb.Nifti1Image(data, np.eye(4))
+    image.header.set_slope_inter(0.5, 1)
+    nb.save(image, nifti_file)
+    scaled = np.asanyarray(nb.load(nifti_file).dataobj)
+
+    fields, nrrd_data = read_nrrd(nrrd_export.write_nrrds([nifti_file]))
+
+    assert fields["type"] == "float"
+    assert np.array_equal(
+        np.frombuffer(nrrd_data, dtype=np.float32), scaled.ravel(order="F")
+    )
+
+
+def test_PlannerCpuQuota_CgroupQuota_LimitCpus(tmpdir):
+
+    cgroup_v2 = tmpdir.mkdir("v2")
+    cgroup_v2.join("cpu.max").write("200000 100000\n")
+    cgroup_v1 = tmpdir.mkdir("v1")
+    cgroup_v1.mkdir("cpu,cpuacct").join("cpu.cfs_quota_us").write("100000\n")
+    cgroup_v1.join("cpu,cpuacct").join("cpu.cfs_period_us").write("100000\n")
+    unlimited = tmpdir.mkdir("unlimited")
+    unlimited.join("cpu.max").write("max 100000\n")
+
+    cpus = len(os.sched_getaffinity(0))
+    assert planner.cpu_quota(str(cgroup_v2)) == min(cpus, 2)
+    assert planner.cpu_quota(str(cgroup_v1)) == 1
+    assert planner.cpu_quota(str(unlimited)) == cpus
+
+
+def test_PlannerPlan_MemoryLimit_FitDcm2niixWorkers(tmpdir):
+
+    with zipfile.ZipFile(f"{ASSETS_DIR}/dicom_single.zip") as archive:
+        archive.extractall(str(tmpdir.mkdir("input")))
+    cgroup_dir = tmpdir.mkdir("cgroup")
+    cgroup_dir.join("cpu.max").write("max 100000\n")
+    # The series decodes to 6 slices of 512 x 512 16-bit pixels
+    series_bytes = 6 * 512 * 512 * 2
+    cgroup_dir.join("memory.max").write(f"{series_bytes * 8}\n")
+
+    resource_plan = planner.plan(str(tmpdir.join("input")), str(cgroup_dir))
+    planner.reset()
+
+    assert resource_plan["files"] == 6
+    assert resource_plan["largest_series_bytes"] == series_bytes
+    assert resource_plan["memory_limit"] == series_bytes * 8
+    assert resource_plan["dcm2niix_workers"] == min(resource_plan["cpus"], 2)
+    assert planner.workers("dcm2niix", 4) == 4
+
+
+def test_PlannerPlan_Archive_OverlapStagesIfFit(tmpdir):
+
+    cgroup_dir = tmpdir.mkdir("cgroup")
+    cgroup_dir.join("cpu.max").write("max 100000\n")
+    # The series is the 6 DICOMs at the root of the archive
+    series_bytes = 6 * 533780
+    memory = series_bytes * (planner.DCM2NIIX_MEMORY_FACTOR + 1)
+    cgroup_dir.join("memory.max").write(f"{int(memory / planner.MEMORY_FRACTION)}\n")
+
+    resource_plan = planner.plan(f"{ASSETS_DIR}/dicom_single.zip", str(cgroup_dir))
+    planner.reset()
+
+    assert resource_plan["files"] == 6
+    assert resource_plan["largest_series_bytes"] == series_bytes
+    assert resource_plan["streaming_workers"] == min(resource_plan["cpus"], 2)
+    assert resource_plan["pipeline_workers"] == 1
+    assert resource_plan["pydeface_workers"] == 1
+
+
+def test_PlannerTemporalChunks_MemoryLimit_FitChunks(monkeypatch):
+
+    series_bytes = 1024**3
+    budget = 2 * planner.DCM2NIIX_MEMORY_FACTOR * series_bytes
+    monkeypatch.setattr(
+        planner,
+        "_plan",
+        {
+            "cpus": 8,
+            "memory_limit": budget / planner.MEMORY_FRACTION,
+            "largest_series_bytes": series_bytes,
+        },
+    )
+
+    # Chunks of a sixteenth of the series fit 8 at a time, rather than 2 series
+    assert planner.temporal_chunks(16) == (16, 8)
+    assert planner.temporal_chunks(4) == (4, 4)
+
+    # A series 4 times the memory is split into at least 2 chunks, one at a time
+    planner._plan["largest_series_bytes"] = 4 * series_bytes
+    assert planner.temporal_chunks(1) == (2, 1)
+    assert planner.temporal_chunks(16) == (16, 8)
+
+    planner._plan.clear()
+    assert planner.temporal_chunks(4) == (4, 4)
+
+
+def test_CoilCombine_4dNifti_KeepLastVolume(tmpdir):
+
+    data = np.arange(4 * 4 * 3 * 5, dtype=np.int16).reshape((4, 4, 3, 5))
+    nifti_file = str(tmpdir.join("coil.nii.gz"))
+    nb.Nifti1Image(data, np.eye(4)).to_filename(nifti_file)
+
+    dcm2niix_utils.coil_combine([nifti_file])
+
+    assert np.array_equal(np.asanyarray(nb.load(nifti_file).dataobj), data[..., -1])
+
+
+def test_StageWorkDir_SmallArchive_StageInStagingDir(tmpdir):
+
+    staging_dir = tmpdir.mkdir("shm")
+    input_files = [f"{ASSETS_DIR}/dicom_single.zip"]
+
+    staged_dir = staging.stage_work_dir(input_files, str(staging_dir))
+    assert os.path.dirname(staged_dir) == str(staging_dir)
+    assert os.path.isdir(staged_dir)
+
+    staging.release(staged_dir)
+    assert not os.path.exists(staged_dir)
+
+    # Inputs larger than the maximum size stay in the work directory
+    assert staging.stage_work_dir(input_files, str(staging_dir), max_size=1) is None
+    assert staging.stage_work_dir(input_files, None) is None
+
+
+def test_PreflightEstimate_ZipArchive_EstimateFromDimensions():
+
+    input_files = [f"{ASSETS_DIR}/dicom_single.zip"]
+    with zipfile.ZipFile(input_files[0]) as zip_obj:
+        size = sum(info.file_size for info in zip_obj.infolist())
+
+    uncompressed = preflight.estimate(input_files, compress_images="n")
+    compressed = preflight.estimate(input_files, compress_images="y")
+    arrange.reset()
+
+    # The voxel data of uncompressed slices is their size less the headers
+    assert uncompressed["input_bytes"] == size
+    assert 0.5 * size < uncompressed["output_bytes"] < size
+    assert compressed["output_bytes"] == int(
+        uncompressed["output_bytes"] * preflight.GZIP_RATIO
+    )
+    assert staging.input_size(input_files) == size
+
+    with pytest.raises(SystemExit):
+        preflight.estimate([f"{ASSETS_DIR}/empty_archive.zip"])
+
+
+def test_EstimateTarSize_CompressedTar_ReadRecordedSize(tmpdir):
+
+    tgz_file = f"{ASSETS_DIR}/dicom_nested.tgz"
+    with gzip.open(tgz_file) as gzip_obj:
+        tar_bytes = gzip_obj.read()
+    tmpdir.join("dicom_nested.tar").write_binary(tar_bytes)
+
+    assert arrange.estimate_tar_size(tgz_file) == len(tar_bytes)
+    assert arrange.list_archive(tgz_file) is None
+
+    # The listing is recorded by the extraction, without listing the archive first
+    arrange.prepare_dcm2niix_input(tgz_file, None, str(tmpdir.mkdir("work")))
+    listing = arrange.list_archive(tgz_file)
+    arrange.reset()
+    assert 0 < listing["size"] <= len(tar_bytes)
+    assert listing["subdirs"]
+
+    for command, extension in [(["xz", "-k"], "xz"), (["zstd", "-q"], "zst")]:
+        if not shutil.which(command[0]):
+            continue
+        subprocess.run(command + [str(tmpdir.join("dicom_nested.tar"))], check=True)
+        compressed_file = str(tmpdir.join(f"dicom_nested.tar.{extension}"))
+        assert arrange.estimate_tar_size(compressed_file) == len(tar_bytes)
+
+
+def test_PreflightCheck_ShortOfSpace_Exit(tmpdir):
+
+    work_dir = str(tmpdir.mkdir("work"))
+    output_dir = str(tmpdir.mkdir("output"))
+    free = shutil.disk_usage(work_dir).free
+
+    preflight.check({"input_bytes": 1024, "output_bytes": 1024}, work_dir, output_dir)
+    preflight.check(None, work_dir, output_dir)
+    assert not preflight.fits({"input_bytes": free, "output_bytes": free}, work_dir)
+
+    with pytest.raises(SystemExit):
+        preflight.check({"input_bytes": free, "output_bytes": 1024}, work_dir)
+    with pytest.raises(SystemExit):
+        preflight.check({"input_bytes": 0, "output_bytes": 2 * free}, None, output_dir)
+
+
+def test_OutOfSpace_NoSpaceError_FallBack(tmpdir):
+
+    no_space = OSError(errno.ENOSPC, "No space left on device")
+    other_error = OSError(errno.EACCES, "Permission denied")
+
+    assert staging.out_of_space(str(tmpdir), no_space)
+    assert not staging.out_of_space(str(tmpdir), other_error)
+
+
+def test_RemoveNewFiles_FailedConversion_KeepExistingFiles(tmpdir):
+
+    tmpdir.join("existing.json").write("{}")
+    existing = set(os.listdir(str(tmpdir)))
+    tmpdir.join("partial.nii.gz").write("nifti")
+    tmpdir.mkdir("partial").join("1.nii").write("nifti")
+
+    staging.remove_new_files(str(tmpdir), existing)
+
+    assert os.listdir(str(tmpdir)) == ["existing.json"]
+
+
+def test_CheckpointLoad_ChangedFile_RepeatFromFirstStage(tmpdir):
+
+    work_dir = str(tmpdir)
+    input_dir = tmpdir.mkdir("dicoms")
+    input_dir.join("1.dcm").write("dicom")
+    nifti_file = str(tmpdir.join("1.nii"))
+
+    checkpoint.load(work_dir, "key")
+    checkpoint.record("prepare", directories=[str(input_dir)])
+    with open(nifti_file, "w") as nifti:
+        nifti.write("converted")
+    checkpoint.record("convert", files=[nifti_file], result={"outputs": [nifti_file]})
+    with open(nifti_file, "w") as nifti:
+        nifti.write("coil combined")
+    checkpoint.record("coil_combine", files=[nifti_file])
+
+    # Restarted after the last stage changed the NIfTI
+    checkpoint.reset()
+    checkpoint.load(work_dir, "key")
+    assert checkpoint.completed("convert") == {"outputs": [nifti_file]}
+    assert checkpoint.completed("coil_combine") == {}
+
+    # Restarted while a stage not recorded was changing the NIfTI
+    with open(nifti_file, "w") as nifti:
+        nifti.write("partially defaced")
+    tmpdir.join("stale.json").write("{}")
+    checkpoint.reset()
+    checkpoint.load(work_dir, "key")
+    assert checkpoint.completed("prepare") == {}
+    assert checkpoint.completed("convert") is None
+    assert checkpoint.completed("coil_combine") is None
+    assert sorted(os.listdir(work_dir)) == [checkpoint.CHECKPOINT_DIR, "dicoms"]
+
+    # The journal of another input is discarded
+    checkpoint.reset()
+    checkpoint.load(work_dir, "other key")
+    assert checkpoint.completed("prepare") is None
+    checkpoint.reset()
+
+
+def test_CheckpointLoad_UnrelatedFiles_KeepFiles(tmpdir):
+
+    work_dir = str(tmpdir)
+    tmpdir.join("notes.txt").write("user data")
+    cache_dir = str(tmpdir.join("cache"))
+
+    checkpoint.load(work_dir, "key", keep=[cache_dir])
+    tmpdir.mkdir("cache").join("entry").write("cached")
+    tmpdir.join("partial.nii").write("interrupted")
+
+    # The journal of another input removes nothing
+    checkpoint.reset()
+    checkpoint.load(work_dir, "other key", keep=[cache_dir])
+    assert sorted(os.listdir(work_dir)) == [
+        checkpoint.CHECKPOINT_DIR,
+        "cache",
+        "notes.txt",
+        "partial.nii",
+    ]
+
+    # Only the files the gear created are removed on restart, not the cache
+    tmpdir.join("stale.nii").write("interrupted")
+    checkpoint.reset()
+    checkpoint.load(work_dir, "other key", keep=[cache_dir])
+    checkpoint.reset()
+    assert sorted(os.listdir(work_dir)) == [
+        checkpoint.CHECKPOINT_DIR,
+        "cache",
+        "notes.txt",
+        "partial.nii",
+    ]
+    assert tmpdir.join("cache", "entry").read() == "cached"
+
+
+def test_FootprintReleaseInput_ConvertedInput_DeleteAndReportPeak(tmpdir):
+
+    work_dir = tmpdir.mkdir("work")
+    footprint.start(str(work_dir))
+    dcm2niix_input_dir = work_dir.mkdir("dicom_single")
+    with zipfile.ZipFile(f"{ASSETS_DIR}/dicom_single.zip") as archive:
+        archive.extractall(str(dcm2niix_input_dir))
+    expected_index = metadata.build_dicom_index(str(dcm2niix_input_dir))
+
+    input_bytes = footprint.sample("prepare")
+    dicom_index = footprint.release_input(str(dcm2niix_input_dir))
+    footprint.report()
+    profile_file = profiling.write(str(tmpdir))
+    footprint.reset()
+    profiling.reset()
+
+    assert dicom_index == expected_index
+    assert not dcm2niix_input_dir.exists()
+    assert input_bytes >= 6 * 512 * 512 * 2
+    with open(profile_file) as profile_obj:
+        disk_usage = json.load(profile_obj)["disk_usage"]
+    assert disk_usage["peak_bytes"] == input_bytes
+    assert disk_usage["peak_stage"] == "prepare"
+    assert disk_usage["samples"][-1] == {"stage": "release_input", "bytes": 0}